@@ -0,0 +1,205 @@
+import numpy as np
+
+# A model suggestion of state s that nobody reviewed yet is stored as
+# s + SUGGESTED, so it goes through undo, the journal and sessions like any
+# label while export and training can tell it apart. Labelling a point, or
+# accepting the suggestion, makes it s.
+SUGGESTED = 4
+
+
+def as_suggestion(values):
+    """Suggested labels 1..4 as unreviewed states, 0 stays unlabelled."""
+    values = np.asarray(values).astype(np.uint8)
+    return np.where(values > 0, values + SUGGESTED, 0).astype(np.uint8)
+
+
+def reviewed(states):
+    """The states suggestions stand for, other states unchanged."""
+    states = np.asarray(states)
+    return np.where(states > SUGGESTED, states - SUGGESTED, states).astype(np.uint8)
+
+
+def ranges_from_indices(idx):
+    """Collapse time-step indices into sorted, disjoint [start, stop) intervals."""
+    idx = np.unique(np.asarray(idx, dtype=np.intp))
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1)
+    starts = idx[np.r_[0, breaks + 1]]
+    stops = idx[np.r_[breaks, len(idx) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+class AnnotationRuns:
+    """
+    HMM state labels stored as run-length segments.
+
+    Segment k covers [starts[k], starts[k+1]) (the last one ends at `length`)
+    with state states[k]; neighbouring segments always have different states.
+    A dense uint8 view is built on demand and cached until the next edit.
+    """
+
+    def __init__(self, starts, states, length):
+        self.length = int(length)
+        self._starts = np.asarray(starts, dtype=np.int64)
+        self._states = np.asarray(states, dtype=np.uint8)
+        self._dense = None
+
+    @classmethod
+    def zeros(cls, length):
+        return cls([0] if length else [], [0] if length else [], length)
+
+    @classmethod
+    def from_dense(cls, values):
+        values = np.asarray(values).astype(np.uint8)
+        if len(values) == 0:
+            return cls.zeros(0)
+        starts = np.r_[0, np.flatnonzero(values[1:] != values[:-1]) + 1]
+        return cls(starts, values[starts], len(values))
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def ends(self):
+        return np.r_[self._starts[1:], self.length]
+
+    def segments(self):
+        """(start, end, state) tuples, end exclusive."""
+        return list(zip(self._starts.tolist(), self.ends.tolist(), self._states.tolist()))
+
+    def dense(self):
+        if self._dense is None:
+            self._dense = np.repeat(self._states, np.diff(np.r_[self._starts, self.length]))
+            self._dense.flags.writeable = False
+        return self._dense
+
+    def values_at(self, idx):
+        return self._states[np.searchsorted(self._starts, idx, side="right") - 1]
+
+    def count(self, state):
+        lengths = np.diff(np.r_[self._starts, self.length])
+        return int(lengths[self._states == state].sum())
+
+    def count_suggested(self):
+        lengths = np.diff(np.r_[self._starts, self.length])
+        return int(lengths[self._states > SUGGESTED].sum())
+
+    def runs(self, start, stop):
+        """Segments of [start, stop) as starts relative to `start` and their states."""
+        first = np.searchsorted(self._starts, start, side="right") - 1
+        last = np.searchsorted(self._starts, stop, side="left")
+        starts = self._starts[first:last].copy()
+        starts[0] = start
+        return starts - start, self._states[first:last].copy()
+
+    def set_runs(self, start, stop, starts, states):
+        """Replace [start, stop) with segments at `starts` (relative to `start`, the first 0)."""
+        start, stop = int(start), int(stop)
+        left = self._starts < start
+        right = self._starts > stop
+        new_starts = [self._starts[left], np.asarray(starts, dtype=np.int64) + start]
+        new_states = [self._states[left], np.asarray(states, dtype=np.uint8)]
+        if stop < self.length:
+            # the segment containing `stop` resumes after the new range
+            new_starts += [[stop], self._starts[right]]
+            new_states += [[self.values_at(stop)], self._states[right]]
+
+        starts = np.concatenate(new_starts).astype(np.int64)
+        states = np.concatenate(new_states).astype(np.uint8)
+        keep = np.r_[True, states[1:] != states[:-1]]
+        self._starts, self._states = starts[keep], states[keep]
+        self._dense = None
+
+    def set_range(self, start, stop, state):
+        start, stop = max(0, int(start)), min(self.length, int(stop))
+        if stop <= start:
+            return
+        self.set_runs(start, stop, [0], [state])
+
+    def set_ranges(self, ranges, state):
+        for start, stop in ranges:
+            self.set_range(start, stop, state)
+
+    def accept(self, ranges):
+        """Turn the suggestions in [start, stop) ranges into the states they suggest."""
+        for start, stop in ranges:
+            start, stop = max(0, int(start)), min(self.length, int(stop))
+            if stop > start:
+                starts, states = self.runs(start, stop)
+                self.set_runs(start, stop, starts, reviewed(states))
+
+
+class EditHistory:
+    """
+    Undo/redo stacks of annotation edits.
+
+    A step is a list of [start, stop, starts, states]: the run-length segments
+    an edited range held before (or, on the redo stack, after) the edit, so a
+    step costs the number of segments it touched, not the night length.
+    The oldest steps are dropped beyond `max_steps` steps or `max_segments`
+    stored segments. Steps are plain lists so they fit in a session store.
+    """
+
+    def __init__(self, undo=None, redo=None, max_steps=100, max_segments=20000):
+        self.undo_steps = list(undo or [])
+        self.redo_steps = list(redo or [])
+        self.max_steps = max_steps
+        self.max_segments = max_segments
+
+    def state(self):
+        return {"undo": self.undo_steps, "redo": self.redo_steps}
+
+    @staticmethod
+    def _capture(annotations, ranges):
+        step = []
+        for start, stop in ranges:
+            starts, states = annotations.runs(start, stop)
+            step.append([int(start), int(stop), starts.tolist(), states.tolist()])
+        return step
+
+    @staticmethod
+    def _size(step):
+        return sum(len(r[3]) for r in step)
+
+    def _trim(self):
+        del self.undo_steps[:max(len(self.undo_steps) - self.max_steps, 0)]
+        total = sum(map(self._size, self.undo_steps)) + sum(map(self._size, self.redo_steps))
+        while self.undo_steps and total > self.max_segments:
+            total -= self._size(self.undo_steps.pop(0))
+
+    def _edit(self, annotations, ranges, apply):
+        ranges = [(max(0, int(a)), min(len(annotations), int(b))) for a, b in ranges]
+        ranges = [(a, b) for a, b in ranges if b > a]
+        if not ranges:
+            return
+        self.undo_steps.append(self._capture(annotations, ranges))
+        self.redo_steps = []
+        apply(ranges)
+        self._trim()
+
+    def set_ranges(self, annotations, ranges, state):
+        """Apply an edit of disjoint ranges, recording how to undo it."""
+        self._edit(annotations, ranges, lambda r: annotations.set_ranges(r, state))
+
+    def accept(self, annotations, ranges):
+        """Accept the suggestions in disjoint ranges, recording how to undo it."""
+        self._edit(annotations, ranges, annotations.accept)
+
+    def _swap(self, annotations, source, target):
+        if not source:
+            return None
+        step = source.pop()
+        ranges = [(start, stop) for start, stop, _, _ in step]
+        target.append(self._capture(annotations, ranges))
+        for start, stop, starts, states in step:
+            annotations.set_runs(start, stop, starts, states)
+        self._trim()
+        return ranges
+
+    def undo(self, annotations):
+        """Revert the last edit, returning the ranges it changed or None if there is nothing to undo."""
+        return self._swap(annotations, self.undo_steps, self.redo_steps)
+
+    def redo(self, annotations):
+        return self._swap(annotations, self.redo_steps, self.undo_steps)
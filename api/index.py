@@ -1 +1,6 @@
-from app import server as app
\ No newline at end of file
+import config
+
+# every request may hit a cold instance, only open data once a page is requested
+config.LAZY_STARTUP = True
+
+from app import server as app
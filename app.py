@@ -9,30 +9,217 @@ from dash import (
     no_update,
     ctx,
     ALL,
+    Patch,
+    ClientsideFunction,
+    set_props,
 )
+from dash.exceptions import MissingCallbackContextException
+import contextlib
+import flask
+import functools
+import logging
+import threading
+import uuid
 import numpy as np
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import dash_bootstrap_components as dbc
 import config
+import metrics
 
 from data import Dataset
+from hmm import HMMSuggester
+from ranking import UncertaintyQueue
+from summary import SummaryIndex
+from similarity import SimilarityIndex
+from watcher import Watcher
+from overview import render, to_png_uri, STATE_COLORS
+from sessions import make_session_store
+from storage import open_storage, _canonical, _parse_name
+from decimate import minmax_indices, box_indices, lasso_indices
+from annotations import ranges_from_indices, reviewed, SUGGESTED
+
+logger = logging.getLogger(__name__)
 
 app = Dash(__name__, 
            external_stylesheets=[dbc.themes.MINTY],
            )
-data = Dataset('assets')
+
+
+# ==================================== Sessions =====================================
+
+
+# Opened once per worker and shared by every session, see start_services
+storage = suggester = ranking = summary = similar = watcher = sessions = None
+_services_lock = threading.Lock()
+
+
+def start_services():
+    """
+    Open the storage and session store and start the background model fit,
+    summary index and watcher for new nights. Runs at import, or with LAZY_STARTUP on first use so
+    a cold start only pays for the imports.
+    """
+    global storage, suggester, ranking, summary, similar, watcher, sessions
+    with _services_lock:
+        if sessions is not None:
+            return
+        _storage = open_storage(config.DATA_PATH, cache_size=config.CACHE_SIZE,
+                                prefetch_workers=config.PREFETCH_WORKERS, mmap_mode=config.MMAP_MODE,
+                                journal=config.JOURNAL, log=config.ANNOTATION_LOG)
+        _suggester = HMMSuggester(_storage) if config.AUTO_SUGGEST else None
+        _ranking = UncertaintyQueue(_storage, _suggester, refit_every=config.RANK_REFIT_EVERY) \
+            if _suggester is not None else None
+        if _suggester is not None:
+            _suggester.start()
+            _ranking.start()
+        _summary = SummaryIndex(_storage, nsigma=config.SUMMARY_NSIGMA, width=config.OVERVIEW_WIDTH)
+        _summary.start()
+        _similar = SimilarityIndex(_storage, nsigma=config.SUMMARY_NSIGMA, limit=config.SIMILAR_WINDOWS)
+        _similar.start()
+        _watcher = None
+        if config.WATCH_INTERVAL_S:
+            _watcher = Watcher(_storage, config.WATCH_INTERVAL_S, summary=_summary, similar=_similar,
+                               ranking=_ranking)
+            _watcher.start()
+        storage, suggester, ranking, summary, similar, watcher = \
+            _storage, _suggester, _ranking, _summary, _similar, _watcher
+        # set last, it marks the services as ready
+        sessions = make_session_store(config.SESSION_STORE, config.SESSION_TTL_S)
+
+# sid -> [lock, callbacks holding or waiting for it], dropped when the last one leaves
+_session_locks = {}
+_session_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def _session_lock(sid):
+    start_services()
+    with _session_locks_guard:
+        entry = _session_locks.setdefault(sid, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        # the store's lock holds the session against the other workers
+        with entry[0], (sessions.lock(sid) if sid else contextlib.nullcontext()):
+            yield
+    finally:
+        with _session_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _session_locks[sid]
+
+def _remote_user():
+    # set by an authenticating proxy or server
+    return flask.request.remote_user if flask.has_request_context() else None
+
+def _user(sid):
+    # otherwise the session stands in for the user
+    return _remote_user() or sid
+
+def _load_session(sid, user=None):
+    start_services()
+    state = sessions.get(sid) if sid else None
+    if sid and state is None:
+        # evicted from the store (or the server restarted), the page starts over at the first night
+        logger.warning("Session %s expired, starting it over", sid)
+        try:
+            set_props("session-expired", {"is_open": True})
+        except MissingCallbackContextException:
+            pass
+    return Dataset(config.DATA_PATH, storage=storage, suggester=suggester, summary=summary, state=state,
+                   user=user or _user(sid))
+
+def new_session():
+    sid = uuid.uuid4().hex
+    data = _load_session(None, _user(sid))
+    sessions.set(sid, data.snapshot())
+    data.prefetch(config.PREFETCH_DEPTH)
+    return sid, data
+
+def session_callback(write=True):
+    """
+    Run a callback against the caller's Dataset. The session id is passed as
+    the last State, and the Dataset replaces it as the first argument.
+    Read-only callbacks skip the write back so they cannot clobber an edit.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            *args, sid = args
+            with metrics.callback(func.__name__), _session_lock(sid):
+                with metrics.phase("session"):
+                    data = _load_session(sid)
+                result = func(data, *args)
+                if write and sid:
+                    with metrics.phase("session"):
+                        sessions.set(sid, data.snapshot())
+            return result
+        return wrapper
+    return decorator
 
 
 # ==================================== Helper functions =====================================
 
 
-def _make_ssins_layout():
+# A per-index patch costs roughly this many bytes more than one point of a full y array
+PATCH_OP_COST = 40
+
+
+def _ssins_title(data):
+    return f"SSINS Background-Subtracted Time-Series Avg. Across DTV7 (Night of {data.night}, pointing {data.pointing})"
+
+def _x_range(data):
+    return [-5, len(data.ssins)+5]
+
+def _annotation_values(data, values=None):
+    """
+    y of the label trace and of the suggestion trace, which only has the
+    points still holding an unreviewed suggestion (None elsewhere).
+    """
+    # states are small integers, plain lists keep per-index patches possible on the client
+    values = data.annotations.dense() if values is None else values
+    labels = reviewed(values)
+    return labels.tolist(), np.where(values > SUGGESTED, labels.astype(object), None).tolist()
+
+@metrics.timed("build")
+def _ssins_points(data, x_range=None):
+    # min-max decimation of the visible window, full resolution once it fits
+    start, stop = (0, None) if x_range is None else (np.floor(x_range[0]), np.ceil(x_range[1]) + 1)
+    idx = minmax_indices(data.ssins, start, stop, config.MAX_PLOT_POINTS)
+    return idx, data.ssins[idx]
+
+def _trace_type(n):
+    # SVG rendering and selection stall the browser on large traces, WebGL does not
+    return "scattergl" if n > config.WEBGL_THRESHOLD else "scatter"
+
+def _trace_class(n):
+    return go.Scattergl if _trace_type(n) == "scattergl" else go.Scatter
+
+def _selected_ranges(data, selectedData):
+    """
+    Map a selection on the (possibly decimated) SSINS trace to [start, stop)
+    time-step intervals. Box and lasso selections are resolved against the
+    full series so points hidden by the decimation are included.
+    """
+    if not selectedData:
+        return None
+    if "range" in selectedData and "x" in selectedData["range"]:
+        r = selectedData["range"]
+        idx = box_indices(data.ssins, r["x"], r["y"])
+    elif "lassoPoints" in selectedData and "x" in selectedData["lassoPoints"]:
+        lasso = selectedData["lassoPoints"]
+        idx = lasso_indices(data.ssins, lasso["x"], lasso["y"])
+    else:
+        idx = [p["x"] for p in selectedData.get("points", [])]
+    return ranges_from_indices(idx)
+
+def _make_ssins_layout(data):
     return go.Layout(
         title=dict(
-            text=f"SSINS Background-Subtracted Time-Series Avg. Across DTV7 (Night of {data.night}, pointing {data.pointing})",
+            text=_ssins_title(data),
             x=0.5, xanchor="center", font=dict(size=18)
         ),
-        xaxis=dict(title="Time Step", type="linear", range=[-5, len(data.ssins)+5]),
+        xaxis=dict(title="Time Step", type="linear", range=_x_range(data)),
         yaxis=dict(title="Amplitude Across DTV-7", type="linear"),
         font=dict(size=14),
         autosize=True,
@@ -40,34 +227,180 @@ def _make_ssins_layout():
         clickmode="event+select",
     )
 
-def _make_annotations_layout():
+def _annotations_meta(data):
+    # read by the client-side labelling in assets/annotator.js
+    return {"file": _canonical(data.filename), "decimated": len(data.ssins) > config.MAX_PLOT_POINTS}
+
+def _make_annotations_layout(data):
     return go.Layout(
+        meta=_annotations_meta(data),
         title=dict(text="Annotations", x=0.5, xanchor="center", font=dict(size=18)),
-        xaxis=dict(title="Time Step", type="linear", range=[-5, len(data.ssins)+5]),
+        xaxis=dict(title="Time Step", type="linear", range=_x_range(data)),
         yaxis=dict(title="HMM State", type="linear", range=[0.5, 4.5], tickmode="array", tickvals=[1,2,3,4]),
         font=dict(size=14),
         autosize=True,
         margin=dict(l=10, r=10, t=30, b=10),
     )
 
-def _build_ssins_figure():
-    fig = go.Figure(layout=_make_ssins_layout())
-    fig.add_trace(go.Scatter(
-        x=np.arange(len(data.ssins)),
-        y=data.ssins,
+@metrics.timed("build")
+def _build_ssins_figure(data):
+    fig = go.Figure(layout=_make_ssins_layout(data))
+    x, y = _ssins_points(data)
+    # chosen by night length, so zooming never swaps the renderer
+    fig.add_trace(_trace_class(len(data.ssins))(
+        x=x,
+        y=y,
         mode="markers",
         marker=dict(size=6, color="blue"),
     ))
     return fig
 
-def _build_annotations_figure():
-    fig = go.Figure(layout=_make_annotations_layout())
-    fig.add_trace(go.Scatter(
-        x=np.arange(len(data.annotations)),
-        y=data.annotations,
+@metrics.timed("build")
+def _build_annotations_figure(data):
+    fig = go.Figure(layout=_make_annotations_layout(data))
+    # x is left implicit, plotly numbers the points 0..n-1
+    fig.add_trace(_trace_class(len(data.annotations))(
         mode="lines",
         line=dict(color="red", width=4),
+        name="Annotations",
+    ))
+    # drawn over the labels until they are labelled or accepted
+    fig.add_trace(_trace_class(len(data.annotations))(
+        mode="lines",
+        line=dict(color="lightgray", width=4),
+        name="Suggested",
     ))
+    # plotly deep-copies lists item by item, so the long y lists go straight into the dict
+    figure = fig.to_dict()
+    figure["data"][0]["y"], figure["data"][1]["y"] = _annotation_values(data)
+    return figure
+
+@metrics.timed("build")
+def _ssins_patch(data, x_range=None):
+    # the layout stays on the client, only the night-dependent parts are sent
+    patched = Patch()
+    patched["layout"]["title"]["text"] = _ssins_title(data)
+    patched["layout"]["xaxis"]["range"] = x_range or _x_range(data)
+    del patched["layout"]["selections"]
+    del patched["data"][0]["selectedpoints"]
+    patched["data"][0]["type"] = _trace_type(len(data.ssins))
+    patched["data"][0]["x"], patched["data"][0]["y"] = _ssins_points(data, x_range)
+    return patched
+
+@metrics.timed("build")
+def _annotations_patch(data, ranges=None, x_range=None):
+    """
+    Patch the annotation trace. With `ranges` (intervals just edited) only the
+    points in them are sent, unless a full y array would be smaller.
+    """
+    patched = Patch()
+    if ranges is None:
+        patched["layout"]["xaxis"]["range"] = x_range or _x_range(data)
+        patched["layout"]["meta"] = _annotations_meta(data)
+        patched["data"][0]["type"] = patched["data"][1]["type"] = _trace_type(len(data.annotations))
+        patched["data"][0]["y"], patched["data"][1]["y"] = _annotation_values(data)
+    elif 2 * sum(stop - start for start, stop in ranges) * PATCH_OP_COST > len(data.annotations):
+        patched["data"][0]["y"], patched["data"][1]["y"] = _annotation_values(data)
+    else:
+        for start, stop in ranges:
+            labels, suggested = _annotation_values(data, data.annotations.values_at(np.arange(start, stop)))
+            for i, (v, u) in enumerate(zip(labels, suggested), start):
+                patched["data"][0]["y"][i] = v
+                patched["data"][1]["y"][i] = u
+    return patched
+
+# one flat colour per state, for marker colours given as state numbers 0..4
+_STATE_SCALE = [[(s + edge) / len(STATE_COLORS), f"rgb{tuple(c.tolist())}"]
+                for s, c in enumerate(STATE_COLORS) for edge in (0, 1)]
+
+@metrics.timed("build")
+def _build_night_figure(data):
+    """Every pointing of the current night, a row each on one time axis, points coloured by state."""
+    files, ssins, annotations = data.load_night()
+    if not files:
+        return {}
+    fig = make_subplots(
+        rows=len(files), cols=1, shared_xaxes=True, vertical_spacing=0.03,
+        subplot_titles=[f"Pointing {_parse_name(f)[1]}" + (" (bad)" if f.startswith("bad_") else "") for f in files],
+    )
+    for row, (x, runs) in enumerate(zip(ssins, annotations), start=1):
+        idx = minmax_indices(x, 0, None, config.MAX_PLOT_POINTS)
+        fig.add_trace(_trace_class(len(x))(
+            x=idx,
+            y=x[idx],
+            mode="markers",
+            marker=dict(size=4, color=reviewed(runs.values_at(idx)), cmin=0, cmax=len(STATE_COLORS) - 1,
+                        colorscale=_STATE_SCALE),
+            showlegend=False,
+        ), row=row, col=1)
+    fig.update_layout(
+        height=60 + 150 * len(files),
+        margin=dict(l=10, r=10, t=30, b=10),
+        font=dict(size=12),
+    )
+    fig.update_xaxes(title="Time Step", row=len(files), col=1)
+    return fig
+
+def _apply_edits(data, batch):
+    """
+    Apply, in order, the label edits queued by the browser (assets/annotator.js)
+    that this session has not applied yet. Returns the ranges where the labels
+    differ from what the browser drew, to be sent back.
+    """
+    fixes, applied = [], False
+    for op in (batch or {}).get("ops", []):
+        if op["seq"] <= data.edit_seq:
+            continue
+        data.edit_seq = op["seq"]
+        if op["file"] != _canonical(data.filename):
+            logger.warning("Dropped a label edit for %s, the session has moved to %s", op["file"], data.filename)
+            continue
+
+        n = len(data.annotations)
+        ranges = [(max(int(a), 0), min(int(b), n)) for a, b in op["ranges"]]
+        ranges = [(a, b) for a, b in ranges if a < b]
+        if op.get("selection"):
+            resolved = _selected_ranges(data, op["selection"]) or []
+            if resolved != ranges:
+                fixes += ranges + resolved
+            ranges = resolved
+        if ranges and op.get("accept"):
+            data.accept_suggestions(ranges)
+            applied = True
+        elif ranges and op.get("propagate"):
+            data.propagate(ranges, int(op["state"]))
+            applied = True
+        elif ranges:
+            data.set_ranges(ranges, int(op["state"]))
+            applied = True
+
+    if applied:
+        data.autosave()
+    return fixes
+
+@metrics.timed("build")
+def _build_overview_figure(data, mode="amplitude"):
+    """One image row per night of the current file list, from the summary thumbnails."""
+    if not data.filenames:
+        fig = go.Figure()
+        fig.update_layout(
+            xaxis=dict(visible=False), yaxis=dict(visible=False),
+            annotations=[dict(text="No night matches the filter", showarrow=False)],
+        )
+        return fig
+    values, states = summary.thumbnails(data.filenames)
+    n = max(len(data.filenames), 1)
+    fig = go.Figure(go.Image(
+        source=to_png_uri(render(values, states, mode)),
+        # stretch the bins so the image keeps a landscape aspect whatever the number of nights
+        dx=1.5 * n / config.OVERVIEW_WIDTH,
+        hovertemplate="row %{y}<extra></extra>",
+    ))
+    fig.update_layout(
+        margin=dict(l=10, r=10, t=10, b=10),
+        xaxis=dict(visible=False),
+        yaxis=dict(title="night (click to open)", showticklabels=False),
+    )
     return fig
 
 def get_good(d):
@@ -80,312 +413,577 @@ def get_good(d):
 # ==================================== App Layout =====================================
 
 
-app.layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                html.H1(
-                    "HMM Annotator",
-                    className="text-center mt-2",
-                ),
-            ],
-            className="mt-0",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    html.H6(
-                        f"Data source: {data._path}"
+_SUMMARY_OPTIONS = [
+    {"label": "Peaks > %g sigma" % config.SUMMARY_NSIGMA, "value": "peaks"},
+    {"label": "RMS", "value": "rms"},
+    {"label": "Maximum", "value": "max"},
+    {"label": "Minimum", "value": "min"},
+    {"label": "Median", "value": "median"},
+    {"label": "Length", "value": "length"},
+    {"label": "Unlabelled fraction", "value": "frac_0"},
+    {"label": "Clean fraction", "value": "frac_1"},
+    {"label": "RFI-Rising fraction", "value": "frac_2"},
+    {"label": "RFI-Decaying fraction", "value": "frac_3"},
+    {"label": "Blip fraction", "value": "frac_4"},
+]
+
+def serve_layout():
+    sid, data = new_session()
+    return _page(sid, data)
+
+def _page(sid, data):
+    """The page of one session; with data=None an empty skeleton, used to validate callbacks."""
+    good = get_good(data) if data is not None else ("", "secondary")
+    return dbc.Container(
+        [
+            dcc.Store(id="session-id", data=sid),
+            dcc.Store(id="edit-batch"),
+            dcc.Store(id="edit-ack"),
+            dcc.Store(id="edit-debounce", data=config.EDIT_DEBOUNCE_MS),
+            # file index version the counts below were computed at
+            dcc.Store(id="index-version"),
+            dbc.Alert(
+                "This page's session expired on the server and started over at the first night. "
+                "Saved and journalled labels are kept, reload the page to continue.",
+                id="session-expired",
+                color="warning",
+                is_open=False,
+                dismissable=True,
+                className="mt-2",
+            ),
+            dcc.Interval(id="index-poll", interval=1000 * (config.WATCH_INTERVAL_S or 1),
+                         disabled=not config.WATCH_INTERVAL_S),
+            dbc.Row(
+                [
+                    html.H1(
+                        "HMM Annotator",
+                        className="text-center mt-2",
                     ),
-                    width="auto"
-                ),
-                dbc.Col(
-                    html.H6(
-                        f"Total number of files: {data.get_n()}",
-                        id="h6-n-files",
+                ],
+                className="mt-0",
+                justify="center",
+                align="center",
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        html.H6(
+                            f"Data source: {data._path if data is not None else ''}"
+                        ),
+                        width="auto"
                     ),
-                    width="auto"
-                ),
-                dbc.Col(
-                    html.H6(
-                        f"Number of annotated files: {data.count_annotations()}",
-                        id="h6-count-annotations",
+                    dbc.Col(
+                        html.H6(
+                            f"Total number of files: {data.get_n() if data is not None else ''}",
+                            id="h6-n-files",
+                        ),
+                        width="auto"
                     ),
-                    width="auto"
-                ),
-                dbc.Col(
-                    html.H6(
-                        f"Number of bad files: {data.count_bad()}",
-                        id="h6-count-bad",
+                    dbc.Col(
+                        html.H6(
+                            f"Number of annotated files: {data.count_annotations() if data is not None else ''}",
+                            id="h6-count-annotations",
+                        ),
+                        width="auto"
                     ),
-                    width="auto"
-                )
-            ],
-            className="mt-0",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
+                    dbc.Col(
+                        html.H6(
+                            f"Number of bad files: {data.count_bad() if data is not None else ''}",
+                            id="h6-count-bad",
+                        ),
+                        width="auto"
+                    )
+                ],
+                className="mt-0",
+                justify="center",
+                align="center",
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.ButtonGroup(
+                                [
+                                    dbc.Button(
+                                        "Set State 1 (Clean)",
+                                        id="button-set-1",
+                                        outline=False,
+                                        color="primary",
+                                        className="me-1",
+                                    ),
+                                    dbc.Button(
+                                        "Set State 2 (RFI-Rising)",
+                                        id="button-set-2",
+                                        outline=False,
+                                        color="primary",
+                                        className="me-1",
+                                    ),
+                                    dbc.Button(
+                                        "Set State 3 (RFI-Decaying)",
+                                        id="button-set-3",
+                                        outline=False,
+                                        color="primary",
+                                        className="me-1",
+                                    ),
+                                    dbc.Button(
+                                        "Set State 4 (Blip)",
+                                        id="button-set-4",
+                                        outline=False,
+                                        color="primary",
+                                        className="me-1",
+                                    ),
+                                ],
+                            ),
+                            dbc.Button(
+                                "Set All Clean",
+                                id="button-set-all-clean",
+                                outline=False,
+                                color="primary",
+                                className="me-1",
+                            ),
+                            dbc.Button(
+                                "Accept Suggestions",
+                                id="button-accept",
+                                outline=True,
+                                color="primary",
+                                className="me-1",
+                            ),
+                            dbc.ButtonGroup(
+                                [
+                                    dbc.Button("Undo", id="button-undo", color="secondary", className="me-1"),
+                                    dbc.Button("Redo", id="button-redo", color="secondary"),
+                                ],
+                                className="ms-2",
+                            ),
+                        ],
+                        width="auto",
+                        className="mb-2",
+                    ),
+                ],
+                className="mt-2 mb-2",
+                justify="center",
+                align="center",
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Button(
+                            "< Previous Night",
+                            id="button-prev",
+                            color="secondary"
+                            ),
+                        width=4,
+                        className="text-start"
+                    ),
+                    dbc.Col(
+                        [
+                        dbc.Button(
+                            "Export Annotations",
+                            id="button-export",
+                            color="primary",
+                            style={"marginRight": "5px"}
+                            ),
+                        dbc.Button(
+                            good[0],
+                            id="button-bad",
+                            color=good[1],
+                            style={"marginLeft": "5px"}
+                            ),
+                        dbc.Switch(
+                            id="switch-uncertain",
+                            label="Most uncertain first",
+                            value=False,
+                            disabled=ranking is None,
+                            className="d-inline-block ms-3 mb-0",
+                            ),
+                        dbc.Switch(
+                            id="switch-night",
+                            label="All pointings",
+                            value=False,
+                            className="d-inline-block ms-3 mb-0",
+                            ),
+                        dbc.Switch(
+                            id="switch-propagate",
+                            label="Label all pointings",
+                            value=False,
+                            # edits of the other pointings are kept in the journal
+                            disabled=storage is None or storage.journal is None,
+                            className="d-inline-block ms-3 mb-0",
+                            ),
+                        ],
+                        width=4,
+                        className="text-center"
+                    ),
+                    dbc.Col(
+                        dbc.Button(
+                            "Next Night >",
+                            id="button-next",
+                            color="secondary"
+                            ),
+                        width=4,
+                        className="text-end"
+                    )
+                ],
+                className="mb-4",
+                justify="center",
+                align="center",
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.Graph(
+                            id="ssins-graph",
+                            figure=_build_ssins_figure(data) if data is not None else {},
+                            style={"display": "inline-block", "height": "35vh", "width":"100%"},
+                        ),
+                        width=12,
+                        className="mb-0 mt-o",
+                    ),
+                ],
+                className="mt-0",
+                justify="center",
+                align="center",
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.Graph(
+                            id="annotation-graph",
+                            figure=_build_annotations_figure(data) if data is not None else {},
+                            style={"display": "inline-block", "height": "35vh", "width": "100%"},
+                        ),
+                        width=12,
+                        className="mb-0 mt-o",
+                    ),
+                ],
+                className="mt-0",
+                justify="center",
+                align="center",
+            ),
+            dcc.Store(id="night-file"),
+            dbc.Collapse(
+                dcc.Graph(id="night-graph", figure={}),
+                id="night-collapse",
+                is_open=False,
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
                         dbc.ButtonGroup(
                             [
                                 dbc.Button(
-                                    "Set State 1 (Clean)",
-                                    id="button-set-1",
+                                    "All pointings",
+                                    id="button-p-all",
                                     outline=False,
                                     color="primary",
                                     className="me-1",
+                                    active=True,
                                 ),
                                 dbc.Button(
-                                    "Set State 2 (RFI-Rising)",
-                                    id="button-set-2",
+                                    "Pointing 0",
+                                    id="button-p-0",
                                     outline=False,
                                     color="primary",
                                     className="me-1",
+                                    active=False,
                                 ),
                                 dbc.Button(
-                                    "Set State 3 (RFI-Decaying)",
-                                    id="button-set-3",
+                                    "Pointing 1",
+                                    id="button-p-1",
                                     outline=False,
                                     color="primary",
                                     className="me-1",
+                                    active=False,
                                 ),
                                 dbc.Button(
-                                    "Set State 4 (Blip)",
-                                    id="button-set-4",
+                                    "Pointing 2",
+                                    id="button-p-2",
                                     outline=False,
                                     color="primary",
                                     className="me-1",
+                                    active=False,
+                                ),
+                                dbc.Button(
+                                    "Pointing 3",
+                                    id="button-p-3",
+                                    outline=False,
+                                    color="primary",
+                                    className="me-1",
+                                    active=False,
+                                ),
+                                dbc.Button(
+                                    "Pointing 4",
+                                    id="button-p-4",
+                                    outline=False,
+                                    color="primary",
+                                    className="me-1",
+                                    active=False,
                                 ),
                             ],
                         ),
+                        width="auto",
+                    ),
+                    dbc.Col(
                         dbc.Button(
-                            "Set All Clean",
-                            id="button-set-all-clean",
-                            outline=False,
-                            color="primary",
-                            className="me-1",
-                        ),
-                    ],
-                    width="auto",
-                    className="mb-2",
-                ),
-            ],
-            className="mt-2 mb-2",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.Button(
-                        "< Previous Night",
-                        id="button-prev",
-                        color="secondary"
-                        ),
-                    width=4,
-                    className="text-start"
-                ),
-                dbc.Col(
-                    [
-                    dbc.Button(
-                        "Export Annotations",
-                        id="button-export",
-                        color="primary",
-                        style={"marginRight": "5px"}
-                        ),
-                    dbc.Button(
-                        get_good(data)[0],
-                        id="button-bad",
-                        color=get_good(data)[1],
-                        style={"marginLeft": "5px"}
+                            "Overview",
+                            id="button-overview",
+                            color="secondary",
                         ),
-                    ],
-                    width=4,
-                    className="text-center"
-                ),
-                dbc.Col(
-                    dbc.Button(
-                        "Next Night >",
-                        id="button-next",
-                        color="secondary"
-                        ),
-                    width=4,
-                    className="text-end"
-                )
-            ],
-            className="mb-4",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    dcc.Graph(
-                        id="ssins-graph",
-                        figure=_build_ssins_figure(),
-                        style={"display": "inline-block", "height": "35vh", "width":"100%"},
+                        width="auto",
                     ),
-                    width=12,
-                    className="mb-0 mt-o",
-                ),
-            ],
-            className="mt-0",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    dcc.Graph(
-                        id="annotation-graph",
-                        figure=_build_annotations_figure(),
-                        style={"display": "inline-block", "height": "35vh", "width": "100%"},
+                    dbc.Col(
+                        dbc.Button(
+                            "Find similar",
+                            id="button-similar",
+                            color="secondary",
+                        ),
+                        width="auto",
                     ),
-                    width=12,
-                    className="mb-0 mt-o",
-                ),
-            ],
-            className="mt-0",
-            justify="center",
-            align="center",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.ButtonGroup(
+                ],
+                className="mt-0",
+                justify="center",
+                align="center",
+            ),
+            dbc.Modal(
+                [
+                    dbc.ModalHeader(dbc.ModalTitle("Overview")),
+                    dbc.ModalBody(
                         [
-                            dbc.Button(
-                                "All pointings",
-                                id="button-p-all",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=True,
-                            ),
-                            dbc.Button(
-                                "Pointing 0",
-                                id="button-p-0",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=False,
-                            ),
-                            dbc.Button(
-                                "Pointing 1",
-                                id="button-p-1",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=False,
-                            ),
-                            dbc.Button(
-                                "Pointing 2",
-                                id="button-p-2",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=False,
-                            ),
-                            dbc.Button(
-                                "Pointing 3",
-                                id="button-p-3",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=False,
-                            ),
-                            dbc.Button(
-                                "Pointing 4",
-                                id="button-p-4",
-                                outline=False,
-                                color="primary",
-                                className="me-1",
-                                active=False,
+                            dbc.RadioItems(
+                                id="overview-mode",
+                                options=[
+                                    {"label": "Amplitude", "value": "amplitude"},
+                                    {"label": "Annotation states", "value": "states"},
+                                    {"label": "Both", "value": "both"},
+                                ],
+                                value="amplitude",
+                                inline=True,
                             ),
-                        ],
+                            dcc.Graph(id="overview-graph", style={"height": "75vh"}),
+                            dcc.Store(id="overview-files"),
+                        ]
                     ),
-                    width="auto",
-                )
-            ],
-            className="mt-0",
-            justify="center",
-            align="center",
-        ),
-        dbc.Toast(
-            children="Flags successfully saved!",
-            id="save-toast",
-            header="Notification",
-            icon="success",
-            duration=4000,
-            is_open=False,
-            dismissable=True,
-            style={"position": "fixed", "top": 10, "right": 10, "width": 350},
-        ),
-    ]
-)
+                ],
+                id="overview-modal",
+                size="xl",
+                is_open=False,
+            ),
+            dbc.Modal(
+                [
+                    dbc.ModalHeader(dbc.ModalTitle("Similar events")),
+                    dbc.ModalBody(
+                        [
+                            html.Div(id="similar-list"),
+                            dcc.Store(id="similar-matches"),
+                        ]
+                    ),
+                ],
+                id="similar-modal",
+                size="lg",
+                is_open=False,
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.InputGroup(
+                            [
+                                dbc.InputGroupText("Sort by"),
+                                dbc.Select(
+                                    id="select-sort",
+                                    options=[{"label": "Filename", "value": ""}] + _SUMMARY_OPTIONS,
+                                    value="",
+                                ),
+                                dbc.InputGroupText(
+                                    dbc.Checkbox(id="check-descending", label="descending", value=False),
+                                ),
+                            ],
+                            size="sm",
+                        ),
+                        width="auto",
+                    ),
+                    dbc.Col(
+                        dbc.InputGroup(
+                            [
+                                dbc.InputGroupText("Only files with"),
+                                dbc.Select(
+                                    id="select-filter",
+                                    options=[{"label": "(no filter)", "value": ""}] + _SUMMARY_OPTIONS,
+                                    value="",
+                                ),
+                                dbc.Input(id="input-filter-min", type="number", placeholder="min", debounce=True),
+                                dbc.Input(id="input-filter-max", type="number", placeholder="max", debounce=True),
+                            ],
+                            size="sm",
+                        ),
+                        width="auto",
+                    ),
+                ],
+                className="mt-2",
+                justify="center",
+                align="center",
+            ),
+            dbc.Toast(
+                children="Flags successfully saved!",
+                id="save-toast",
+                header="Notification",
+                icon="success",
+                duration=4000,
+                is_open=False,
+                dismissable=True,
+                style={"position": "fixed", "top": 10, "right": 10, "width": 350},
+            ),
+        ]
+    )
+
+
+# a skeleton to check callbacks against, otherwise Dash builds a whole session at import
+app.validation_layout = _page(None, None)
+app.layout = serve_layout
 
 
 # ======================================= Server Setup =================================
 
 server = app.server
 
+
+def _collect(registry):
+    if sessions is None:
+        return
+    cache = storage.cache_stats()
+    if cache:
+        registry.set("annotator_cache_hits_total", cache["hits"])
+        registry.set("annotator_cache_misses_total", cache["misses"])
+        registry.set("annotator_cache_entries", cache["size"])
+    writes = storage.writer.stats()
+    registry.set("annotator_writes_queued", writes["queued"])
+    for result in ("written", "merged", "failed"):
+        registry.set("annotator_writes_total", writes[result], result=result)
+
+
+metrics.registry.describe("annotator_cache_hits_total", "counter", "Raw and annotation loads served from the file cache.")
+metrics.registry.describe("annotator_cache_misses_total", "counter", "Raw and annotation loads read from disk.")
+metrics.registry.describe("annotator_cache_entries", "gauge", "Arrays held in the file cache.")
+metrics.registry.describe("annotator_writes_queued", "gauge", "Annotation writes waiting in the write-behind queue.")
+metrics.registry.describe("annotator_writes_total", "counter", "Write-behind writes by result.")
+metrics.registry.add_collector(_collect)
+metrics.init_app(server, slow_ms=config.SLOW_CALLBACK_MS)
+
+if not config.LAZY_STARTUP:
+    start_services()
+
 # ======================================= Callback functions ===========================
 
 
-@app.callback(
+# labelling runs in the browser, see assets/annotator.js
+app.clientside_callback(
+    ClientsideFunction(namespace="annotator", function_name="label"),
     Output("annotation-graph", "figure", allow_duplicate=True),
     Input("button-set-1", "n_clicks"),
     Input("button-set-2", "n_clicks"),
     Input("button-set-3", "n_clicks"),
     Input("button-set-4", "n_clicks"),
     Input("button-set-all-clean", "n_clicks"),
+    Input("button-accept", "n_clicks"),
     State("ssins-graph", "selectedData"),
+    State("annotation-graph", "figure"),
+    State("switch-propagate", "value"),
+    State("edit-debounce", "data"),
     prevent_initial_call=True,
 )
-def set_state(b1,b2,b3,b4,ball, selectedData):
 
-    try:
-        points = selectedData["points"]
-        x_selected = [p["x"] for p in points]
-    except TypeError:
-        x_selected = None
 
-    triggered = ctx.triggered_id
-    if triggered == "button-set-1":
-        state_val = 1
-    elif triggered == "button-set-2":
-        state_val = 2
-    elif triggered == "button-set-3":
-        state_val = 3
-    elif triggered == "button-set-4":
-        state_val = 4
-    elif triggered == "button-set-all-clean":
-        state_val = 1
-        x_selected = range(len(data.ssins))
+@app.callback(
+    Output("annotation-graph", "figure", allow_duplicate=True),
+    Output("edit-ack", "data"),
+    Output("night-graph", "figure", allow_duplicate=True),
+    Input("edit-batch", "data"),
+    State("switch-night", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback()
+def apply_edits(data, batch, night=False):
+    fixes = _apply_edits(data, batch)
+    propagated = any(op.get("propagate") for op in (batch or {}).get("ops", []))
+    return _annotations_patch(data, fixes) if fixes else no_update, {"seq": data.edit_seq, "fixed": bool(fixes)}, \
+            _build_night_figure(data) if night and propagated else no_update
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="annotator", function_name="ack"),
+    Output("annotation-graph", "figure", allow_duplicate=True),
+    Input("edit-ack", "data"),
+    State("annotation-graph", "figure"),
+    prevent_initial_call=True,
+)
+
+
+# the file shown, as a store so the night view only follows night changes
+app.clientside_callback(
+    ClientsideFunction(namespace="annotator", function_name="file"),
+    Output("night-file", "data"),
+    Input("annotation-graph", "figure"),
+    State("night-file", "data"),
+)
+
+
+@app.callback(
+    Output("night-graph", "figure"),
+    Output("night-collapse", "is_open"),
+    Input("switch-night", "value"),
+    Input("night-file", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback(write=False)
+def show_night(data, on, filename):
+    if not on:
+        return no_update, False
+    return _build_night_figure(data), True
+
+
+@app.callback(
+    Output("annotation-graph", "figure", allow_duplicate=True),
+    Input("button-undo", "n_clicks"),
+    Input("button-redo", "n_clicks"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback()
+def undo_redo(data, bundo, bredo, batch):
+    # edits still queued come first, undo must see them
+    fixes = _apply_edits(data, batch)
+    changed = data.undo() if ctx.triggered_id == "button-undo" else data.redo()
+    if changed is None:
+        return _annotations_patch(data, fixes) if fixes else no_update
+    data.autosave()
+    return _annotations_patch(data, fixes + list(changed))
+
+
+@app.callback(
+    Output("ssins-graph", "figure", allow_duplicate=True),
+    Input("ssins-graph", "relayoutData"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback(write=False)
+def refine_ssins(data, relayoutData):
+    if not relayoutData or len(data.ssins) <= config.MAX_PLOT_POINTS:
+        return no_update
+
+    if "xaxis.range[0]" in relayoutData:
+        x_range = [relayoutData["xaxis.range[0]"], relayoutData["xaxis.range[1]"]]
+    elif "xaxis.range" in relayoutData:
+        x_range = relayoutData["xaxis.range"]
+    elif relayoutData.get("xaxis.autorange"):
+        x_range = None
     else:
-        state_val = None
-
-    if state_val is not None:
-        data.annotations[x_selected] = state_val
-
-    # Rebuild annotation graph
-    fig = go.Figure(layout=_make_annotations_layout())
-    fig.add_trace(
-        go.Scatter(
-            x=np.arange(len(data.annotations)),
-            y=data.annotations,
-            mode="lines",
-            line=dict(color="red", width=4),
-            name="Annotations",
-        )
-    )
+        return no_update
 
-    return fig
+    patched = Patch()
+    patched["data"][0]["x"], patched["data"][0]["y"] = _ssins_points(data, x_range)
+    return patched
 
 
 @callback(
@@ -397,9 +995,14 @@ def set_state(b1,b2,b3,b4,ball, selectedData):
     Output("button-bad", "color"),
     Input("button-prev", "n_clicks"),
     Input("button-next", "n_clicks"),
+    State("switch-uncertain", "value"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
     prevent_initial_call=False,
 )
-def change_night(prev_clicks, next_clicks):
+@session_callback()
+def change_night(data, prev_clicks, next_clicks, uncertain=False, batch=None):
+    _apply_edits(data, batch)
 
     try:
         cur_idx = data.filenames.index(data.filename)
@@ -407,15 +1010,32 @@ def change_night(prev_clicks, next_clicks):
         cur_idx = 0
     max_idx = len(data.filenames) - 1
 
-    # disabled states for current position
-    prev_disabled = (cur_idx == 0)
-    next_disabled = (cur_idx == max_idx)
+    uncertain = bool(uncertain) and ranking is not None
+    prev_disabled, next_disabled = _nav_disabled(data, uncertain)
 
-    # on first load (no trigger), just set disabled states
+    # on first load (no trigger), or with a filter that matches nothing, just set disabled states
     trigger = ctx.triggered_id
-    if not trigger:
+    if not trigger or not data.filenames:
         return no_update, no_update, prev_disabled, next_disabled, no_update, no_update
 
+    if uncertain:
+        if trigger == "button-prev":
+            moved = data.back()
+        else:
+            new_name = ranking.next(data.pointing_group, exclude=[data.filename, *data.history])
+            if new_name is None and cur_idx < max_idx:
+                # nothing left to rank, carry on in filename order
+                new_name = data.filenames[cur_idx + 1]
+            moved = new_name is not None
+            if moved:
+                data.visit(new_name)
+        if not moved:
+            return no_update, no_update, not data.history, trigger == "button-next", \
+                    get_good(data)[0], get_good(data)[1]
+        data.prefetch(config.PREFETCH_DEPTH)
+        return _ssins_patch(data), _annotations_patch(data), not data.history, False, \
+                get_good(data)[0], get_good(data)[1]
+
     # edge guards: do nothing if already at an endpoint
     if trigger == "button-prev" and cur_idx == 0:
         return no_update, no_update, True, next_disabled, \
@@ -429,14 +1049,15 @@ def change_night(prev_clicks, next_clicks):
     new_name = data.filenames[new_idx]
 
     data.set_filename(new_name)
+    data.prefetch(config.PREFETCH_DEPTH)
 
     # recompute disabled states at new position
     new_prev_disabled = (new_idx == 0)
     new_next_disabled = (new_idx == max_idx)
 
-    # rebuild figures for the new night
-    ssins_fig = _build_ssins_figure()
-    ann_fig = _build_annotations_figure()
+    # patch figures for the new night
+    ssins_fig = _ssins_patch(data)
+    ann_fig = _annotations_patch(data)
 
     return ssins_fig, ann_fig, new_prev_disabled, new_next_disabled, \
             get_good(data)[0], get_good(data)[1]
@@ -446,6 +1067,8 @@ def change_night(prev_clicks, next_clicks):
 @app.callback(
     Output("ssins-graph", "figure", allow_duplicate=True),
     Output("annotation-graph", "figure", allow_duplicate=True),
+    Output("button-prev", "disabled", allow_duplicate=True),
+    Output("button-next", "disabled", allow_duplicate=True),
     Output("button-p-all", "active"),
     Output("button-p-0", "active"),
     Output("button-p-1", "active"),
@@ -463,62 +1086,246 @@ def change_night(prev_clicks, next_clicks):
     Input("button-p-2", "n_clicks"),
     Input("button-p-3", "n_clicks"),
     Input("button-p-4", "n_clicks"),
+    Input("select-sort", "value"),
+    Input("check-descending", "value"),
+    Input("select-filter", "value"),
+    Input("input-filter-min", "value"),
+    Input("input-filter-max", "value"),
+    State("switch-uncertain", "value"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def switch_pointing(pall,p0,p1,p2,p3,p4):
+@session_callback()
+def switch_pointing(data, pall,p0,p1,p2,p3,p4, sort, descending, field, low, high, uncertain, batch):
+    _apply_edits(data, batch)
     triggered = ctx.triggered_id
 
-    active = [False,False,False,False,False,False]
-
+    # the sort and filter controls keep the current pointing group
+    p = data.pointing_group
     if triggered == "button-p-all":
         p = 'p'
-        active[0] = True
-    elif triggered == "button-p-0":
-        p = 'p0'
-        active[1] = True
-    elif triggered == "button-p-1":
-        p = 'p1'
-        active[2] = True
-    elif triggered == "button-p-2":
-        p = 'p2'
-        active[3] = True
-    elif triggered == "button-p-3":
-        p = 'p3'
-        active[4] = True
-    elif triggered == "button-p-4":
-        p = 'p4'
-        active[5] = True
+    elif str(triggered).startswith("button-p-"):
+        p = 'p' + triggered[len("button-p-"):]
+    else:
+        # filtered on the summary rows as they are, kept current in the background
+        data.view = {"where": {field: [low, high]} if field else {}, "sort": sort or None,
+                     "descending": bool(descending)}
+
+    active = [p == 'p'] + [p == f'p{i}' for i in range(5)]
 
     data.set_pointing(p)
+    data.prefetch(config.PREFETCH_DEPTH)
 
-    # rebuild figures for the new pointing
-    ssins_fig = _build_ssins_figure()
-    ann_fig = _build_annotations_figure()
+    # patch figures for the new pointing
+    ssins_fig = _ssins_patch(data)
+    ann_fig = _annotations_patch(data)
 
-    return ssins_fig, ann_fig, active[0], active[1], active[2], active[3], active[4], active[5], \
+    # a filter that matches nothing keeps the current night on screen, with nowhere to go
+    prev_disabled, next_disabled = _nav_disabled(data, bool(uncertain) and ranking is not None)
+    return ssins_fig, ann_fig, prev_disabled, next_disabled, \
+            active[0], active[1], active[2], active[3], active[4], active[5], \
             get_good(data)[0], get_good(data)[1], f"Number of bad files: {data.count_bad()}", \
             f"Total number of files: {data.get_n()}", f"Number of annotated files: {data.count_annotations(p)}"
 
 
+@app.callback(
+    Output("h6-n-files", "children", allow_duplicate=True),
+    Output("h6-count-annotations", "children", allow_duplicate=True),
+    Output("h6-count-bad", "children", allow_duplicate=True),
+    Output("button-prev", "disabled", allow_duplicate=True),
+    Output("button-next", "disabled", allow_duplicate=True),
+    Output("index-version", "data"),
+    Input("index-poll", "n_intervals"),
+    State("index-version", "data"),
+    State("switch-uncertain", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def follow_index(n, seen, uncertain, sid):
+    # most ticks find nothing new, so the session is only loaded once the index moved
+    start_services()
+    storage.index.refresh()
+    version = storage.index.version
+    if version == seen:
+        return (no_update,) * 6
+    return (*_index_counts(uncertain, sid), version)
+
+
+def _nav_disabled(data, uncertain):
+    """Disabled states of Previous and Next, both when the file list is empty."""
+    if not data.filenames:
+        return True, True
+    # in uncertainty order Previous walks back through the visited files
+    if uncertain:
+        return not data.history, False
+    idx = data.filenames.index(data.filename) if data.filename in data.filenames else 0
+    return idx == 0, idx >= len(data.filenames) - 1
+
+
+@session_callback(write=False)
+def _index_counts(data, uncertain):
+    prev_disabled, next_disabled = _nav_disabled(data, bool(uncertain) and ranking is not None)
+    return f"Total number of files: {data.get_n()}", \
+            f"Number of annotated files: {data.count_annotations(data.pointing_group)}", \
+            f"Number of bad files: {data.count_bad()}", prev_disabled, next_disabled
+
+
+@app.callback(
+    Output("overview-graph", "figure"),
+    Output("overview-files", "data"),
+    Output("overview-modal", "is_open"),
+    Input("button-overview", "n_clicks"),
+    Input("overview-mode", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback(write=False)
+def show_overview(data, n, mode):
+    return _build_overview_figure(data, mode), data.filenames, True
+
+
+@app.callback(
+    Output("ssins-graph", "figure", allow_duplicate=True),
+    Output("annotation-graph", "figure", allow_duplicate=True),
+    Output("button-bad", "children", allow_duplicate=True),
+    Output("button-bad", "color", allow_duplicate=True),
+    Output("button-prev", "disabled", allow_duplicate=True),
+    Output("button-next", "disabled", allow_duplicate=True),
+    Output("overview-modal", "is_open", allow_duplicate=True),
+    Input("overview-graph", "clickData"),
+    State("overview-files", "data"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback()
+def open_from_overview(data, click, filenames, batch):
+    if not click or not filenames:
+        return (no_update,) * 7
+    row = min(max(int(round(click["points"][0]["y"])), 0), len(filenames) - 1)
+    if filenames[row] not in data.filenames:
+        return (no_update,) * 7
+
+    _apply_edits(data, batch)
+    data.visit(filenames[row])
+    data.prefetch(config.PREFETCH_DEPTH)
+    idx = data.filenames.index(data.filename)
+    return _ssins_patch(data), _annotations_patch(data), get_good(data)[0], get_good(data)[1], \
+            idx == 0, idx == len(data.filenames) - 1, False
+
+
+@app.callback(
+    Output("similar-list", "children"),
+    Output("similar-matches", "data"),
+    Output("similar-modal", "is_open"),
+    Input("button-similar", "n_clicks"),
+    State("ssins-graph", "selectedData"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback(write=False)
+def find_similar(data, n, selectedData):
+    ranges = _selected_ranges(data, selectedData)
+    if not ranges:
+        return dbc.Alert("Select the event to match on the SSINS graph first.", color="secondary"), [], True
+    start, stop = ranges[0][0], ranges[-1][1]
+    # the watcher embeds new and replaced nights as they arrive
+    found = similar.search(data.ssins[start:stop], k=config.SIMILAR_TOP_K, exclude=(data.filename, start, stop))
+
+    current = {rec.canonical: rec.filename for rec in data.records("p")}
+    items, matches = [], []
+    for i, (name, m_start, m_stop, score) in enumerate(found):
+        filename = current.get(name, name)
+        night, pointing = _parse_name(name)
+        items.append(dbc.ListGroupItem(
+            f"Night {night}, pointing {pointing}: time steps {m_start} to {m_stop}, similarity {score:.3f}",
+            id={"type": "similar-match", "index": i},
+            action=True,
+            # only files in the current list can be opened
+            disabled=filename not in data.filenames,
+        ))
+        matches.append([filename, m_start, m_stop])
+    if not items:
+        return dbc.Alert("No similar events found.", color="secondary"), [], True
+    return dbc.ListGroup(items), matches, True
+
+
+@app.callback(
+    Output("ssins-graph", "figure", allow_duplicate=True),
+    Output("annotation-graph", "figure", allow_duplicate=True),
+    Output("button-bad", "children", allow_duplicate=True),
+    Output("button-bad", "color", allow_duplicate=True),
+    Output("button-prev", "disabled", allow_duplicate=True),
+    Output("button-next", "disabled", allow_duplicate=True),
+    Output("similar-modal", "is_open", allow_duplicate=True),
+    Input({"type": "similar-match", "index": ALL}, "n_clicks"),
+    State("similar-matches", "data"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+@session_callback()
+def open_similar(data, clicks, matches, batch):
+    # new list items fire this too, without a click
+    if not ctx.triggered or not ctx.triggered[0]["value"] or not matches:
+        return (no_update,) * 7
+    filename, start, stop = matches[ctx.triggered_id["index"]]
+    if filename not in data.filenames:
+        return (no_update,) * 7
+
+    _apply_edits(data, batch)
+    data.visit(filename)
+    data.prefetch(config.PREFETCH_DEPTH)
+    idx = data.filenames.index(data.filename)
+
+    # zoom on the match, with its own width of context either side
+    x_range = [start - (stop - start), stop + (stop - start)]
+    return _ssins_patch(data, x_range), _annotations_patch(data, x_range=x_range), \
+            get_good(data)[0], get_good(data)[1], idx == 0, idx == len(data.filenames) - 1, False
+
+
 @app.callback(
     Output("save-toast", "is_open"),
     Output("save-toast", "children"),
     Output("h6-count-annotations", "children", allow_duplicate=True),
     Input("button-export", "n_clicks"),
+    State("edit-batch", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def export(n):
+@session_callback()
+def export(data, n, batch):
     if not n:
-        return no_update, no_update
+        return no_update, no_update, no_update
+
+    _apply_edits(data, batch)
 
     # Block export if any unannotated points (zeros) remain
-    missing = int(np.count_nonzero(data.annotations == 0))
+    missing = data.annotations.count(0)
     if missing > 0:
         msg = f"Export blocked: {missing} unannotated point(s) remain. Label all points (1, 2, or 3) before exporting."
         return True, msg, no_update
+    # model suggestions are not labels until someone has looked at them
+    unreviewed = data.annotations.count_suggested()
+    if unreviewed > 0:
+        msg = (f"Export blocked: {unreviewed} point(s) still hold unreviewed suggestions (grey). "
+               "Label them, or select them and click Accept Suggestions, before exporting.")
+        return True, msg, no_update
 
-    # Otherwise save
-    annotations_path = data.save_annotations()
+    # Otherwise save, and wait for the write so a failure is reported rather than lost
+    try:
+        annotations_path = data.save_annotations(wait=config.SAVE_TIMEOUT_S)
+    except OSError as e:
+        # TimeoutError included, the journal entry stays until the write succeeds
+        logger.error("Export of %s failed: %s", data.filename, e)
+        return True, f"Export failed, the labels are still in this session: {e}", no_update
+    metrics.count_file("annotated", _remote_user())
+    if ranking is not None:
+        ranking.discard(data.filename)
+    # the state fractions and thumbnail of the night, off the request thread
+    threading.Thread(target=summary.update, args=([data.filename],), name="summary-update",
+                     daemon=True).start()
     return True, f"Annotations successfully saved in {annotations_path}", \
             f"Number of annotated files: {data.count_annotations(data.pointing_group)}"
 
@@ -528,16 +1335,24 @@ def export(n):
     Output("button-bad", "color", allow_duplicate=True),
     Output("h6-count-bad", "children", allow_duplicate=True),
     Input("button-bad", "n_clicks"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def reject_accept(nbad):
+@session_callback()
+def reject_accept(data, nbad):
 
     triggered = ctx.triggered_id
     if triggered == "button-bad":
         if data.good:
             data.mark_bad()
+            metrics.count_file("rejected", _remote_user())
+            if ranking is not None:
+                ranking.discard(data.filename)
         else:
             data.mark_good()
+            metrics.count_file("accepted", _remote_user())
+            if ranking is not None:
+                ranking.add(data.filename)
 
     return get_good(data)[0], get_good(data)[1], f"Number of bad files: {data.count_bad()}"
 
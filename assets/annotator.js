@@ -0,0 +1,171 @@
+// Hotkeys and client-side labelling, see "Hotkeys" in the README.
+//
+// The label buttons repaint the annotation trace in the browser. Their edits
+// are queued and sent to the server in one batch (the "edit-batch" store) once
+// no label was set for EDIT_DEBOUNCE_MS, or as soon as any other control is
+// used, so the server always has them before it changes night or saves.
+
+(function () {
+    const KEYS = {
+        "1": "button-set-1",
+        "2": "button-set-2",
+        "3": "button-set-3",
+        "4": "button-set-4",
+        "arrowright": "button-next",
+        "n": "button-next",
+        "arrowleft": "button-prev",
+        "p": "button-prev",
+        "r": "button-bad",
+        "a": "button-accept",
+    };
+    const LABELS = {
+        "button-set-1": 1,
+        "button-set-2": 2,
+        "button-set-3": 3,
+        "button-set-4": 4,
+        "button-set-all-clean": 1,
+    };
+
+    let queue = [];  // edits the server has not acknowledged, oldest first
+    let seq = 0;
+    let sent = 0;
+    let timer = null;
+
+    function flush() {
+        clearTimeout(timer);
+        timer = null;
+        if (seq > sent) {
+            sent = seq;
+            // unacknowledged edits are sent again, the server skips those it has
+            window.dash_clientside.set_props("edit-batch", {data: {ops: queue.slice()}});
+        }
+    }
+
+    // [start, stop) runs of a selection. Box and lasso selections are
+    // contiguous, so neighbouring displayed points are joined across the
+    // points a decimated trace leaves out.
+    function selectedRanges(selectedData, n) {
+        const points = (selectedData.points || []).slice();
+        const region = selectedData.range || selectedData.lassoPoints;
+        const key = region ? "pointIndex" : "x";
+        points.sort((a, b) => a[key] - b[key]);
+        const ranges = [];
+        let prev = null;
+        for (const p of points) {
+            const x = Math.round(p.x);
+            if (x < 0 || x >= n) {
+                continue;
+            }
+            if (prev !== null && p[key] === prev[key] + 1) {
+                ranges[ranges.length - 1][1] = x + 1;
+            } else {
+                ranges.push([x, x + 1]);
+            }
+            prev = p;
+        }
+        return ranges;
+    }
+
+    // trace 0 holds the labels, trace 1 the unreviewed suggestions, which
+    // any label or acceptance clears
+    function paint(figure, ops) {
+        const y = figure.data[0].y.slice();
+        const suggested = figure.data[1].y.slice();
+        for (const op of ops) {
+            for (const [start, stop] of op.ranges) {
+                const a = Math.max(start, 0), b = Math.min(stop, y.length);
+                if (!op.accept) {
+                    y.fill(op.state, a, b);
+                }
+                suggested.fill(null, a, b);
+            }
+        }
+        const traces = [Object.assign({}, figure.data[0], {y: y}), Object.assign({}, figure.data[1], {y: suggested})];
+        return Object.assign({}, figure, {data: traces.concat(figure.data.slice(2))});
+    }
+
+    document.addEventListener("keydown", function (event) {
+        if (event.ctrlKey || event.metaKey || event.altKey || event.repeat) {
+            return;
+        }
+        if (event.target.closest && event.target.closest("input, textarea, select, [contenteditable]")) {
+            return;
+        }
+        const button = document.getElementById(KEYS[event.key.toLowerCase()]);
+        if (!button || button.disabled) {
+            return;
+        }
+        event.preventDefault();
+        button.click();
+    });
+
+    // capture phase, so the batch is sent before the control's own callback fires
+    function flushOutside(event) {
+        if (!event.target.closest || !event.target.closest("#ssins-graph, #annotation-graph, [id^='button-set-'], #button-accept")) {
+            flush();
+        }
+    }
+    document.addEventListener("pointerdown", flushOutside, true);
+    document.addEventListener("click", flushOutside, true);
+    document.addEventListener("visibilitychange", flush);
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        annotator: {
+            label: function (b1, b2, b3, b4, ball, baccept, selectedData, figure, propagate, debounceMs) {
+                const triggered = window.dash_clientside.callback_context.triggered;
+                if (!triggered.length || !figure || !figure.layout.meta) {
+                    return window.dash_clientside.no_update;
+                }
+                const id = triggered[0].prop_id.split(".")[0];
+                const meta = figure.layout.meta;
+                const n = figure.data[0].y.length;
+
+                const op = {seq: seq + 1, file: meta.file};
+                if (id === "button-accept") {
+                    op.accept = true;
+                } else {
+                    op.state = LABELS[id];
+                }
+                if (id === "button-set-all-clean" || !selectedData) {
+                    // no selection labels the whole night
+                    op.ranges = [[0, n]];
+                } else {
+                    op.ranges = selectedRanges(selectedData, n);
+                    if (meta.decimated && selectedData.range) {
+                        // points left out of the plot are only known to the server, it redoes the selection
+                        op.selection = {range: selectedData.range};
+                    } else if (meta.decimated && selectedData.lassoPoints) {
+                        op.selection = {lassoPoints: selectedData.lassoPoints};
+                    }
+                }
+                if (propagate && !op.accept) {
+                    op.propagate = true;
+                }
+                if (!op.ranges.length && !op.selection) {
+                    return window.dash_clientside.no_update;
+                }
+
+                seq = op.seq;
+                queue.push(op);
+                clearTimeout(timer);
+                timer = setTimeout(flush, debounceMs);
+                return paint(figure, [op]);
+            },
+
+            file: function (figure, current) {
+                const file = figure && figure.layout.meta ? figure.layout.meta.file : null;
+                return file === current ? window.dash_clientside.no_update : file;
+            },
+
+            ack: function (ack, figure) {
+                queue = queue.filter(op => op.seq > ack.seq);
+                // the server's corrections may have painted over edits still on their way
+                const pending = queue.filter(op => figure && op.file === figure.layout.meta.file);
+                if (!ack.fixed || !pending.length) {
+                    return window.dash_clientside.no_update;
+                }
+                return paint(figure, pending);
+            },
+        },
+    });
+})();
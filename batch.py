@@ -0,0 +1,267 @@
+import argparse
+import json
+import numpy as np
+import os
+import sys
+import time
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from annotations import SUGGESTED
+from data import Dataset
+from hmm import GaussianHMM, HMMSuggester
+from storage import open_storage, _canonical
+from writer import atomic_write
+
+# Storage (and model) of the worker process, opened once by the pool initializer
+_storage = None
+_model = None
+
+
+def _init_worker(path):
+    global _storage
+    _storage = open_storage(path, cache_size=1, prefetch_workers=1, mmap_mode="r")
+
+
+def _init_suggest_worker(path, params):
+    global _model
+    _init_worker(path)
+    _model = GaussianHMM(*params)
+
+
+def _scan(names):
+    """(filename, length, unlabelled points) for each file, without keeping the arrays."""
+    out = []
+    for name in names:
+        length = len(_storage.load_ssins(name))
+        annotations = _storage.load_annotations(name)
+        # unreviewed suggestions count as unlabelled
+        missing = length if annotations is None else int(np.count_nonzero(
+            (np.asarray(annotations) == 0) | (np.asarray(annotations) > SUGGESTED)))
+        out.append((name, length, missing))
+    return out
+
+
+def _rows(names):
+    out = []
+    for name in names:
+        ssins = np.asarray(_storage.load_ssins(name))
+        annotations = _storage.load_annotations(name)
+        labels = np.zeros(len(ssins), np.uint8) if annotations is None else np.asarray(annotations).astype(np.uint8)
+        # a model's own suggestions are no training labels
+        labels[labels > SUGGESTED] = 0
+        out.append((ssins, labels))
+    return out
+
+
+def _suggest(names):
+    """Write Viterbi labels for each file, returning the raw stamps they were computed from."""
+    stamps = [_storage.raw_stamp(name) for name in names]
+    paths = _model.viterbi_batch([np.asarray(_storage.load_ssins(name)) for name in names])
+    for name, path in zip(names, paths):
+        _storage.save_suggestion(name, path)
+    return list(zip(names, stamps))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _bounded_map(pool, fn, chunks, window):
+    """Ordered pool.map that keeps at most `window` chunks in flight or unread."""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.submit(fn, chunk))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def scan(path, pointing="p", workers=None, chunk=256):
+    """Per-file annotation completeness of a data directory or archive."""
+    data = Dataset(path)
+    records = {r.filename: r for r in data.records(pointing)}
+    workers = workers or os.cpu_count()
+
+    results = []
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(os.path.abspath(path),)) as pool:
+        for part in _bounded_map(pool, _scan, _chunks(list(records), chunk), 4 * workers):
+            for name, length, missing in part:
+                rec = records[name]
+                results.append({
+                    "filename": name, "night": rec.night, "pointing": rec.pointing, "bad": rec.bad,
+                    "annotated": rec.annotated, "length": length, "unlabelled": missing,
+                })
+    return results
+
+
+def summarize(results, key):
+    groups = defaultdict(lambda: {"files": 0, "bad": 0, "annotated": 0, "complete": 0,
+                                  "points": 0, "unlabelled": 0})
+    for r in results:
+        g = groups[r[key]]
+        g["files"] += 1
+        g["bad"] += r["bad"]
+        g["annotated"] += r["annotated"]
+        g["complete"] += r["annotated"] and r["unlabelled"] == 0
+        g["points"] += r["length"]
+        g["unlabelled"] += r["unlabelled"]
+    return dict(sorted(groups.items()))
+
+
+def _print_table(title, groups):
+    print(f"\n{title}")
+    print(f"{'':>10} {'files':>7} {'bad':>5} {'annotated':>10} {'complete':>9} {'unlabelled':>11}")
+    for name, g in groups.items():
+        frac = g["unlabelled"] / g["points"] if g["points"] else 0.0
+        print(f"{name:>10} {g['files']:>7} {g['bad']:>5} {g['annotated']:>10} {g['complete']:>9} {frac:>10.1%}")
+
+
+def report(path, pointing="p", workers=None, as_json=False):
+    results = scan(path, pointing, workers)
+    per_pointing = summarize(results, "pointing")
+    per_night = summarize(results, "night")
+    incomplete = [r["filename"] for r in results if not r["bad"] and r["unlabelled"] > 0]
+
+    if as_json:
+        json.dump({"pointings": per_pointing, "nights": per_night, "incomplete": incomplete},
+                  sys.stdout, indent=1)
+        print()
+        return
+
+    _print_table("Per pointing", {f"p{k}": v for k, v in per_pointing.items()})
+    _print_table("Per night", per_night)
+    print(f"\n{len(incomplete)} good file(s) still contain unlabelled points")
+
+
+def export(path, out, pointing="p", workers=None, complete_only=False, include_bad=True, chunk=256):
+    """
+    Write every selected night into one training set under `out`:
+    ssins.npy (n_files x max_length, NaN padded), labels.npy (uint8, 0 padded),
+    lengths.npy, bad.npy (bad-file mask) and filenames.txt.
+    Rows are streamed into memory-mapped outputs as workers finish them.
+    """
+    t0 = time.perf_counter()
+    results = scan(path, pointing, workers)
+    rows = [r for r in results
+            if (include_bad or not r["bad"]) and (not complete_only or (r["annotated"] and r["unlabelled"] == 0))]
+    names = [r["filename"] for r in rows]
+    lengths = np.array([r["length"] for r in rows], dtype=np.int64)
+    width = int(lengths.max()) if len(rows) else 0
+
+    os.makedirs(out, exist_ok=True)
+    open_memmap = np.lib.format.open_memmap
+    ssins = open_memmap(os.path.join(out, "ssins.npy"), mode="w+", dtype=np.float64, shape=(len(rows), width))
+    labels = open_memmap(os.path.join(out, "labels.npy"), mode="w+", dtype=np.uint8, shape=(len(rows), width))
+    np.save(os.path.join(out, "lengths.npy"), lengths)
+    np.save(os.path.join(out, "bad.npy"), np.array([r["bad"] for r in rows], dtype=bool))
+    with open(os.path.join(out, "filenames.txt"), "w") as f:
+        f.write("\n".join(names) + "\n")
+
+    workers = workers or os.cpu_count()
+    i = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(os.path.abspath(path),)) as pool:
+        for part in _bounded_map(pool, _rows, _chunks(names, chunk), 2 * workers):
+            for x, y in part:
+                ssins[i, :len(x)] = x
+                ssins[i, len(x):] = np.nan
+                labels[i, :len(y)] = y
+                i += 1
+    ssins.flush()
+    labels.flush()
+    print(f"Exported {len(rows)} file(s) x {width} steps to {os.path.abspath(out)} "
+          f"in {time.perf_counter() - t0:.1f}s")
+
+
+def _save_checkpoint(path, checkpoint):
+    atomic_write(path, lambda f: json.dump(checkpoint, f), mode="w")
+
+
+def prelabel(path, pointing="p", workers=None, chunk=16, force=False):
+    """
+    Write HMM suggestions for every file to `path`/suggestions/, never touching
+    annotations. A checkpoint records the raw stamp each suggestion was made
+    from, so an interrupted run resumes where it stopped and files whose raw
+    series did not change are skipped. Refitting the model starts over.
+    """
+    storage = open_storage(path)
+    suggester = HMMSuggester(storage)
+    suggester.fit()
+    model = suggester.model
+    if model is None:
+        print("No saved annotations to fit a model on")
+        return
+
+    params = (model.log_pi, model.log_A, model.means, model.variances)
+    fingerprint = zlib.crc32(b"".join(np.ascontiguousarray(p).tobytes() for p in params))
+    checkpoint_file = os.path.join(storage.suggestion_path, "checkpoint.json")
+    checkpoint = {"model": fingerprint, "done": {}}
+    if not force and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            saved = json.load(f)
+        if saved.get("model") == fingerprint:
+            checkpoint = saved
+
+    storage.index.refresh()
+    done = checkpoint["done"]
+    todo = [r.filename for r in storage.index.records(pointing)
+            if done.get(r.canonical) != storage.raw_stamp(r.filename)]
+    print(f"{len(todo)} file(s) to label, {len(storage.index.records(pointing)) - len(todo)} up to date")
+    if not todo:
+        return
+
+    workers = workers or os.cpu_count()
+    t0 = last_save = time.perf_counter()
+    n = 0
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_suggest_worker,
+                                 initargs=(os.path.abspath(path), params)) as pool:
+            for part in _bounded_map(pool, _suggest, _chunks(todo, chunk), 4 * workers):
+                for name, stamp in part:
+                    done[_canonical(name)] = stamp
+                n += len(part)
+                now = time.perf_counter()
+                if now - last_save > 10:
+                    _save_checkpoint(checkpoint_file, checkpoint)
+                    last_save = now
+                    print(f"{n}/{len(todo)} files, {n / (now - t0):.1f} files/s")
+    finally:
+        _save_checkpoint(checkpoint_file, checkpoint)
+        elapsed = time.perf_counter() - t0
+        print(f"Labelled {n} file(s) in {elapsed:.1f}s ({n / max(elapsed, 1e-9):.1f} files/s) "
+              f"into {storage.suggestion_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless validation and export of HMM annotations.")
+    parser.add_argument("path", help="data directory (raw_data/ + annotations/) or archive")
+    parser.add_argument("-p", "--pointing", default="p", help="pointing group, e.g. p0 (default: all)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_report = sub.add_parser("report", help="annotation completeness per pointing and per night")
+    p_report.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    p_export = sub.add_parser("export", help="write a consolidated training set")
+    p_export.add_argument("out", help="output directory")
+    p_export.add_argument("--complete-only", action="store_true", help="only fully labelled files")
+    p_export.add_argument("--exclude-bad", action="store_true", help="leave out files flagged bad")
+
+    p_suggest = sub.add_parser("suggest", help="pre-label every file with the HMM into suggestions/")
+    p_suggest.add_argument("--force", action="store_true", help="ignore the checkpoint and relabel everything")
+
+    args = parser.parse_args(argv)
+    if args.command == "report":
+        report(args.path, args.pointing, args.workers, args.json)
+    elif args.command == "export":
+        export(args.path, args.out, args.pointing, args.workers,
+               complete_only=args.complete_only, include_bad=not args.exclude_bad)
+    elif args.command == "suggest":
+        prelabel(args.path, args.pointing, args.workers, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+import argparse
+import cProfile
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+def make_tree(path, lengths, pointings=5, annotated=0.0, seed=0):
+    """
+    Synthetic raw_data/ + annotations/ tree, one night per length: noise with
+    a few decaying bursts. A fraction `annotated` of the nights gets labels.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(path, "raw_data"), exist_ok=True)
+    os.makedirs(os.path.join(path, "annotations"), exist_ok=True)
+    names = []
+    for i, n in enumerate(lengths):
+        x = rng.normal(0, 1, n)
+        labels = np.ones(n)
+        for start in rng.integers(0, max(n - 50, 1), size=max(n // 5000, 1)):
+            burst = x[start:start + 50]
+            burst += rng.uniform(10, 200) * np.exp(-np.arange(len(burst)) / 10)
+            labels[start:start + 5], labels[start + 5:start + 50] = 2, 3
+        name = f"subtracted_data_{100000 + i}_p{i % pointings}.npy"
+        np.save(os.path.join(path, "raw_data", name), x)
+        if rng.random() < annotated:
+            np.save(os.path.join(path, "annotations", name), labels)
+        names.append(name)
+    return names
+
+
+def _use_tree(path):
+    """Import the app against the tree at `path`, it opens its storage at import time."""
+    config.DATA_PATH, config.AUTO_SUGGEST, config.JOURNAL = path, False, False
+    import app
+    return app
+
+
+def _timed(fn, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return result, best
+
+
+def _payload(value):
+    from dash._utils import to_json
+    return len(to_json(value))
+
+
+def _stats(seconds, payloads=None):
+    ms = 1e3 * np.asarray(seconds)
+    out = {
+        "n": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+    if payloads:
+        out["mean_bytes"] = int(np.mean(payloads))
+    return out
+
+
+def _measure(fn, repeat, payload=False):
+    """Latency statistics of `repeat` calls to fn(i), with the JSON size of what it returns."""
+    seconds, payloads = [], []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(i)
+        seconds.append(time.perf_counter() - t0)
+        if payload:
+            payloads.append(_payload(result))
+    return _stats(seconds, payloads)
+
+
+def render(sizes=SIZES, repeat=3):
+    """Server build time (best of `repeat`) and JSON payload of both figures per night length."""
+    from data import Dataset
+
+    with tempfile.TemporaryDirectory() as tmp:
+        names = make_tree(tmp, sizes)
+        app = _use_tree(tmp)
+
+        results = []
+        for name, n in zip(names, sizes):
+            data = Dataset(tmp, storage=app.storage)
+            data.set_filename(name)
+            row = {"points": n, "trace": app._trace_type(n)}
+            for key, build in (("ssins_figure", app._build_ssins_figure),
+                               ("annotation_figure", app._build_annotations_figure),
+                               ("ssins_patch", app._ssins_patch),
+                               ("annotation_patch", app._annotations_patch)):
+                fig, seconds = _timed(lambda: build(data), repeat)
+                row[f"{key}_ms"] = round(1e3 * seconds, 2)
+                row[f"{key}_bytes"] = _payload(fig)
+            results.append(row)
+    return results
+
+
+def _trigger(prop_id):
+    """Make `ctx.triggered_id` report `prop_id` for a callback called directly."""
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    context_value.set(AttributeDict(triggered_inputs=[{"prop_id": prop_id, "value": 1}], updated_props={}))
+
+
+def dataset_suite(path, storage, repeat):
+    from data import Dataset
+
+    data = Dataset(path, storage=storage)
+    files = data.filenames
+    pointings = ["p0", "p1", "p2", "p3", "p4", "p"]
+    results = {
+        "Dataset.__init__": _measure(lambda i: Dataset(path, storage=storage), repeat),
+        "Dataset._sorted_files": _measure(lambda i: data._sorted_files("p"), repeat),
+        "Dataset.set_filename": _measure(lambda i: data.set_filename(files[i % len(files)]), repeat),
+        "Dataset.set_pointing": _measure(lambda i: data.set_pointing(pointings[i % len(pointings)]), repeat),
+    }
+    data.set_pointing("p")
+
+    def toggle(i):
+        data.mark_bad() if data.good else data.mark_good()
+    results["Dataset.mark_bad/mark_good"] = _measure(toggle, repeat - repeat % 2)
+    results["Dataset.count_annotations"] = _measure(lambda i: data.count_annotations("p"), repeat)
+
+    def save(i):
+        data.set_filename(files[i % len(files)])
+        data.annotations.set_range(0, len(data.annotations), 1)
+        t0 = time.perf_counter()
+        data.save_annotations()
+        return time.perf_counter() - t0
+    # only the save itself is timed, not opening the file
+    results["Dataset.save_annotations"] = _stats([save(i) for i in range(repeat)])
+    storage.writer.flush()
+    return results
+
+
+def callback_suite(app, repeat):
+    sid, data = app.new_session()
+    results = {}
+
+    seq = itertools.count(1)
+
+    def edit(state, ranges=None, selection=None):
+        """One op for the session's current night, `ranges` defaults to all of it."""
+        # the session moves between nights, and ops for another night are dropped
+        data = app._load_session(sid)
+        ranges = ranges or [[0, len(data.ssins)]]
+        op = {"seq": next(seq), "file": app._canonical(data.filename), "state": state, "ranges": ranges}
+        if selection is not None:
+            op["selection"] = selection
+        return {"ops": [op]}
+
+    def box_edit(i):
+        # a box selection the server resolves again, as sent for decimated nights
+        start = (i * 97) % max(len(data.ssins) - 100, 1)
+        box = {"range": {"x": [start, start + 99], "y": [-1e9, 1e9]}}
+        return edit(1 + i % 4, [[start, start + 100]], box)
+    # built up front, only the callback is timed
+    batches = [box_edit(i) for i in range(repeat)]
+    results["callback.apply_edits"] = _measure(lambda i: app.apply_edits(batches[i], False, sid), repeat,
+                                               payload=True)
+
+    def change_night(i):
+        _trigger("button-next.n_clicks" if i % 2 == 0 else "button-prev.n_clicks")
+        return app.change_night(1, 1, False, None, sid)
+    results["callback.change_night"] = _measure(change_night, repeat, payload=True)
+
+    buttons = itertools.cycle(["button-p-0", "button-p-1", "button-p-2", "button-p-3", "button-p-4", "button-p-all"])
+
+    def switch_pointing(i):
+        _trigger(f"{next(buttons)}.n_clicks")
+        return app.switch_pointing(1, 1, 1, 1, 1, 1, "", False, "", None, None, False, None, sid)
+    results["callback.switch_pointing"] = _measure(switch_pointing, repeat, payload=True)
+
+    def export(i):
+        app.apply_edits(edit(1), False, sid)
+        _trigger("button-export.n_clicks")
+        t0 = time.perf_counter()
+        result = app.export(1, None, sid)
+        return time.perf_counter() - t0, _payload(result)
+    timings = [export(i) for i in range(repeat)]
+    results["callback.export"] = _stats([t for t, _ in timings], [b for _, b in timings])
+    app.storage.writer.flush()
+    return results
+
+
+def similar(files=200, length=20_000, nights=100_000, repeat=20, k=10):
+    """
+    Similarity index build time on a synthetic tree, then query latency per
+    query length with the index scaled to `nights` by repeating its files.
+    """
+    from storage import open_storage
+    from similarity import SimilarityIndex, SCALES
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_tree(tmp, [length] * files)
+        storage = open_storage(tmp)
+        index = SimilarityIndex(storage)
+        build = _timed(index.refresh, 1)[1]
+        rec = storage.index.records()[0]
+        ssins = np.asarray(storage.load_ssins(rec.filename))
+        storage.index_writer.flush()
+
+    rows = list(index._rows.values())
+    for i in range(nights - len(rows)):
+        index._rows[f"copy_{i}"] = rows[i % len(rows)]
+    index._tables = None
+    tables = _timed(lambda: [index._table(w) for w in SCALES], 1)[1]
+
+    peak = int(np.argmax(ssins))
+    results = {"build_s_per_file": round(build / files, 5), "nights": len(index), "table_s": round(tables, 3)}
+    for n in SCALES:
+        segment = ssins[max(peak - n // 8, 0):][:n]
+        results[f"search_{n}"] = _stats([_timed(lambda: index.search(segment, k), 1)[1] for _ in range(repeat)])
+    return results
+
+
+_STARTUP = """
+import json, time
+t0 = time.perf_counter()
+import config
+config.DATA_PATH, config.LAZY_STARTUP = {path!r}, {lazy!r}
+import app
+t1 = time.perf_counter()
+client = app.server.test_client()
+client.get("/")
+t2 = time.perf_counter()
+client.get("/_dash-layout")
+t3 = time.perf_counter()
+print(json.dumps({{"import_ms": 1e3 * (t1 - t0), "index_ms": 1e3 * (t2 - t1),
+                  "first_layout_ms": 1e3 * (t3 - t2), "total_ms": 1e3 * (t3 - t0)}}))
+"""
+
+
+def startup(path=None, runs=5, lazy=True, files=200, length=10_000):
+    """
+    Cold starts in fresh interpreters: import of the app, the index page and
+    the first layout (which opens a session), median over `runs`.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            make_tree(tmp, [length] * files, annotated=0.5)
+            path = tmp
+        script = _STARTUP.format(path=os.path.abspath(path), lazy=lazy)
+        here = os.path.dirname(os.path.abspath(__file__))
+        samples = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", script], cwd=here, capture_output=True, text=True, check=True)
+            sample = json.loads(out.stdout.strip().splitlines()[-1])
+            sample["process_ms"] = 1e3 * (time.perf_counter() - t0)
+            samples.append(sample)
+    return {key: round(float(np.median([s[key] for s in samples])), 1) for key in samples[0]}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def suite(files=200, length=10_000, repeat=50, annotated=0.5):
+    """Time the Dataset operations and the Dash callbacks on a synthetic tree of `files` x `length`."""
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        make_tree(tmp, [length] * files, annotated=annotated)
+        generated = time.perf_counter() - t0
+
+        app = _use_tree(tmp)
+        results = dataset_suite(tmp, app.storage, repeat)
+        results.update(callback_suite(app, repeat))
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "files": files,
+            "length": length,
+            "repeat": repeat,
+            "generate_s": round(generated, 2),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=1.2):
+    """Print the p50 latency of two suite result files side by side, flagging slowdowns."""
+    with open(old) as f:
+        a = json.load(f)
+    with open(new) as f:
+        b = json.load(f)
+    print(f"{'':34} {a['meta']['commit'] or old:>12} {b['meta']['commit'] or new:>12} {'ratio':>7}")
+    for key in [k for k in a["results"] if k in b["results"]]:
+        before, after = a["results"][key]["p50_ms"], b["results"][key]["p50_ms"]
+        ratio = after / before if before else np.inf
+        flag = "  slower" if ratio > threshold else ("  faster" if ratio < 1 / threshold else "")
+        print(f"{key:34} {before:>10.3f}ms {after:>10.3f}ms {ratio:>7.2f}{flag}")
+
+
+def _print_rows(rows):
+    keys = list(rows[0])
+    print("  ".join(f"{k:>22}" for k in keys))
+    for row in rows:
+        print("  ".join(f"{row[k]:>22}" for k in keys))
+
+
+def _print_suite(report):
+    meta = report["meta"]
+    print(f"{meta['files']} files x {meta['length']} points, {meta['repeat']} calls each (commit {meta['commit']})")
+    print(f"{'':34} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'bytes':>9}")
+    for key, r in report["results"].items():
+        print(f"{key:34} {r['p50_ms']:>9.3f} {r['p90_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['max_ms']:>9.3f} "
+              f"{r.get('mean_bytes', ''):>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Timings of the annotator on synthetic data.")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--profile", metavar="FILE", help="write cProfile statistics of the run to FILE")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_render = sub.add_parser("render", help="figure build time and payload size per night length")
+    p_render.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    p_render.add_argument("--repeat", type=int, default=3)
+
+    p_suite = sub.add_parser("suite", help="latency percentiles of Dataset operations and callbacks")
+    p_suite.add_argument("--files", type=int, default=200)
+    p_suite.add_argument("--length", type=int, default=10_000)
+    p_suite.add_argument("--repeat", type=int, default=50)
+    p_suite.add_argument("-o", "--out", help="also save the results to this JSON file")
+
+    p_startup = sub.add_parser("startup", help="cold-start time of the app in fresh interpreters")
+    p_startup.add_argument("--path", help="data directory (default: a synthetic tree)")
+    p_startup.add_argument("--runs", type=int, default=5)
+    p_startup.add_argument("--eager", action="store_true", help="measure with LAZY_STARTUP off")
+    p_startup.add_argument("--budget-ms", type=float, help="exit with status 1 if the median process time exceeds this")
+
+    p_similar = sub.add_parser("similar", help="similarity index build time and query latency")
+    p_similar.add_argument("--files", type=int, default=200)
+    p_similar.add_argument("--length", type=int, default=20_000)
+    p_similar.add_argument("--nights", type=int, default=100_000, help="index size the queries run against")
+    p_similar.add_argument("--repeat", type=int, default=20)
+
+    p_compare = sub.add_parser("compare", help="compare two saved suite results")
+    p_compare.add_argument("old")
+    p_compare.add_argument("new")
+
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        compare(args.old, args.new)
+        return
+    if args.command == "startup":
+        results = startup(args.path, args.runs, lazy=not args.eager)
+        print(json.dumps(results) if args.json else
+              "  ".join(f"{k} {v:.0f}" for k, v in results.items()))
+        if args.budget_ms is not None and results["process_ms"] > args.budget_ms:
+            print(f"Cold start of {results['process_ms']:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+            sys.exit(1)
+        return
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    if args.command == "render":
+        results = render(args.sizes, args.repeat)
+    elif args.command == "similar":
+        results = similar(args.files, args.length, args.nights, args.repeat)
+    else:
+        results = suite(args.files, args.length, args.repeat)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    if args.command == "suite" and args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    elif args.command == "render":
+        _print_rows(results)
+    elif args.command == "similar":
+        for key, value in results.items():
+            print(f"{key:22} " + (f"p50 {value['p50_ms']:.1f} ms  p90 {value['p90_ms']:.1f} ms"
+                                  if isinstance(value, dict) else str(value)))
+    else:
+        _print_suite(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ArrayCache:
+    """
+    Bounded LRU cache of .npy arrays, keyed by path and validated against the
+    file's mtime/size, with a thread pool to load files in the background.
+
+    Cached arrays are shared, callers that mutate them must take a copy.
+    Loads may pass an np.load `mmap_mode`, in which case only the mapping is
+    cached and pages are read when the array is sliced.
+    """
+
+    def __init__(self, maxsize=32, workers=2):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _lookup(self, path, stamp):
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            self._entries.move_to_end(path)
+            return entry[1]
+        return None
+
+    def _store(self, path, stamp, arr):
+        with self._lock:
+            self._entries[path] = (stamp, arr)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _read(self, path, stamp, mmap_mode=None):
+        arr = np.load(path, mmap_mode=mmap_mode)
+        arr.flags.writeable = False
+        self._store(path, stamp, arr)
+        return arr
+
+    def load(self, path, mmap_mode=None):
+        """Return the array stored at `path`, or None if the file does not exist."""
+        stamp = self._stamp(path)
+        if stamp is None:
+            return None
+
+        with self._lock:
+            arr = self._lookup(path, stamp)
+            future = self._pending.get((path, stamp))
+            if arr is not None or future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if arr is not None:
+            return arr
+        if future is not None:
+            return future.result()
+        return self._read(path, stamp, mmap_mode)
+
+    def put(self, path, arr):
+        """Store an array that was just written to `path`."""
+        stamp = self._stamp(path)
+        if stamp is not None:
+            arr = np.array(arr)
+            arr.flags.writeable = False
+            self._store(path, stamp, arr)
+
+    def _prefetch_one(self, path, stamp, mmap_mode):
+        try:
+            return self._read(path, stamp, mmap_mode)
+        finally:
+            with self._lock:
+                self._pending.pop((path, stamp), None)
+
+    def prefetch(self, paths, mmap_mode=None):
+        """Schedule background loads for any of `paths` not already cached."""
+        for path in paths:
+            stamp = self._stamp(path)
+            if stamp is None:
+                continue
+            with self._lock:
+                if self._lookup(path, stamp) is not None or (path, stamp) in self._pending:
+                    continue
+                self._pending[(path, stamp)] = self._pool.submit(self._prefetch_one, path, stamp, mmap_mode)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "pending": len(self._pending),
+            }
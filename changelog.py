@@ -0,0 +1,274 @@
+import argparse
+import datetime
+import numpy as np
+import os
+import sqlite3
+import threading
+import time
+
+from annotations import AnnotationRuns
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, user TEXT, time REAL NOT NULL, length INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS versions_name ON versions (name, id);
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER NOT NULL, start INTEGER NOT NULL, stop INTEGER NOT NULL, state INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS changes_version ON changes (version);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT NOT NULL, version INTEGER NOT NULL, length INTEGER NOT NULL,
+    starts BLOB NOT NULL, states BLOB NOT NULL, PRIMARY KEY (name, version));
+"""
+
+
+def changed_runs(old, new):
+    """(start, stop, state) runs of `new` where it differs from `old` (everywhere if old is None)."""
+    new = np.asarray(new).astype(np.uint8)
+    if old is None or len(old) != len(new):
+        idx = np.arange(len(new))
+    else:
+        idx = np.flatnonzero(np.asarray(old) != new)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero((np.diff(idx) != 1) | (new[idx[1:]] != new[idx[:-1]]))
+    starts = idx[np.r_[0, breaks + 1]]
+    stops = idx[np.r_[breaks, len(idx) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist(), new[starts].tolist()))
+
+
+def diff_runs(a, b):
+    """(start, stop, state in a, state in b) of the runs where two AnnotationRuns differ."""
+    if len(a) != len(b):
+        raise ValueError(f"Cannot compare labels of {len(a)} and {len(b)} time steps")
+    # every change of either labelling starts a run, so runs never need merging
+    bounds = np.union1d(a._starts, b._starts)
+    stops = np.r_[bounds[1:], len(a)]
+    sa, sb = a.values_at(bounds), b.values_at(bounds)
+    keep = np.flatnonzero(sa != sb)
+    return list(zip(bounds[keep].tolist(), stops[keep].tolist(), sa[keep].tolist(), sb[keep].tolist()))
+
+
+class AnnotationLog:
+    """
+    Append-only record of every annotation save, in `path`/annotation_log.sqlite.
+
+    A save adds one version (night, user, time) holding only the runs that
+    changed, so a write costs the size of the change. The labels of any
+    version are rebuilt from the latest snapshot before it plus the changes
+    since; a snapshot is taken once `snapshot_every` changes of a night have
+    piled up, which bounds that replay.
+    """
+
+    FILENAME = "annotation_log.sqlite"
+
+    def __init__(self, path, snapshot_every=200):
+        self.path = os.path.join(os.path.abspath(path), self.FILENAME)
+        self.snapshot_every = snapshot_every
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # transactions are explicit, appends read and write under one lock
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _version_at(self, conn, name, version=None, at=None):
+        query, args = "SELECT MAX(id) FROM versions WHERE name = ?", [name]
+        if version is not None:
+            query, args = query + " AND id <= ?", args + [version]
+        if at is not None:
+            query, args = query + " AND time <= ?", args + [at]
+        return conn.execute(query, args).fetchone()[0]
+
+    def _replay(self, conn, name, version):
+        """(labels, last snapshot id) of `name` as of `version`."""
+        snap = conn.execute(
+            "SELECT version, length, starts, states FROM snapshots WHERE name = ? AND version <= ? "
+            "ORDER BY version DESC LIMIT 1", (name, version)).fetchone()
+        runs, after = None, 0
+        if snap is not None:
+            after = snap[0]
+            runs = AnnotationRuns(np.frombuffer(snap[2], np.int64), np.frombuffer(snap[3], np.uint8), snap[1])
+
+        rows = conn.execute(
+            "SELECT v.length, c.start, c.stop, c.state FROM versions v JOIN changes c ON c.version = v.id "
+            "WHERE v.name = ? AND v.id > ? AND v.id <= ? ORDER BY v.id, c.rowid", (name, after, version))
+        for length, start, stop, state in rows:
+            if runs is None or len(runs) != length:
+                runs = AnnotationRuns.zeros(length)
+            runs.set_range(start, stop, state)
+        return runs, after
+
+    def _insert(self, conn, name, user, runs, length, now):
+        version = conn.execute("INSERT INTO versions (name, user, time, length) VALUES (?, ?, ?, ?)",
+                               (name, user, now, length)).lastrowid
+        conn.executemany("INSERT INTO changes VALUES (?, ?, ?, ?)",
+                         [(version, start, stop, state) for start, stop, state in runs])
+        return version
+
+    def _snapshot(self, conn, name, version, runs):
+        conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                     (name, version, len(runs), runs._starts.astype(np.int64).tobytes(),
+                      runs._states.astype(np.uint8).tobytes()))
+
+    def append(self, name, values, user=None, previous=None):
+        """
+        Log the runs where `values` differs from the latest logged labels of
+        `name` as a new version, returning its id (None if nothing changed).
+        For a night the log has not seen, `previous()` may return the labels
+        saved before the log existed, which are logged first.
+        """
+        values = np.asarray(values).astype(np.uint8)
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            latest = self._version_at(conn, name)
+            current, snapshot = self._replay(conn, name, latest) if latest is not None else (None, 0)
+            if latest is None and previous is not None:
+                base = previous()
+                if base is not None and len(base) == len(values):
+                    self._insert(conn, name, None, changed_runs(None, base), len(base), now)
+                    current = AnnotationRuns.from_dense(base)
+
+            runs = changed_runs(current.dense() if current is not None else None, values)
+            if not runs:
+                conn.execute("COMMIT")
+                return None
+            version = self._insert(conn, name, user, runs, len(values), now)
+
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM changes c JOIN versions v ON c.version = v.id WHERE v.name = ? AND v.id > ?",
+                (name, snapshot)).fetchone()[0]
+            if pending >= self.snapshot_every:
+                self._snapshot(conn, name, version, AnnotationRuns.from_dense(values))
+            conn.execute("COMMIT")
+            return version
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def state(self, name, version=None, at=None):
+        """Labels of `name` as of `version` and/or unix time `at` (default: latest), None before its first save."""
+        conn = self._connect()
+        target = self._version_at(conn, name, version, at)
+        if target is None:
+            return None
+        return self._replay(conn, name, target)[0]
+
+    def history(self, name=None, limit=None):
+        """Versions, newest first, as dicts of version, name, user, time, changes and points changed."""
+        query = ("SELECT v.id, v.name, v.user, v.time, COUNT(c.rowid), COALESCE(SUM(c.stop - c.start), 0) "
+                 "FROM versions v LEFT JOIN changes c ON c.version = v.id")
+        args = []
+        if name is not None:
+            query, args = query + " WHERE v.name = ?", [name]
+        query += " GROUP BY v.id ORDER BY v.id DESC"
+        if limit is not None:
+            query, args = query + " LIMIT ?", args + [limit]
+        keys = ("version", "name", "user", "time", "changes", "points")
+        return [dict(zip(keys, row)) for row in self._connect().execute(query, args)]
+
+    def diff(self, name, a, b=None):
+        """Runs where the labels of `name` differ between versions `a` and `b` (default: latest)."""
+        old, new = self.state(name, a), self.state(name, b)
+        if old is None or new is None:
+            raise KeyError(f"{name} has no logged version at or before {a if old is None else b}")
+        return diff_runs(old, new)
+
+    def compact(self):
+        """Snapshot the latest labels of every night with changes since its last snapshot, returns how many."""
+        conn = self._connect()
+        stale = conn.execute(
+            "SELECT v.name, MAX(v.id) FROM versions v LEFT JOIN "
+            "(SELECT name, MAX(version) AS version FROM snapshots GROUP BY name) s ON s.name = v.name "
+            "GROUP BY v.name HAVING MAX(v.id) > COALESCE(MAX(s.version), 0)").fetchall()
+        for name, version in stale:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                runs, _ = self._replay(conn, name, version)
+                self._snapshot(conn, name, version, runs)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return len(stale)
+
+
+def rollback(storage, name, version=None, at=None, user=None):
+    """
+    Save the labels night `name` had at `version` (or unix time `at`) through
+    `storage`, which logs the restore as a new version. Returns its id, None
+    if the labels were already those.
+    """
+    runs = storage.log.state(name, version, at)
+    if runs is None:
+        raise KeyError(f"{name} has no logged version at or before {version if at is None else at}")
+    current = storage.log.state(name)
+    if len(current) == len(runs) and not diff_runs(current, runs):
+        return None
+    storage.index.refresh()
+    rec = next((r for r in storage.index.records() if r.canonical == name), None)
+    if rec is None:
+        raise KeyError(f"{name} is not in {storage.path}")
+    # files keep the dtype of the raw series, as Dataset.save_annotations does
+    values = runs.dense().astype(storage.load_ssins(rec.filename).dtype)
+    storage.save_annotations(rec.filename, values, user=user)
+    storage.writer.flush()
+    return storage.log.history(name, limit=1)[0]["version"]
+
+
+def _time(text):
+    return None if text is None else datetime.datetime.fromisoformat(text).timestamp()
+
+
+def main(argv=None):
+    from storage import open_storage
+
+    parser = argparse.ArgumentParser(description="Inspect and roll back the annotation log of a data directory or archive.")
+    parser.add_argument("path", help="data directory (raw_data/ + annotations/) or archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_history = sub.add_parser("history", help="list logged versions, newest first")
+    p_history.add_argument("name", nargs="?", help="canonical filename (default: every night)")
+    p_history.add_argument("-n", "--limit", type=int, default=20)
+
+    p_diff = sub.add_parser("diff", help="runs whose labels differ between two versions of a night")
+    p_diff.add_argument("name")
+    p_diff.add_argument("a", type=int)
+    p_diff.add_argument("b", type=int, nargs="?", help="(default: latest)")
+
+    p_rollback = sub.add_parser("rollback", help="restore a night's labels as of a version or time")
+    p_rollback.add_argument("name")
+    group = p_rollback.add_mutually_exclusive_group(required=True)
+    group.add_argument("--version", type=int)
+    group.add_argument("--at", help="ISO date and time, e.g. 2026-10-01T12:00")
+    p_rollback.add_argument("--user", default=os.environ.get("USER"))
+
+    sub.add_parser("compact", help="snapshot every night changed since its last snapshot")
+
+    args = parser.parse_args(argv)
+    storage = open_storage(args.path, log=True)
+    log = storage.log
+
+    if args.command == "history":
+        for v in log.history(args.name, args.limit):
+            when = datetime.datetime.fromtimestamp(v["time"]).isoformat(timespec="seconds")
+            print(f"{v['version']:>8}  {when}  {v['user'] or '-':<16} {v['name']:<40} "
+                  f"{v['changes']:>6} runs {v['points']:>10} points")
+    elif args.command == "diff":
+        for start, stop, a, b in log.diff(args.name, args.a, args.b):
+            print(f"[{start}, {stop})  {a} -> {b}")
+    elif args.command == "rollback":
+        version = rollback(storage, args.name, args.version, _time(args.at), args.user)
+        print(f"Restored {args.name} as version {version}" if version else f"{args.name} was unchanged")
+    elif args.command == "compact":
+        print(f"Wrote {log.compact()} snapshots")
+
+
+if __name__ == "__main__":
+    main()
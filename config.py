@@ -1,2 +1,24 @@
 BIND_ADDR='0.0.0.0'
-BIND_PORT=8080
\ No newline at end of file
+BIND_PORT=8080
+DATA_PATH='assets'
+CACHE_SIZE=32
+PREFETCH_DEPTH=3
+PREFETCH_WORKERS=2
+MAX_PLOT_POINTS=5000
+SESSION_STORE='memory'
+SESSION_TTL_S=7*24*3600
+MMAP_MODE=None
+JOURNAL=True
+AUTO_SUGGEST=True
+SUMMARY_NSIGMA=5
+OVERVIEW_WIDTH=256
+WEBGL_THRESHOLD=5000
+SLOW_CALLBACK_MS=None
+LAZY_STARTUP=False
+EDIT_DEBOUNCE_MS=300
+ANNOTATION_LOG=True
+SIMILAR_TOP_K=10
+SIMILAR_WINDOWS=16
+WATCH_INTERVAL_S=5
+SAVE_TIMEOUT_S=10
+RANK_REFIT_EVERY=50
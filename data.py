@@ -1,15 +1,52 @@
+import json
 import numpy as np
 import os
-from pathlib import Path
+
+from annotations import AnnotationRuns, EditHistory, as_suggestion
+from storage import open_storage, _canonical, _parse_name
 
 
 class Dataset:
+    """
+    One annotator's view of a data directory or archive.
+
+    The storage backend (file index, caches) can be passed in so that several
+    sessions share it, and `snapshot`/`restore` move the per-session state
+    (current file, pointing group, unsaved annotations) in and out of a
+    session store.
+
+    `mmap_mode` is passed to np.load for the raw series, so with "r" only the
+    parts of a night that are plotted or selected get paged in. With a
+    `suggester` (hmm.HMMSuggester), unlabelled nights open pre-filled with
+    its Viterbi path, as suggestions (annotations.SUGGESTED) that have to be
+    labelled or accepted before the night can be saved. With a `summary`
+    (summary.SummaryIndex), the file list can be filtered and sorted by
+    per-file statistics through `set_view`.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, cache_size=32, prefetch_workers=2, mmap_mode=None, journal=False,
+                 storage=None, suggester=None, summary=None, state=None, user=None):
 
         self._path = os.path.abspath(path)
-        self._data_path = os.path.join(self._path, "raw_data/")
-        self._annotation_path = os.path.join(self._path,"annotations/")
+        self._storage = storage or open_storage(self._path, cache_size, prefetch_workers, mmap_mode, journal)
+        self._index = self._storage.index
+        self._suggester = suggester
+        self._summary = summary
+        self.filename = None
+        self.history = []
+        self.edits = EditHistory()
+        self.view = {"where": {}, "sort": None, "descending": False}
+        # sequence number of the last label edit received from the browser
+        self.edit_seq = 0
+        # recorded with each save in the annotation log, and owns this session's journal entries
+        self.user = user
+        # (filename, files, ssins, annotations) of the night, read once per request
+        self._night = None
+
+        if state is not None:
+            self.restore(state)
+            return
+
         self.filenames = self._sorted_files()
         self.pointing_group = "p"
 
@@ -17,44 +54,251 @@ class Dataset:
             self.set_filename(self.filenames[0])
         self._set_goodness()
 
+    def snapshot(self):
+        return {
+            "filename": self.filename,
+            "pointing_group": self.pointing_group,
+            "length": len(self.annotations),
+            "starts": self.annotations._starts.tolist(),
+            "states": self.annotations._states.tolist(),
+            "history": self.history,
+            "view": self.view,
+            "edits": self.edits.state(),
+            "edit_seq": self.edit_seq,
+        }
+
+    def restore(self, state):
+        self.pointing_group = state["pointing_group"]
+        self.history = state.get("history", [])
+        self.view = state.get("view", self.view)
+        self.edit_seq = state.get("edit_seq", 0)
+        self.filenames = self._sorted_files(p=self.pointing_group)
+
+        # another session may have flagged the file good/bad since
+        filename = state["filename"]
+        candidates = [filename, f"bad_{filename}", _canonical(filename)]
+        current = next((f for f in candidates if f in self.filenames), None)
+        if current is None:
+            # still open even if the view filters it out
+            current = next((f for f in candidates if self._index.get(f) is not None), None)
+        if current is None:
+            if len(self.filenames) > 0:
+                self.set_filename(self.filenames[0])
+            self._set_goodness()
+            return
+
+        # the session's labels are used as they are, the file's stored or suggested ones are not needed
+        self._set_ssins(current)
+        if state["length"] == len(self.ssins):
+            self.annotations = AnnotationRuns(state["starts"], state["states"], state["length"])
+            self.edits = EditHistory(**state.get("edits", {}))
+        else:
+            self._initialize_annotations()
+            self.edits = EditHistory()
+        self._extract_metadata()
+        self._set_goodness()
+
     def _set_goodness(self):
         self.good = bool(self.filename) and not self.filename.startswith("bad_")
 
     def _set_ssins(self, filename):
         self.filename = filename
-        path = os.path.join(self._data_path, filename)
-        self.ssins = np.load(path)
+        self.ssins = self._storage.load_ssins(filename)
+
+    def _stored_annotations(self, filename, length):
+        """Journalled, saved or batch-suggested labels of a file, None if it has none."""
+        # this user's unexported work takes precedence, unless the night was exported since
+        journal = self._storage.journal
+        entry = journal.load(_canonical(filename)) if journal is not None else None
+        if entry is not None and entry[2] == length and entry[3] == (self.user or "") \
+                and entry[4] == self._annotation_base(filename):
+            return AnnotationRuns(*entry[:3])
+        annotations = self._storage.load_annotations(filename)
+        if annotations is not None:
+            return AnnotationRuns.from_dense(annotations)
+        # labels from an overnight `batch.py suggest` run
+        suggestion = self._storage.load_suggestion(filename)
+        if suggestion is not None and len(suggestion) == length:
+            return AnnotationRuns.from_dense(as_suggestion(suggestion))
+        return None
+
+    def _suggested_annotations(self, ssins, filename):
+        suggestion = self._suggester.suggest(ssins, filename) if self._suggester is not None else None
+        if suggestion is not None:
+            return AnnotationRuns.from_dense(as_suggestion(suggestion))
+        return AnnotationRuns.zeros(len(ssins))
 
     def _initialize_annotations(self, return_annotations=False):
-        annotation_file = os.path.join(self._annotation_path, self.filename)
-        if os.path.exists(annotation_file):
-            self.annotations = np.load(annotation_file)
-        else:
-            self.annotations = np.zeros_like(self.ssins)
+        self.annotations = self._stored_annotations(self.filename, len(self.ssins))
+        if self.annotations is None:
+            self.annotations = self._suggested_annotations(self.ssins, self.filename)
 
         if return_annotations:
             return self.annotations
 
     def _extract_metadata(self):
-        split = self.filename.split("_")
-        self.night = split[-2]
-        self.pointing = split[-1].split(".")[0][-1]
+        self.night, self.pointing = _parse_name(self.filename)
 
     def set_filename(self, new_filename):
         self._set_ssins(new_filename)
         self._initialize_annotations()
+        self.edits = EditHistory()
         self._extract_metadata()
         self._set_goodness()
 
-    def save_annotations(self):
-        self.save_path = os.path.join(self._annotation_path, self.filename)
-        np.save(self.save_path, self.annotations)
+    def save_annotations(self, wait=None):
+        """
+        Queue the annotations for writing. With `wait` (seconds), block until
+        they are written, raising if that failed, before the suggester learns
+        from them.
+        """
+        if self.annotations.count_suggested():
+            raise ValueError(f"{self.filename} still has suggested labels nobody reviewed")
+        # files keep the dtype of the raw series, as before run-length storage
+        dense = self.annotations.dense().astype(self.ssins.dtype)
+        self.save_path = self._storage.save_annotations(self.filename, dense, user=self.user)
+        if wait is not None:
+            self._storage.wait_saved(self.filename, wait)
+        if self._suggester is not None:
+            self._suggester.update(self.filename, self.ssins, dense)
         return self.save_path
+
+    def set_ranges(self, ranges, state):
+        """Label [start, stop) ranges with `state`, undoably."""
+        self.edits.set_ranges(self.annotations, ranges, state)
+
+    def accept_suggestions(self, ranges=None):
+        """Accept the suggested labels in [start, stop) ranges (default: the whole night), undoably."""
+        self.edits.accept(self.annotations, ranges or [(0, len(self.annotations))])
+
+    def undo(self):
+        """Revert the last edit of this night, returning the ranges it changed (None if none)."""
+        return self.edits.undo(self.annotations)
+
+    def redo(self):
+        return self.edits.redo(self.annotations)
+
+    def _annotation_base(self, filename):
+        return json.dumps(self._storage.annotation_stamp(filename))
+
+    def _journal(self, filename, annotations):
+        self._storage.journal.record(_canonical(filename), annotations, self.user or "",
+                                     self._annotation_base(filename))
+
+    def autosave(self):
+        """Journal the current, possibly incomplete, annotations."""
+        if self._storage.journal is not None:
+            self._journal(self.filename, self.annotations)
+
+    def flush(self):
+        """Wait for queued annotation writes to reach the disk."""
+        self._storage.writer.flush()
+
+    def prefetch(self, n=2):
+        """Load the n previous and n next files of the current list in the background."""
+        try:
+            idx = self.filenames.index(self.filename)
+        except ValueError:
+            return
+        neighbours = self.filenames[max(idx - n, 0):idx] + self.filenames[idx + 1:idx + 1 + n]
+        self._storage.prefetch(neighbours)
+
+    def cache_stats(self):
+        return self._storage.cache_stats()
+
+    def visit(self, filename, limit=50):
+        """Open `filename`, remembering the current file for `back`."""
+        self.history = (self.history + [_canonical(self.filename)])[-limit:]
+        self.set_filename(filename)
+
+    def back(self):
+        """Reopen the most recent file in the history that still exists, False if there is none."""
+        while self.history:
+            name = self.history.pop()
+            current = next((f for f in (name, f"bad_{name}") if f in self.filenames), None)
+            if current is not None:
+                self.set_filename(current)
+                return True
+        return False
     
+    def night_files(self):
+        """Every pointing of the current night, this file included, in pointing order."""
+        self._index.refresh()
+        return [r.filename for r in self._index.records() if r.night == self.night]
+
+    def load_night(self):
+        """
+        (filenames, raw series, labels) of every pointing of the current night.
+        The files are read concurrently by the storage's prefetch workers, once
+        for the lifetime of this Dataset (a request) unless the file changes.
+        """
+        if self._night is not None and self._night[0] == self.filename:
+            _, files, ssins, annotations = self._night
+        else:
+            files = self.night_files()
+            self._storage.prefetch([f for f in files if f != self.filename])
+            ssins, annotations = [], []
+            for f in files:
+                if f == self.filename:
+                    ssins.append(None)
+                    annotations.append(None)
+                    continue
+                x = self._storage.load_ssins(f)
+                ssins.append(x)
+                annotations.append(self._stored_annotations(f, len(x)) or self._suggested_annotations(x, f))
+            self._night = (self.filename, files, ssins, annotations)
+        # the current file's labels are the live ones
+        for i, f in enumerate(files):
+            if f == self.filename:
+                ssins[i], annotations[i] = self.ssins, self.annotations
+        return files, ssins, annotations
+
+    def propagate(self, ranges, state):
+        """
+        Label [start, stop) ranges with `state` in every pointing of the night,
+        as one masked assignment over their stacked labels. The edit of the
+        current file is undoable, the other pointings are journalled.
+        """
+        journal = self._storage.journal
+        if journal is None:
+            raise RuntimeError("Labelling every pointing needs the journal (JOURNAL = True)")
+
+        files, ssins, annotations = self.load_night()
+        lengths = [len(x) for x in ssins]
+        labels = np.zeros((len(files), max(lengths, default=0)), np.uint8)
+        for i, runs in enumerate(annotations):
+            labels[i, :lengths[i]] = runs.dense()
+        mask = np.zeros(labels.shape[1], bool)
+        for start, stop in ranges:
+            mask[start:stop] = True
+        inside = mask & (np.arange(labels.shape[1]) < np.array(lengths)[:, None])
+        changed = ((labels != state) & inside).any(axis=1)
+        labels[:, mask] = state
+
+        # only the pointings whose labels changed are journalled again
+        for i, (f, row, n) in enumerate(zip(files, labels, lengths)):
+            if f != self.filename and changed[i]:
+                annotations[i] = AnnotationRuns.from_dense(row[:n])
+                self._journal(f, annotations[i])
+        self.set_ranges([(start, min(stop, len(self.ssins))) for start, stop in ranges
+                         if start < len(self.ssins)], state)
+
     def set_pointing(self, pointing):
         self.filenames = self._sorted_files(p=pointing)
-        self.set_filename(self.filenames[0])
         self.pointing_group = pointing
+        if len(self.filenames) > 0:
+            self.set_filename(self.filenames[0])
+
+    def set_view(self, where=None, sort=None, descending=False):
+        """
+        Only list files whose summary values lie within `where` ({field: [low, high]}),
+        ordered by `sort`, e.g. set_view({"peaks": [1, None]}, sort="rms", descending=True).
+        """
+        self.view = {"where": where or {}, "sort": sort, "descending": bool(descending)}
+        self.set_pointing(self.pointing_group)
+
+    def _is_default_view(self):
+        return not self.view["where"] and self.view["sort"] is None
 
     def mark_bad(self):
         self.good = False
@@ -73,29 +317,21 @@ class Dataset:
         if new_base == old_base:
             return
 
-        old_data = Path(self._data_path) / old_base
-        new_data = Path(self._data_path) / new_base
-        old_ann  = Path(self._annotation_path) / old_base
-        new_ann  = Path(self._annotation_path) / new_base
-
-        # data file
-        new_data.parent.mkdir(parents=True, exist_ok=True)
-        os.replace(old_data, new_data)
-
-        # annotation file (if present)
-        if old_ann.exists():
-            new_ann.parent.mkdir(parents=True, exist_ok=True)
-            os.replace(old_ann, new_ann)
-
+        self._storage.rename(old_base, new_base)
         self.filename = new_base
-        self.filenames = self._sorted_files()
+        self.filenames = self._sorted_files(p=self.pointing_group)
 
     def count_bad(self):
         return sum(1 for f in self.filenames if f.startswith("bad_"))
     
     def count_annotations(self, p="p"):
-        p_annot = [f for f in os.listdir(self._annotation_path) if p in f]
-        return len(p_annot)
+        self._index.refresh()
+        return self._index.count_annotated(p)
+
+    def records(self, p="p"):
+        """Index records (night, pointing, bad and annotated flags) of a pointing group."""
+        self._index.refresh()
+        return self._index.records(p)
 
     def get_n(self):
         return len(self.filenames)
@@ -104,13 +340,14 @@ class Dataset:
         return self._initialize_annotations(return_annotations=True)
     
     def _canonical(self, name):
-        return name[4:] if name.startswith("bad_") else name
+        return _canonical(name)
 
     def _sorted_files(self, p=""):
-        files = [f for f in os.listdir(self._data_path)
-                if f.endswith(".npy") and (Path(self._data_path)/f).is_file() and p in f]
-        # sort by canonical name, with good first then bad (stable)
-        return sorted(files, key=lambda f: (self._canonical(f), f.startswith("bad_")))
+        self._index.refresh()
+        filenames = self._index.filenames(p)
+        if self._summary is None or self._is_default_view():
+            return filenames
+        return self._summary.select(filenames, self.view["where"], self.view["sort"], self.view["descending"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+# Memory-mapped series are scanned in blocks of this many samples so only a
+# bounded window is resident at a time
+CHUNK = 1 << 20
+
+
+def minmax_indices(y, start=0, stop=None, n_out=5000):
+    """
+    Indices of a min-max decimation of y[start:stop] to at most ~n_out points.
+
+    The window is cut into n_out // 2 buckets and the positions of each
+    bucket's minimum and maximum are kept, so peaks survive the decimation.
+    Windows that already fit in n_out are returned at full resolution.
+    """
+    n = len(y)
+    start = max(0, int(start))
+    stop = n if stop is None else min(n, int(stop))
+    if stop - start <= n_out:
+        return np.arange(start, stop)
+
+    bucket = -(-(stop - start) // max(n_out // 2, 1))
+    n_full = (stop - start) // bucket
+    end_full = start + n_full * bucket
+
+    parts = [[start, stop - 1]]
+    per_chunk = max(CHUNK // bucket, 1)
+    for b0 in range(0, n_full, per_chunk):
+        b1 = min(b0 + per_chunk, n_full)
+        lo = start + b0 * bucket
+        seg = np.asarray(y[lo:start + b1 * bucket]).reshape(b1 - b0, bucket)
+        offsets = lo + np.arange(b1 - b0) * bucket
+        parts += [offsets + seg.argmin(axis=1), offsets + seg.argmax(axis=1)]
+
+    if end_full < stop:
+        tail = np.asarray(y[end_full:stop])
+        parts.append([end_full + tail.argmin(), end_full + tail.argmax()])
+
+    return np.unique(np.concatenate(parts))
+
+
+def box_indices(y, x_range, y_range):
+    """Indices of y whose (index, value) fall inside a box selection."""
+    x0, x1 = sorted(x_range)
+    lo = max(0, int(np.ceil(x0)))
+    hi = min(len(y), int(np.floor(x1)) + 1)
+    if hi <= lo:
+        return np.arange(0)
+    y0, y1 = sorted(y_range)
+    parts = []
+    for c in range(lo, hi, CHUNK):
+        window = np.asarray(y[c:min(c + CHUNK, hi)])
+        parts.append(c + np.flatnonzero((window >= y0) & (window <= y1)))
+    return np.concatenate(parts)
+
+
+def lasso_indices(y, lasso_x, lasso_y):
+    """Indices of y whose (index, value) fall inside a lasso polygon."""
+    from matplotlib.path import Path
+
+    poly = np.column_stack([lasso_x, lasso_y])
+    lo = max(0, int(np.ceil(poly[:, 0].min())))
+    hi = min(len(y), int(np.floor(poly[:, 0].max())) + 1)
+    if hi <= lo:
+        return np.arange(0)
+    path = Path(poly)
+    parts = []
+    for c in range(lo, hi, CHUNK):
+        idx = np.arange(c, min(c + CHUNK, hi))
+        parts.append(idx[path.contains_points(np.column_stack([idx, y[idx[0]:idx[-1] + 1]]))])
+    return np.concatenate(parts)
@@ -0,0 +1,342 @@
+import json
+import logging
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+
+from storage import _canonical
+from writer import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Clean, RFI-Rising, RFI-Decaying, Blip; stored labels are 1..N_STATES, 0 is unlabelled
+N_STATES = 4
+MIN_VARIANCE = 1e-6
+
+
+def _logsumexp(a, axis):
+    m = np.max(a, axis=axis, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0.0)
+    return np.squeeze(m, axis) + np.log(np.sum(np.exp(a - m), axis=axis))
+
+
+def _pad(sequences):
+    """Stack 1-D sequences into a (B, T) batch with their lengths."""
+    lengths = np.array([len(s) for s in sequences], dtype=np.intp)
+    batch = np.zeros((len(sequences), lengths.max() if len(lengths) else 0))
+    for b, s in enumerate(sequences):
+        batch[b, :len(s)] = s
+    return batch, lengths
+
+
+def _maxplus(a, b):
+    """Max-plus products of stacks of (K, K) matrices, one pass per state instead of a (K, K, K) temporary."""
+    out = a[..., :, 0, None] + b[..., None, 0, :]
+    for m in range(1, a.shape[-1]):
+        np.maximum(out, a[..., :, m, None] + b[..., None, m, :], out=out)
+    return out
+
+
+def viterbi_path(log_pi, log_A, log_B, chunk=None):
+    """
+    Most likely state path (0..K-1) for (T, K) log emissions.
+
+    A step of the recursion is a max-plus product with log_A + log_B[t], which
+    is associative, so the steps are cut into chunks of ~sqrt(T): each chunk's
+    product and then its back-pointers are computed for all chunks at once,
+    and only the K scores entering each chunk are carried one chunk after the
+    other. Python loops over ~sqrt(T) steps rather than T.
+    """
+    T, K = log_B.shape
+    if T == 0:
+        return np.zeros(0, np.intp)
+    n = T - 1
+    L = chunk or max(int(np.sqrt(4 * n)), 1)
+    C = max(-(-n // L), 1)
+    pad = C * L - n
+    B = np.concatenate([log_B[1:], np.zeros((pad, K))]).reshape(C, L, K)
+    # the padding at the end of the last chunk leaves the scores as they are
+    identity = np.where(np.eye(K, dtype=bool), 0.0, -np.inf)
+
+    def step(l):
+        M = log_A + B[:, l, None, :]
+        if l >= L - pad:
+            M[-1] = identity
+        return M
+
+    P = step(0)
+    for l in range(1, L):
+        P = _maxplus(P, step(l))
+
+    entry = np.empty((C, K))
+    d = log_pi + log_B[0]
+    for c in range(C):
+        entry[c] = d
+        d = (d[:, None] + P[c]).max(axis=0)
+
+    psi = np.empty((C, L, K), dtype=np.intp)
+    d = entry
+    for l in range(L):
+        scores = d[:, :, None] + step(l)
+        psi[:, l] = scores.argmax(axis=1)
+        d = np.take_along_axis(scores, psi[:, l, None, :], axis=1)[:, 0]
+
+    # the state at every step of a chunk for each state it could end in, then
+    # the chunks' end states from the last one back
+    states = np.empty((C, L, K), dtype=np.intp)
+    cur = np.tile(np.arange(K), (C, 1))
+    for l in range(L - 1, -1, -1):
+        states[:, l] = cur
+        cur = np.take_along_axis(psi[:, l], cur, axis=1)
+    end = np.empty(C, dtype=np.intp)
+    k = d[-1].argmax()
+    for c in range(C - 1, -1, -1):
+        end[c] = k
+        k = cur[c, k]
+    path = np.take_along_axis(states, end[:, None, None], axis=2)[..., 0].ravel()[:n]
+    return np.r_[k, path]
+
+
+def sequence_stats(x, labels, k=N_STATES):
+    """
+    Sufficient statistics of one labelled sequence as a flat vector:
+    start counts (k), transition counts (k*k), and per state the count, sum
+    and sum of squares of the emissions (3k). Unlabelled points, and states
+    above k (unreviewed suggestions, annotations.SUGGESTED), are skipped.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    s = np.asarray(labels).astype(np.intp) - 1
+    valid = (s >= 0) & (s < k) & np.isfinite(x)
+
+    start = np.zeros(k)
+    if len(s) and valid[0]:
+        start[s[0]] = 1
+
+    pairs = valid[:-1] & valid[1:]
+    trans = np.bincount(s[:-1][pairs] * k + s[1:][pairs], minlength=k * k).astype(np.float64)
+
+    sv, xv = s[valid], x[valid]
+    n = np.bincount(sv, minlength=k).astype(np.float64)
+    s1 = np.bincount(sv, weights=xv, minlength=k)
+    s2 = np.bincount(sv, weights=xv * xv, minlength=k)
+    return np.concatenate([start, trans, n, s1, s2])
+
+
+class GaussianHMM:
+    """
+    HMM with one Gaussian emission per state, evaluated in log space.
+    Posteriors are vectorised over states and over a batch of padded
+    sequences, so the only Python loop is over time steps; Viterbi paths are
+    computed in chunks (see viterbi_path).
+    """
+
+    def __init__(self, log_pi, log_A, means, variances):
+        self.log_pi = np.asarray(log_pi)
+        self.log_A = np.asarray(log_A)
+        self.means = np.asarray(means)
+        self.variances = np.asarray(variances)
+
+    @classmethod
+    def from_stats(cls, stats, k=N_STATES):
+        """Maximum-likelihood parameters (with add-one smoothing) from summed sequence_stats."""
+        start = stats[:k]
+        trans = stats[k:k + k * k].reshape(k, k)
+        n, s1, s2 = stats[k + k * k:].reshape(3, k)
+
+        pi = (start + 1) / (start.sum() + k)
+        A = (trans + 1) / (trans.sum(axis=1, keepdims=True) + k)
+
+        total = max(n.sum(), 1.0)
+        global_mean = s1.sum() / total
+        global_var = max(s2.sum() / total - global_mean ** 2, MIN_VARIANCE)
+        safe_n = np.maximum(n, 1)
+        means = np.where(n > 0, s1 / safe_n, global_mean)
+        variances = np.where(n > 1, s2 / safe_n - means ** 2, global_var)
+        return cls(np.log(pi), np.log(A), means, np.maximum(variances, MIN_VARIANCE))
+
+    def log_emissions(self, x):
+        """(..., T) observations to (..., T, K) log densities; non-finite points carry no evidence."""
+        x = np.asarray(x, dtype=np.float64)[..., None]
+        logp = -0.5 * (np.log(2 * np.pi * self.variances) + (x - self.means) ** 2 / self.variances)
+        return np.where(np.isfinite(x), logp, 0.0)
+
+    def viterbi_batch(self, sequences):
+        """Most likely state path (labels 1..K) of each sequence."""
+        return [(viterbi_path(self.log_pi, self.log_A, self.log_emissions(x)) + 1).astype(np.uint8)
+                for x in sequences]
+
+    def viterbi(self, x):
+        return self.viterbi_batch([x])[0]
+
+    def posteriors_batch(self, sequences):
+        """Per-step state posteriors (T, K) and log-likelihood of each sequence."""
+        x, lengths = _pad(sequences)
+        log_B = self.log_emissions(x)
+        B, T, K = log_B.shape
+        if T == 0:
+            return [np.zeros((0, K)) for _ in sequences], np.zeros(B)
+
+        # padded steps carry no evidence, so they leave alpha and beta unchanged in mass
+        step = np.arange(T) < lengths[:, None]
+        log_B = np.where(step[..., None], log_B, 0.0)
+
+        log_alpha = np.empty((B, T, K))
+        log_alpha[:, 0] = self.log_pi + log_B[:, 0]
+        for t in range(1, T):
+            log_alpha[:, t] = _logsumexp(log_alpha[:, t - 1, :, None] + self.log_A, axis=1) + log_B[:, t]
+
+        log_beta = np.zeros((B, T, K))
+        for t in range(T - 2, -1, -1):
+            log_beta[:, t] = _logsumexp(self.log_A + (log_B[:, t + 1] + log_beta[:, t + 1])[:, None, :], axis=2)
+
+        loglik = _logsumexp(log_alpha[:, T - 1], axis=1)
+        gamma = np.exp(log_alpha + log_beta - loglik[:, None, None])
+        return [gamma[b, :lengths[b]] for b in range(B)], loglik
+
+    def posteriors(self, x):
+        gamma, loglik = self.posteriors_batch([x])
+        return gamma[0], loglik[0]
+
+
+class HMMSuggester:
+    """
+    Keeps a GaussianHMM fitted to every saved annotation of a storage backend.
+
+    Per-file sufficient statistics are cached in `path`/hmm_model.npz together
+    with the storage's stamp (mtime and size, or archive row) of the
+    annotations they came from, so a restart only reads files that changed,
+    and each export updates the model in place. The suggestions of the last
+    few nights are kept until their raw data or the model changes.
+    """
+
+    FILENAME = "hmm_model.npz"
+    SUGGESTIONS = 16
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._cache_file = os.path.join(storage.path, self.FILENAME)
+        self._stats = {}
+        self._stamps = {}
+        self._total = np.zeros(N_STATES + N_STATES * N_STATES + 3 * N_STATES)
+        self._lock = threading.Lock()
+        self._suggestions = OrderedDict()
+        self.model = None
+        self.version = 0
+        self.ready = threading.Event()
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with np.load(self._cache_file) as f:
+                names, stamps, stats = f["names"], f["stamps"], f["stats"]
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        if stats.shape[1:] != self._total.shape:
+            return
+        for name, stamp, row in zip(names.tolist(), stamps.tolist(), stats):
+            self._stats[name] = row
+            self._stamps[name] = stamp
+        self._refit()
+
+    def _save_cache(self):
+        names = list(self._stats)
+        snapshot = (np.array(names), np.array([self._stamps[n] for n in names]),
+                    np.array([self._stats[n] for n in names]).reshape(len(names), -1))
+
+        def write(path, value):
+            names, stamps, stats = value
+            atomic_write(path, lambda f: np.savez(f, names=names, stamps=stamps, stats=stats))
+
+        self._storage.index_writer.submit(self._cache_file, write, snapshot)
+
+    def _refit(self, total=None):
+        if total is None:
+            total = np.sum(list(self._stats.values()), axis=0) if self._stats else np.zeros_like(self._total)
+        self._total = total
+        has_labels = self._total[N_STATES + N_STATES * N_STATES:][:N_STATES].sum() > 0
+        self.model = GaussianHMM.from_stats(self._total) if has_labels else None
+        self.version += 1
+
+    def _stamp(self, filename):
+        return json.dumps(self._storage.annotation_stamp(filename))
+
+    def fit(self):
+        """Bring the statistics up to date with every annotated file in storage."""
+        self._storage.index.refresh()
+        changed = False
+        seen = set()
+        for rec in self._storage.index.records():
+            if not rec.annotated:
+                continue
+            seen.add(rec.canonical)
+            stamp = self._stamp(rec.filename)
+            if self._stamps.get(rec.canonical) == stamp:
+                continue
+            labels = self._storage.load_annotations(rec.filename)
+            if labels is None:
+                continue
+            stats = sequence_stats(self._storage.load_ssins(rec.filename), labels)
+            with self._lock:
+                self._stats[rec.canonical] = stats
+                self._stamps[rec.canonical] = stamp
+            changed = True
+
+        with self._lock:
+            for name in set(self._stats) - seen:
+                del self._stats[name], self._stamps[name]
+                changed = True
+            if changed:
+                self._refit()
+                self._save_cache()
+        return changed
+
+    def start(self):
+        """Run `fit` in a background thread, suggestions use the cached model meanwhile."""
+        def run():
+            try:
+                self.fit()
+            except Exception:
+                logger.exception("Fitting the HMM suggester failed")
+            finally:
+                self.ready.set()
+        threading.Thread(target=run, name="hmm-fit", daemon=True).start()
+
+    def update(self, filename, ssins, labels):
+        """Replace one file's contribution after its annotations were saved."""
+        stats = sequence_stats(ssins, labels)
+        # a save still queued leaves the old stamp, the next fit then reads the file again
+        stamp = self._stamp(filename)
+        name = _canonical(filename)
+        with self._lock:
+            old = self._stats.get(name, 0)
+            self._stats[name] = stats
+            self._stamps[name] = stamp
+            self._refit(self._total - old + stats)
+            self._save_cache()
+
+    def suggest(self, ssins, filename=None):
+        """
+        Viterbi labels (1..4) for a series, or None before any annotation exists.
+        Given the `filename` of the series, the labels are cached.
+        """
+        # the version is read first, a refit in between then only misses the cache
+        version, model = self.version, self.model
+        if model is None or len(ssins) == 0:
+            return None
+        key = None
+        if filename is not None:
+            key = (_canonical(filename), json.dumps(self._storage.raw_stamp(filename)), version)
+            with self._lock:
+                labels = self._suggestions.get(key)
+                if labels is not None:
+                    self._suggestions.move_to_end(key)
+                    return labels
+        labels = model.viterbi(ssins)
+        labels.flags.writeable = False
+        if key is not None:
+            with self._lock:
+                self._suggestions[key] = labels
+                while len(self._suggestions) > self.SUGGESTIONS:
+                    self._suggestions.popitem(last=False)
+        return labels
@@ -0,0 +1,203 @@
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ("session", "load", "compute", "build", "serialize")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+class Registry:
+    """
+    Counters, gauges and histograms rendered in the Prometheus text format.
+    Collectors are called on every scrape to refresh values read from
+    elsewhere, such as cache statistics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = defaultdict(dict)
+        self._histograms = defaultdict(dict)
+        self._collectors = []
+
+    def describe(self, name, kind, help):
+        self._meta[name] = (kind, help)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = self._values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            h = self._histograms[name].get(key)
+            if h is None:
+                h = self._histograms[name][key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect(self)
+            except Exception:
+                logger.exception("Metrics collector failed")
+
+        lines = []
+        with self._lock:
+            for name in sorted(self._values.keys() | self._histograms.keys()):
+                kind, help = self._meta.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f"{name}{_labels(key)} {value}")
+                for key, (counts, total, n) in sorted(self._histograms.get(name, {}).items()):
+                    for bound, count in zip(BUCKETS, counts):
+                        lines.append(f"{name}_bucket{_labels(key, le=bound)} {count}")
+                    lines.append(f"{name}_bucket{_labels(key, le='+Inf')} {n}")
+                    lines.append(f"{name}_sum{_labels(key)} {total}")
+                    lines.append(f"{name}_count{_labels(key)} {n}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("annotator_callback_seconds", "histogram", "Callback latency, including Dash serialization.")
+registry.describe("annotator_callback_phase_seconds_total", "counter",
+                  "Time spent per callback in each phase: session, load, compute, build, serialize.")
+registry.describe("annotator_slow_callbacks_total", "counter", "Callbacks slower than SLOW_CALLBACK_MS.")
+registry.describe("annotator_files_total", "counter", "Files annotated, rejected or accepted, per authenticated user.")
+
+# Callbacks run on the thread serving their request, so per-request timing is thread-local
+_local = threading.local()
+_slow_ms = None
+
+
+@contextmanager
+def phase(name):
+    """
+    Charge the time spent in the block to phase `name` of the running callback.
+    Phases nest exclusively: an inner phase pauses the outer one, so the
+    phases of a callback add up to its total time.
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        yield
+        return
+    now = time.perf_counter()
+    parent = stack[-1]
+    _local.phases[parent[0]] += now - parent[1]
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        current, start = stack.pop()
+        _local.phases[current] += now - start
+        stack[-1][1] = now
+
+
+def timed(name):
+    """Decorator form of `phase`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_file(action, user=None):
+    """
+    Count a file `action` ("annotated", "rejected", "accepted") by `user`.
+    Only pass users the server authenticated, anything per session makes a new series every visit.
+    """
+    registry.inc("annotator_files_total", action=action, user=user or "")
+
+
+@contextmanager
+def callback(name):
+    """Time one callback; inside a request the totals are recorded once the response is serialized."""
+    _local.stack = [["compute", time.perf_counter()]]
+    _local.phases = defaultdict(float)
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        current, start = _local.stack.pop()
+        _local.phases[current] += now - start
+        phases, _local.phases, _local.stack = _local.phases, None, None
+        if getattr(_local, "request_start", None) is not None:
+            _local.callback = (name, phases, now)
+        else:
+            _record(name, phases)
+
+
+def _record(name, phases):
+    total = sum(phases.values())
+    registry.observe("annotator_callback_seconds", total, callback=name)
+    for p, seconds in phases.items():
+        registry.inc("annotator_callback_phase_seconds_total", seconds, callback=name, phase=p)
+
+    if _slow_ms is not None and 1e3 * total >= _slow_ms:
+        registry.inc("annotator_slow_callbacks_total", callback=name)
+        logger.warning("Slow callback %s: %.0f ms (%s)", name, 1e3 * total,
+                       ", ".join(f"{p} {1e3 * phases.get(p, 0.0):.0f} ms" for p in PHASES))
+
+
+def init_app(server, slow_ms=None):
+    """
+    Serve `registry` at /metrics on a Flask server and time the callback
+    requests it handles, logging those that take `slow_ms` or longer.
+    """
+    global _slow_ms
+    from flask import Response
+
+    _slow_ms = slow_ms
+
+    @server.before_request
+    def _start():
+        _local.request_start = time.perf_counter()
+        _local.callback = None
+
+    @server.after_request
+    def _finish(response):
+        done = getattr(_local, "callback", None)
+        _local.request_start = _local.callback = None
+        if done is not None:
+            name, phases, finished = done
+            # Dash turns the callback's return value into JSON after it returns
+            phases["serialize"] += time.perf_counter() - finished
+            _record(name, phases)
+        return response
+
+    @server.route("/metrics")
+    def _metrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
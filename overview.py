@@ -0,0 +1,62 @@
+import base64
+import io
+import numpy as np
+
+# RGB of states 0 (unlabelled) to 4, in the order of the annotation buttons
+STATE_COLORS = np.array([
+    [200, 200, 200],
+    [31, 119, 180],
+    [214, 39, 40],
+    [255, 127, 14],
+    [148, 103, 189],
+], dtype=np.uint8)
+
+# amplitude levels, so that levels x states still fits an 8-bit palette
+LEVELS = 51
+
+
+def _palette(mode):
+    # matplotlib and PIL are only imported once an overview is drawn, they slow down startup
+    from matplotlib import colormaps
+    ramp = colormaps["viridis"](np.linspace(0, 1, LEVELS))[:, :3] * 255
+    if mode == "states":
+        return STATE_COLORS
+    if mode == "both":
+        return (0.5 * ramp[None, :, :] + 0.5 * STATE_COLORS[:, None, :]).reshape(-1, 3)
+    return ramp
+
+
+def amplitude_levels(values, clip=99.0):
+    """(n, width) thumbnails to 0..LEVELS-1 on a shared [1st, `clip`th] percentile scale."""
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return np.zeros(values.shape, np.uint8)
+    # a sample is enough for the scale, keeps this fast for 10k nights
+    sample = finite[::max(len(finite) // 100_000, 1)]
+    low, high = np.percentile(sample, [1.0, clip])
+    scaled = np.clip((values - low) / max(high - low, 1e-12), 0, 1)
+    return np.nan_to_num(scaled * (LEVELS - 1), nan=0).astype(np.uint8)
+
+
+def render(values, states, mode="amplitude"):
+    """
+    One row per night as a palette image: "amplitude", "states", or "both"
+    (state colours blended over the amplitude). Pixels index into an 8-bit
+    palette, a third of the size of RGB to encode and send.
+    """
+    if mode == "states":
+        pixels = states
+    elif mode == "both":
+        pixels = states * LEVELS + amplitude_levels(values)
+    else:
+        pixels = amplitude_levels(values)
+    from PIL import Image
+    image = Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8), mode="P")
+    image.putpalette(_palette(mode).astype(np.uint8).ravel().tolist())
+    return image
+
+
+def to_png_uri(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG", compress_level=1)
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
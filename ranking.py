@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import logging
+import numpy as np
+import threading
+
+from storage import _canonical
+
+logger = logging.getLogger(__name__)
+
+
+def mean_entropy(gamma):
+    """Average per-step entropy (nats) of (T, K) state posteriors."""
+    if len(gamma) == 0:
+        return 0.0
+    p = np.clip(gamma, 1e-12, 1.0)
+    return float(-(p * np.log(p)).sum(axis=1).mean())
+
+
+def drift(old, new):
+    """
+    How far HMM `new` moved from `old`: the largest change of a state mean
+    (in old standard deviations), of a log variance or of a log transition
+    probability.
+    """
+    return max(np.max(np.abs(new.means - old.means) / np.sqrt(old.variances)),
+               np.max(np.abs(np.log(new.variances / old.variances))),
+               np.max(np.abs(new.log_A - old.log_A)))
+
+
+class UncertaintyQueue:
+    """
+    Unannotated files ordered by how unsure the HMM suggester is about them
+    (mean posterior entropy), most uncertain first.
+
+    Scores live in a heap with lazy invalidation: saving a file only drops its
+    entry. The queue scores with its own copy of the suggester's model, which
+    every export refits, and only takes the newer one after `refit_every`
+    refits or once it has drifted more than `max_drift` (see `drift`). Then a
+    background thread (see `start`) rescores the old entries in batches, most
+    uncertain first, and `next` rescores at most `rescore_per_call` of them
+    itself, taking the older scores of the rest meanwhile. Files `add`ed are
+    scored by the same thread.
+    """
+
+    def __init__(self, storage, suggester, batch=32, rescore_per_call=2, refit_every=50, max_drift=0.1):
+        self._storage = storage
+        self._suggester = suggester
+        self._batch = batch
+        self.rescore_per_call = rescore_per_call
+        self.refit_every = refit_every
+        self.max_drift = max_drift
+        # the model scores come from, its version here and the suggester's version it was taken at
+        self._model = None
+        self.version = 0
+        self._taken_at = None
+        self._heap = []
+        self._live = {}
+        self._added = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def _sync(self):
+        """Take the suggester's model if it is the first, or enough refits or drift ago, True if so."""
+        version, model = self._suggester.version, self._suggester.model
+        if model is None or version == self._taken_at:
+            return False
+        with self._lock:
+            if self._model is not None and version - self._taken_at < self.refit_every \
+                    and drift(self._model, model) <= self.max_drift:
+                return False
+            self._model, self._taken_at = model, version
+            self.version += 1
+        self._wake.set()
+        return True
+
+    def _score(self, filenames):
+        with self._lock:
+            version, model = self.version, self._model
+        if model is None or not filenames:
+            return
+        seqs = [np.asarray(self._storage.load_ssins(f)) for f in filenames]
+        gammas, _ = model.posteriors_batch(seqs)
+        with self._lock:
+            for f, gamma in zip(filenames, gammas):
+                token = next(self._counter)
+                self._live[_canonical(f)] = token
+                heapq.heappush(self._heap, (-mean_entropy(gamma), token, _canonical(f), version))
+
+    def rank_all(self):
+        """Score every unannotated file that is not queued yet."""
+        self._sync()
+        self._storage.index.refresh()
+        todo = [r.filename for r in self._storage.index.records()
+                if not r.annotated and not r.bad and r.canonical not in self._live]
+        for i in range(0, len(todo), self._batch):
+            self._score(todo[i:i + self._batch])
+
+    def _rescore(self):
+        """Rescore the entries of older models, most uncertain first, until the model changes again."""
+        version = self.version
+        with self._lock:
+            stale = sorted(e for e in self._heap if e[3] != version and self._live.get(e[2]) == e[1])
+        for i in range(0, len(stale), self._batch):
+            if self.version != version:
+                # a newer model, the next round starts over from the top
+                self._wake.set()
+                return
+            filenames = []
+            for _, _, name, _ in stale[i:i + self._batch]:
+                rec = self._record(name)
+                if rec is None or rec.annotated or rec.bad:
+                    self.discard(name)
+                else:
+                    filenames.append(rec.filename)
+            self._score(filenames)
+
+    def start(self):
+        """Rank in a background thread once the suggester's first fit is done, then keep the ranks current."""
+        def run():
+            self._suggester.ready.wait()
+            try:
+                self.rank_all()
+            except Exception:
+                logger.exception("Ranking files by uncertainty failed")
+            while True:
+                self._wake.wait()
+                self._wake.clear()
+                with self._lock:
+                    added, self._added = self._added, []
+                added = [r.filename for r in map(self._record, map(_canonical, added))
+                         if r is not None and not r.annotated and not r.bad]
+                try:
+                    for i in range(0, len(added), self._batch):
+                        self._score(added[i:i + self._batch])
+                    self._rescore()
+                except Exception:
+                    logger.exception("Updating the uncertainty ranks failed")
+        threading.Thread(target=run, name="uncertainty-rank", daemon=True).start()
+
+    def add(self, filename):
+        """Queue a file (new, or accepted again) to be scored in the background."""
+        with self._lock:
+            self._added.append(filename)
+        self._wake.set()
+
+    def discard(self, filename):
+        with self._lock:
+            self._live.pop(_canonical(filename), None)
+
+    def _record(self, name):
+        index = self._storage.index
+        return index.get(name) or index.get(f"bad_{name}")
+
+    def next(self, p="p", exclude=()):
+        """Filename of the most uncertain unannotated good file in pointing group `p`, or None."""
+        exclude = {_canonical(f) for f in exclude}
+        skipped = []
+        found = None
+        rescored = 0
+        self._sync()
+        while True:
+            with self._lock:
+                if not self._heap:
+                    break
+                entry = heapq.heappop(self._heap)
+                _, token, name, version = entry
+                if self._live.get(name) != token:
+                    continue
+
+            rec = self._record(name)
+            if rec is None or rec.annotated or rec.bad:
+                self.discard(name)
+                continue
+            if version != self.version:
+                self._wake.set()
+                if rescored < self.rescore_per_call:
+                    # scored with an older model, rescore and let it find its new place
+                    rescored += 1
+                    self._score([rec.filename])
+                    continue
+            skipped.append(entry)
+            if name not in exclude and (len(p) < 2 or rec.pointing == p[1:]):
+                found = rec.filename
+                break
+
+        with self._lock:
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+        return found
+
+    def __len__(self):
+        return len(self._live)
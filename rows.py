@@ -0,0 +1,91 @@
+import logging
+import numpy as np
+import os
+import threading
+
+from writer import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class FileRows:
+    """
+    Base of the indexes that keep one row per file of a storage, keyed by
+    canonical name, recompute a row only when the file's raw or annotation
+    stamp changes, and cache the table in `path`/FILENAME.
+
+    Subclasses set FILENAME and implement `_update(rec)` (recompute one
+    file's row if it is stale, True if it changed), `_load_cache()` and
+    `_snapshot()`, the arrays saved with np.savez. `_invalidate` is called
+    under the lock whenever rows are dropped.
+    """
+
+    FILENAME = None
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._cache_file = os.path.join(storage.path, self.FILENAME)
+        self._rows = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _invalidate(self):
+        pass
+
+    def _save_cache(self):
+        def write(path, value):
+            atomic_write(path, lambda f: np.savez(f, **value))
+
+        self._storage.index_writer.submit(self._cache_file, write, self._snapshot())
+
+    def refresh(self):
+        """Bring every row up to date with storage and drop removed files, returns the number recomputed."""
+        with self._refresh_lock:
+            self._storage.index.refresh()
+            records = self._storage.index.records()
+            changed = 0
+            for rec in records:
+                try:
+                    changed += self._update(rec)
+                except FileNotFoundError:
+                    continue
+
+            seen = {rec.canonical for rec in records}
+            with self._lock:
+                gone = set(self._rows) - seen
+                for name in gone:
+                    del self._rows[name]
+                if gone:
+                    self._invalidate()
+            if changed or gone:
+                self._save_cache()
+            return changed
+
+    def update(self, filenames):
+        """Bring the rows of some files up to date, e.g. nights that just arrived, returns how many changed."""
+        with self._refresh_lock:
+            changed = 0
+            for filename in filenames:
+                rec = self._storage.index.get(filename)
+                if rec is None:
+                    continue
+                try:
+                    changed += self._update(rec)
+                except FileNotFoundError:
+                    continue
+            if changed:
+                self._save_cache()
+            return changed
+
+    def start(self):
+        """Run `refresh` in a background thread."""
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Building %s failed", self.FILENAME)
+        threading.Thread(target=run, name=os.path.splitext(self.FILENAME)[0], daemon=True).start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
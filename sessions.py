@@ -0,0 +1,203 @@
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class MemorySessionStore:
+    """
+    In-process LRU of session states. Only suitable for a single worker,
+    use a file or SQLite store when running several.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            state = self._states.get(sid)
+            if state is not None:
+                self._states.move_to_end(sid)
+            return state
+
+    def set(self, sid, state):
+        with self._lock:
+            self._states[sid] = state
+            self._states.move_to_end(sid)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._states.pop(sid, None)
+
+    def lock(self, sid):
+        # a single worker, the app's own lock is enough
+        return contextlib.nullcontext()
+
+
+class FileSessionStore:
+    """
+    One JSON file per session in a local directory, shared by all workers.
+    `lock` holds an flock on the session's .lock file. Sessions not written
+    for `ttl` seconds are deleted, checked at most every `prune_every` seconds.
+    """
+
+    def __init__(self, path, ttl=None, prune_every=60.0):
+        self._path = os.path.abspath(path)
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._pruned = 0.0
+        os.makedirs(self._path, exist_ok=True)
+
+    def _file(self, sid, suffix=".json"):
+        # session ids are uuid hex strings, anything else is rejected
+        if not sid.isalnum():
+            raise ValueError(f"Invalid session id {sid!r}")
+        return os.path.join(self._path, f"{sid}{suffix}")
+
+    def get(self, sid):
+        try:
+            with open(self._file(sid)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def set(self, sid, state):
+        path = self._file(sid)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+        self._prune()
+
+    def _prune(self):
+        now = time.time()
+        if self.ttl is None or now - self._pruned < self.prune_every:
+            return
+        self._pruned = now
+        with os.scandir(self._path) as it:
+            for e in it:
+                if e.name.endswith(".json") and now - e.stat().st_mtime > self.ttl:
+                    self.delete(e.name[:-len(".json")])
+
+    def delete(self, sid):
+        for suffix in (".json", ".lock"):
+            try:
+                os.remove(self._file(sid, suffix))
+            except FileNotFoundError:
+                pass
+
+    @contextlib.contextmanager
+    def lock(self, sid):
+        """Hold the session against every other worker on the host."""
+        with open(self._file(sid, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SQLiteSessionStore:
+    """
+    Session states in a SQLite table, shared by all workers on the host.
+    `lock` takes a lease on the session's row, so a worker that died holding
+    it only blocks the session for `lease` seconds. Sessions not written for
+    `ttl` seconds are deleted, checked at most every `prune_every` seconds.
+    """
+
+    def __init__(self, path, ttl=None, prune_every=60.0, lease=30.0, poll=0.005):
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._pruned = 0.0
+        self.lease = lease
+        self.poll = poll
+        self._path = os.path.abspath(path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "sid TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                "updated REAL NOT NULL DEFAULT (julianday('now')))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_locks ("
+                "sid TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = self._connect().execute("SELECT state FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, sid, state):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, state, updated) VALUES (?, ?, julianday('now'))",
+                (sid, json.dumps(state)),
+            )
+        self._prune()
+
+    def _prune(self):
+        now = time.time()
+        if self.ttl is None or now - self._pruned < self.prune_every:
+            return
+        self._pruned = now
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE updated < julianday('now') - ?", (self.ttl / 86400,))
+            conn.execute("DELETE FROM session_locks WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def _acquire(self, sid, token):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM session_locks WHERE sid = ? AND expires < ?", (sid, now))
+            cur = conn.execute("INSERT OR IGNORE INTO session_locks (sid, token, expires) VALUES (?, ?, ?)",
+                               (sid, token, now + self.lease))
+            return cur.rowcount == 1
+
+    @contextlib.contextmanager
+    def lock(self, sid):
+        """Hold the session against every other worker on the host."""
+        token = uuid.uuid4().hex
+        while not self._acquire(sid, token):
+            time.sleep(self.poll)
+        try:
+            yield
+        finally:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM session_locks WHERE sid = ? AND token = ?", (sid, token))
+
+
+def make_session_store(spec, ttl=None):
+    """
+    Build a session store from a spec string: "memory", "memory:<maxsize>",
+    "file:<directory>" or "sqlite:<database file>". File and SQLite stores
+    delete sessions not written for `ttl` seconds.
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "memory":
+        return MemorySessionStore(int(arg)) if arg else MemorySessionStore()
+    if kind == "file":
+        return FileSessionStore(arg, ttl)
+    if kind == "sqlite":
+        return SQLiteSessionStore(arg, ttl)
+    raise ValueError(f"Unknown session store {spec!r}")
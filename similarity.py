@@ -0,0 +1,187 @@
+import json
+import numpy as np
+
+from rows import FileRows
+from storage import _canonical
+
+# window lengths (time steps) indexed, a query uses the one closest to its length
+SCALES = (64, 256, 1024)
+# points each window is reduced to
+DIMS = 32
+
+
+def embed(segment, dims=DIMS):
+    """
+    A segment of any length as a unit vector of `dims` bin means with its
+    mean removed, so dot products compare shapes whatever their amplitude.
+    None for a flat segment.
+    """
+    x = np.asarray(segment, dtype=np.float64)
+    x = np.where(np.isfinite(x), x, np.nanmedian(x) if np.isfinite(x).any() else 0.0)
+    if len(x) < dims:
+        x = np.interp(np.linspace(0, len(x) - 1, dims), np.arange(len(x)), x) if len(x) > 1 else np.zeros(dims)
+    edges = (np.arange(dims) * len(x)) // dims
+    v = np.add.reduceat(x, edges) / np.diff(np.r_[edges, len(x)])
+    v -= v.mean()
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else None
+
+
+def window_features(ssins, window, nsigma=5, limit=16, dims=DIMS):
+    """
+    (starts, vectors) of the `window`-long segments of a series, at half-window
+    steps, that reach `nsigma` robust sigmas from its median: up to `limit`
+    of them, the strongest first. Quiet background is not indexed.
+    """
+    x = np.asarray(ssins, dtype=np.float64)
+    finite = x[np.isfinite(x)]
+    if len(x) < window or len(finite) == 0:
+        return np.zeros(0, np.int64), np.zeros((0, dims), np.float16)
+    median = np.median(finite)
+    sigma = 1.4826 * np.median(np.abs(finite - median)) or finite.std() or 1.0
+    x = np.where(np.isfinite(x), x, median)
+
+    # bin means at window/dims resolution, each window is `dims` consecutive bins
+    size = window // dims
+    bins = x[:len(x) // size * size].reshape(-1, size).mean(axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(bins, dims)[::dims // 2]
+    starts = np.arange(len(windows)) * (window // 2)
+
+    activity = np.abs(windows - median).max(axis=1) / sigma
+    keep = np.flatnonzero(activity >= nsigma)
+    keep = keep[np.argsort(-activity[keep], kind="stable")[:limit]]
+    v = windows[keep] - windows[keep].mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(v, axis=1)
+    keep, v, norms = keep[norms > 0], v[norms > 0], norms[norms > 0]
+    return starts[keep].astype(np.int64), (v / norms[:, None]).astype(np.float16)
+
+
+class SimilarityIndex(FileRows):
+    """
+    Shape vectors of the active windows of every file, at each of SCALES,
+    for "find similar" queries across nights.
+
+    Search is exact: one matrix-vector product over the windows of the query's
+    scale, in float32 chunks of the float16 table. Files are re-embedded only
+    when their raw stamp changes, and the table is cached in `path`/similarity.npz.
+    """
+
+    FILENAME = "similarity.npz"
+    CHUNK = 1 << 18
+
+    def __init__(self, storage, nsigma=5, limit=16):
+        super().__init__(storage)
+        self.nsigma = nsigma
+        self.limit = limit
+        # rows are canonical name -> (raw stamp, [(starts, vectors) per scale])
+        self._tables = None
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with np.load(self._cache_file) as f:
+                names, stamps = f["names"].tolist(), f["stamps"].tolist()
+                params = json.loads(str(f["params"]))
+                tables = [(f[f"owner_{w}"], f[f"starts_{w}"], f[f"vectors_{w}"]) for w in SCALES]
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        if params != self._params():
+            return
+        per_scale = []
+        for owner, starts, vectors in tables:
+            order = np.argsort(owner, kind="stable")
+            bounds = np.searchsorted(owner[order], np.arange(len(names) + 1))
+            per_scale.append([(starts[order[a:b]], vectors[order[a:b]]) for a, b in zip(bounds[:-1], bounds[1:])])
+        for i, (name, stamp) in enumerate(zip(names, stamps)):
+            self._rows[name] = (json.loads(stamp), [scale[i] for scale in per_scale])
+
+    def _params(self):
+        return {"scales": list(SCALES), "dims": DIMS, "nsigma": self.nsigma, "limit": self.limit}
+
+    def _snapshot(self):
+        with self._lock:
+            names = list(self._rows)
+            rows = [self._rows[n] for n in names]
+        snapshot = {
+            "names": np.array(names, dtype=str),
+            "stamps": np.array([json.dumps(r[0]) for r in rows], dtype=str),
+            "params": np.array(json.dumps(self._params())),
+        }
+        for s, w in enumerate(SCALES):
+            parts = [r[1][s] for r in rows]
+            snapshot[f"owner_{w}"] = np.repeat(np.arange(len(rows)), [len(p[0]) for p in parts]).astype(np.int32)
+            snapshot[f"starts_{w}"] = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, np.int64)
+            snapshot[f"vectors_{w}"] = np.concatenate([p[1] for p in parts]) if parts else np.zeros((0, DIMS), np.float16)
+        return snapshot
+
+    def _invalidate(self):
+        self._tables = None
+
+    def _update(self, rec):
+        """Re-embed one file if its raw series changed, True if it did."""
+        stamp = self._storage.raw_stamp(rec.filename)
+        old = self._rows.get(rec.canonical)
+        if old is not None and old[0] == stamp:
+            return False
+        ssins = self._storage.load_ssins(rec.filename)
+        features = [window_features(ssins, w, self.nsigma, self.limit) for w in SCALES]
+        with self._lock:
+            self._rows[rec.canonical] = (stamp, features)
+            self._invalidate()
+        return True
+
+    def _table(self, scale):
+        """(names, owner, starts, vectors) of one scale, concatenated on first use after a change."""
+        with self._lock:
+            if self._tables is None:
+                names = list(self._rows)
+                tables = []
+                for s in range(len(SCALES)):
+                    parts = [self._rows[n][1][s] for n in names]
+                    tables.append((
+                        np.repeat(np.arange(len(names)), [len(p[0]) for p in parts]),
+                        np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, np.int64),
+                        np.concatenate([p[1] for p in parts]) if parts else np.zeros((0, DIMS), np.float16),
+                    ))
+                self._tables = (names, tables)
+            names, tables = self._tables
+        return (names, *tables[SCALES.index(scale)])
+
+    def search(self, segment, k=10, exclude=None):
+        """
+        The `k` windows most similar in shape to `segment`, as (canonical name,
+        start, stop, score) with score the cosine similarity, best first.
+        Overlapping windows of one file count once. `exclude` is a
+        (canonical name, start, stop) range left out, usually the query itself.
+        """
+        query = embed(segment)
+        if query is None:
+            return []
+        # the scale closest to the query's length, on a log scale
+        scale = min(SCALES, key=lambda w: abs(np.log(w / max(len(segment), 1))))
+        names, owner, starts, vectors = self._table(scale)
+        if len(vectors) == 0:
+            return []
+
+        q = query.astype(np.float32)
+        scores = np.empty(len(vectors), np.float32)
+        for i in range(0, len(vectors), self.CHUNK):
+            scores[i:i + self.CHUNK] = vectors[i:i + self.CHUNK].astype(np.float32) @ q
+
+        # enough candidates to still have k once overlaps are merged
+        n = min(len(scores), 8 * k + 64)
+        candidates = np.argpartition(-scores, n - 1)[:n]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        matches = []
+        for i in candidates.tolist():
+            name, start = names[owner[i]], int(starts[i])
+            stop = start + scale
+            if exclude is not None and name == _canonical(exclude[0]) and start < exclude[2] and exclude[1] < stop:
+                continue
+            if any(m[0] == name and start < m[2] and m[1] < stop for m in matches):
+                continue
+            matches.append((name, start, stop, float(scores[i])))
+            if len(matches) == k:
+                break
+        return matches
@@ -0,0 +1,599 @@
+import argparse
+import functools
+import numpy as np
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import zstandard
+
+from cache import ArrayCache
+from changelog import AnnotationLog
+from metrics import timed
+from writer import WriteBehind, Journal, save_npy, atomic_write
+
+
+def _canonical(name):
+    return name[4:] if name.startswith("bad_") else name
+
+
+def _parse_name(filename):
+    split = _canonical(filename).split("_")
+    night = split[-2]
+    pointing = split[-1].split(".")[0][-1]
+    return night, pointing
+
+
+class FileRecord:
+
+    __slots__ = ("filename", "canonical", "night", "pointing", "bad", "annotated")
+
+    def __init__(self, filename, annotated=False):
+        self.filename = filename
+        self.canonical = _canonical(filename)
+        self.night, self.pointing = _parse_name(filename)
+        self.bad = filename.startswith("bad_")
+        self.annotated = annotated
+
+    def sort_key(self):
+        # sort by canonical name, with good first then bad (stable)
+        return (self.canonical, self.bad)
+
+
+class FileIndex:
+    """
+    In-memory index of the files in raw_data/ and annotations/.
+
+    Directories are only re-listed (with os.scandir) when their mtime changes,
+    and the Dataset updates records directly when it renames or saves files.
+    Such a change passes the directory `stamps` read just before it, so the
+    rescan is only skipped when no other process changed the directory since
+    the last listing. `version` moves with every change to the records or
+    their flags.
+
+    With `hold_new` set, files that appear in later listings are held back
+    until they are `admit`ted, and files replaced under the same name (a new
+    inode) are reported once by `take_replaced`. watcher.Watcher sets it.
+    """
+
+    def __init__(self, data_path, annotation_path):
+        self._data_path = data_path
+        self._annotation_path = annotation_path
+        self._records = {}
+        self._annotated = set()
+        self._data_mtime = None
+        self._annotation_mtime = None
+        self._sorted = None
+        self._inodes = {}
+        self._held = set()
+        self._replaced = set()
+        self.hold_new = False
+        self.version = 0
+        # shared by every session of a worker, so guard against concurrent refreshes
+        self._lock = threading.RLock()
+        self.refresh()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _scan(path):
+        try:
+            with os.scandir(path) as it:
+                # name -> inode, which scandir gets without a stat per file
+                return {e.name: e.inode() for e in it if e.name.endswith(".npy") and e.is_file()}
+        except FileNotFoundError:
+            return {}
+
+    def refresh(self, force=False):
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force):
+        changed = False
+
+        annotation_mtime = self._mtime(self._annotation_path)
+        if force or annotation_mtime != self._annotation_mtime:
+            self._annotated = set(self._scan(self._annotation_path))
+            self._annotation_mtime = annotation_mtime
+            for name, rec in self._records.items():
+                rec.annotated = name in self._annotated
+            self.version += 1
+
+        data_mtime = self._mtime(self._data_path)
+        if force or data_mtime != self._data_mtime:
+            names = self._scan(self._data_path)
+            # a file renamed elsewhere (marked bad or good) keeps its inode and needs no checking
+            moved = set()
+            for name in self._records.keys() - names.keys():
+                del self._records[name]
+                moved.add(self._inodes.get(name))
+            self._held &= set(names)
+            for name in names.keys() - self._records.keys() - self._held:
+                if self.hold_new and names[name] not in moved:
+                    self._held.add(name)
+                else:
+                    self._records[name] = FileRecord(name, name in self._annotated)
+            if self.hold_new:
+                self._replaced |= {name for name, inode in names.items()
+                                   if name in self._records and self._inodes.get(name, inode) != inode}
+            self._inodes = names
+            self._data_mtime = data_mtime
+            changed = True
+
+        if changed:
+            self._changed()
+        return changed
+
+    def _changed(self):
+        self._sorted = None
+        self.version += 1
+
+    def held(self):
+        """Files listed since `hold_new` was set that are not admitted yet."""
+        with self._lock:
+            return sorted(self._held)
+
+    def admit(self, filenames):
+        """Add held files to the records."""
+        with self._lock:
+            admitted = [name for name in filenames if name in self._held]
+            for name in admitted:
+                self._held.discard(name)
+                self._records[name] = FileRecord(name, name in self._annotated)
+            if admitted:
+                self._changed()
+
+    def take_replaced(self):
+        """Files replaced under the same name since the last call."""
+        with self._lock:
+            replaced, self._replaced = sorted(self._replaced), set()
+            return replaced
+
+    def _sorted_records(self):
+        if self._sorted is None:
+            self._sorted = sorted(self._records.values(), key=FileRecord.sort_key)
+        return self._sorted
+
+    @staticmethod
+    def _matches(rec, p):
+        # "" and "p" select every pointing, "pN" selects pointing N
+        return len(p) < 2 or rec.pointing == p[1:]
+
+    def records(self, p=""):
+        with self._lock:
+            return [r for r in self._sorted_records() if self._matches(r, p)]
+
+    def filenames(self, p=""):
+        return [r.filename for r in self.records(p)]
+
+    def get(self, filename):
+        with self._lock:
+            return self._records.get(filename)
+
+    def count_annotated(self, p="p"):
+        with self._lock:
+            return sum(1 for r in self._records.values() if r.annotated and self._matches(r, p))
+
+    def count_bad(self, p="p"):
+        with self._lock:
+            return sum(1 for r in self._records.values() if r.bad and self._matches(r, p))
+
+    def mark_annotated(self, filename):
+        # the file is written later, `annotations_written` follows up on its directory
+        with self._lock:
+            self._annotated.add(filename)
+            rec = self._records.get(filename)
+            if rec is not None:
+                rec.annotated = True
+            self.version += 1
+
+    def annotations_written(self, before):
+        """An annotation file was written, `before` being `stamps()` taken just before."""
+        with self._lock:
+            self._sync_stamps((None, before[1]))
+
+    def rename(self, old_name, new_name, before=(None, None)):
+        """Move a record after the files were renamed, `before` being `stamps()` taken just before."""
+        with self._lock:
+            rec = self._records.pop(old_name, None)
+            annotated = old_name in self._annotated
+            if annotated:
+                self._annotated.discard(old_name)
+                self._annotated.add(new_name)
+            self._records[new_name] = FileRecord(new_name, annotated)
+            self._changed()
+            self._sync_stamps(before)
+            return rec
+
+    def stamps(self):
+        """Current (raw_data, annotations) directory mtimes."""
+        return self._mtime(self._data_path), self._mtime(self._annotation_path)
+
+    def _sync_stamps(self, before):
+        # our own change is already applied, skip its rescan only if the
+        # directory was as last listed before it, or another process's change would be missed
+        data_before, annotation_before = before
+        if data_before is not None and data_before == self._data_mtime:
+            self._data_mtime = self._mtime(self._data_path)
+        if annotation_before is not None and annotation_before == self._annotation_mtime:
+            self._annotation_mtime = self._mtime(self._annotation_path)
+
+
+class Storage:
+    """
+    Parts shared by the storage backends: model suggestions are kept as
+    uint8 .npy files under `path`/suggestions/, apart from human annotations,
+    and with a `log` every annotation save is also recorded in it.
+
+    Annotation saves go through the write-behind `writer`; the write job logs
+    them and removes the night's journal entry only once the annotations are
+    written, and `wait_saved` reports whether that happened. The index caches
+    are written by `index_writer`, so a save never waits behind them.
+    """
+
+    log = None
+
+    def _log_base(self, filename):
+        # the labels saved before, only read (before they are overwritten) the first time the log sees a night
+        if self.log is None or self.log.history(_canonical(filename), limit=1):
+            return None
+        return self._stored_annotations(filename)
+
+    def _saved(self, filename, values, user, base):
+        if self.log is not None:
+            self.log.append(_canonical(filename), values, user, previous=lambda: base)
+        if self.journal is not None:
+            self.journal.discard(_canonical(filename))
+
+    def wait_saved(self, filename, timeout=None):
+        """
+        Wait for the queued annotation save of `filename`, raising TimeoutError
+        if it is still queued after `timeout` seconds and OSError if it failed.
+        """
+        if not self.writer.flush(timeout, keys=[self._annotation_key(filename)]):
+            raise TimeoutError(f"Saving {filename} is still pending after {timeout} s")
+        error = self.writer.error(self._annotation_key(filename))
+        if error is not None:
+            raise OSError(f"Saving {filename} failed: {error}") from error
+
+    @property
+    def suggestion_path(self):
+        return os.path.join(self.path, "suggestions")
+
+    def _suggestion_file(self, filename):
+        return os.path.join(self.suggestion_path, _canonical(filename))
+
+    def load_suggestion(self, filename):
+        try:
+            return np.load(self._suggestion_file(filename))
+        except FileNotFoundError:
+            return None
+
+    def save_suggestion(self, filename, values):
+        path = self._suggestion_file(filename)
+        atomic_write(path, lambda f: np.save(f, np.asarray(values, dtype=np.uint8)))
+        return path
+
+
+class DirectoryStorage(Storage):
+    """
+    The original layout: one .npy per night in raw_data/, a matching file in
+    annotations/, and bad files flagged by a "bad_" filename prefix.
+
+    With `mmap_mode` (e.g. "r") raw series are memory-mapped rather than read
+    into memory, annotations are always loaded in full. Annotation files are
+    written atomically by a write-behind queue.
+    """
+
+    def __init__(self, path, cache_size=32, prefetch_workers=2, mmap_mode=None, journal=False, log=False):
+        self.path = os.path.abspath(path)
+        self.mmap_mode = mmap_mode
+        self.writer = WriteBehind()
+        # the summary, similarity and model caches, so annotation saves never queue behind their snapshots
+        self.index_writer = WriteBehind()
+        self.journal = Journal(os.path.join(self.path, "journal"), self.writer) if journal else None
+        self.log = AnnotationLog(self.path) if log else None
+        self.data_path = os.path.join(self.path, "raw_data/")
+        self.annotation_path = os.path.join(self.path, "annotations/")
+        self.index = FileIndex(self.data_path, self.annotation_path)
+        self.cache = ArrayCache(maxsize=cache_size, workers=prefetch_workers)
+
+    @timed("load")
+    def load_ssins(self, filename):
+        path = os.path.join(self.data_path, filename)
+        ssins = self.cache.load(path, self.mmap_mode)
+        if ssins is None:
+            raise FileNotFoundError(path)
+        return ssins
+
+    def raw_stamp(self, filename):
+        """Changes whenever the raw series of `filename` is rewritten."""
+        st = os.stat(os.path.join(self.data_path, filename))
+        return [st.st_mtime_ns, st.st_size]
+
+    def annotation_stamp(self, filename):
+        """Changes whenever the saved annotations of `filename` are rewritten, None if there are none."""
+        try:
+            st = os.stat(os.path.join(self.annotation_path, filename))
+        except FileNotFoundError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    @timed("load")
+    def load_annotations(self, filename):
+        path = os.path.join(self.annotation_path, filename)
+        # a save that is still queued is newer than the file on disk
+        found, values = self.writer.pending(path)
+        if found:
+            return values
+        return self.cache.load(path)
+
+    def _stored_annotations(self, filename):
+        return self.cache.load(os.path.join(self.annotation_path, filename))
+
+    def _annotation_key(self, filename):
+        return os.path.join(self.annotation_path, filename)
+
+    def _write_annotations(self, filename, user, path, values):
+        base = self._log_base(filename)
+        before = self.index.stamps()
+        save_npy(path, values)
+        self.index.annotations_written(before)
+        self._saved(filename, values, user, base)
+
+    def save_annotations(self, filename, values, user=None):
+        path = self._annotation_key(filename)
+        self.writer.submit(path, functools.partial(self._write_annotations, filename, user), values)
+        self.index.mark_annotated(filename)
+        return path
+
+    def rename(self, old_name, new_name):
+        # queued saves still target the old name
+        self.writer.flush(keys=[self._annotation_key(old_name)])
+
+        old_data = Path(self.data_path) / old_name
+        new_data = Path(self.data_path) / new_name
+        old_ann  = Path(self.annotation_path) / old_name
+        new_ann  = Path(self.annotation_path) / new_name
+        before = self.index.stamps()
+
+        # data file
+        new_data.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(old_data, new_data)
+
+        # annotation file (if present)
+        if old_ann.exists():
+            new_ann.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_ann, new_ann)
+
+        self.index.rename(old_name, new_name, before)
+
+    def prefetch(self, filenames):
+        self.cache.prefetch([os.path.join(self.data_path, f) for f in filenames], self.mmap_mode)
+        self.cache.prefetch([os.path.join(self.annotation_path, f) for f in filenames])
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+
+class ArchiveIndex(FileIndex):
+    """FileIndex over the metadata database of an archive."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._conn = None
+        self._extents = {}
+        self._data_version = None
+        super().__init__(storage.path, storage.path)
+
+    def _refresh(self, force):
+        # data_version only moves when another connection commits, so the
+        # index polls through a connection of its own (used under its lock)
+        if self._conn is None:
+            self._conn = sqlite3.connect(os.path.join(self._storage.path, self._storage.META),
+                                         timeout=30, check_same_thread=False)
+        conn = self._conn
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if not force and version == self._data_version:
+            return False
+
+        rows = conn.execute(
+            "SELECT f.name, f.offset, f.length, f.bad, a.name IS NOT NULL "
+            "FROM files f LEFT JOIN annotations a ON a.name = f.name"
+        ).fetchall()
+        # built aside and swapped in, the old records stay whole for readers until then
+        records, annotated_names, extents = {}, set(), {}
+        for name, offset, length, bad, annotated in rows:
+            filename = f"bad_{name}" if bad else name
+            records[filename] = FileRecord(filename, bool(annotated))
+            extents[name] = (offset, length)
+            if annotated:
+                annotated_names.add(filename)
+        self._records, self._annotated, self._extents = records, annotated_names, extents
+        self._data_version = version
+        self._changed()
+        return True
+
+    def extent(self, filename):
+        return self._extents[_canonical(filename)]
+
+    def _sync_stamps(self, before):
+        pass
+
+
+class ArchiveStorage(Storage):
+    """
+    A whole campaign in one directory: every night's SSINS series concatenated
+    into a single memory-mapped ssins.npy, with offsets, bad flags and
+    zstd-compressed uint8 annotations in meta.sqlite. Flagging a file or
+    saving annotations only touches the database, annotation writes go
+    through a write-behind queue.
+    """
+
+    SSINS = "ssins.npy"
+    META = "meta.sqlite"
+
+    def __init__(self, path, prefetch_workers=2, journal=False, log=False):
+        self.path = os.path.abspath(path)
+        self._local = threading.local()
+        self.writer = WriteBehind()
+        self.index_writer = WriteBehind()
+        self.journal = Journal(os.path.join(self.path, "journal"), self.writer) if journal else None
+        self.log = AnnotationLog(self.path) if log else None
+        self._ssins = np.load(os.path.join(self.path, self.SSINS), mmap_mode="r")
+        self._pool = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch")
+        self.index = ArchiveIndex(self)
+
+    @classmethod
+    def is_archive(cls, path):
+        return (os.path.isfile(os.path.join(path, cls.SSINS))
+                and os.path.isfile(os.path.join(path, cls.META)))
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, self.META), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @timed("load")
+    def load_ssins(self, filename):
+        offset, length = self.index.extent(filename)
+        return self._ssins[offset:offset + length]
+
+    def raw_stamp(self, filename):
+        """Changes whenever the archive, or this night's place in it, is rewritten."""
+        st = os.stat(os.path.join(self.path, self.SSINS))
+        return [st.st_mtime_ns, *self.index.extent(filename)]
+
+    def annotation_stamp(self, filename):
+        # INSERT OR REPLACE gives the row a new rowid on every save
+        row = self._connect().execute(
+            "SELECT rowid, length(data) FROM annotations WHERE name = ?", (_canonical(filename),)
+        ).fetchone()
+        return None if row is None else list(row)
+
+    @timed("load")
+    def load_annotations(self, filename):
+        found, blob = self.writer.pending(_canonical(filename))
+        if found:
+            return np.frombuffer(zstandard.decompress(blob), dtype=np.uint8)
+        return self._stored_annotations(filename)
+
+    def _stored_annotations(self, filename):
+        row = self._connect().execute(
+            "SELECT data FROM annotations WHERE name = ?", (_canonical(filename),)
+        ).fetchone()
+        return None if row is None else np.frombuffer(zstandard.decompress(row[0]), dtype=np.uint8)
+
+    def _annotation_key(self, filename):
+        return _canonical(filename)
+
+    def _write_annotations(self, values, user, name, blob):
+        base = self._log_base(name)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO annotations (name, data) VALUES (?, ?)", (name, blob))
+        self._saved(name, values, user, base)
+
+    def save_annotations(self, filename, values, user=None):
+        name = _canonical(filename)
+        blob = zstandard.compress(np.asarray(values).astype(np.uint8).tobytes())
+        self.writer.submit(name, functools.partial(self._write_annotations, values, user), blob)
+        self.index.mark_annotated(filename)
+        return f"{os.path.join(self.path, self.META)} ({name})"
+
+    def rename(self, old_name, new_name):
+        with self._connect() as conn:
+            conn.execute("UPDATE files SET bad = ? WHERE name = ?",
+                         (int(new_name.startswith("bad_")), _canonical(old_name)))
+        self.index.rename(old_name, new_name)
+
+    def _touch(self, filename):
+        # fault the night's pages in so the next load is served from the page cache
+        offset, length = self.index.extent(filename)
+        return float(np.add.reduce(self._ssins[offset:offset + length]))
+
+    def prefetch(self, filenames):
+        for f in filenames:
+            self._pool.submit(self._touch, f)
+
+    def cache_stats(self):
+        return {}
+
+
+def open_storage(path, cache_size=32, prefetch_workers=2, mmap_mode=None, journal=False, log=False):
+    """
+    Open `path` as an archive if it is one, otherwise as a raw_data/annotations
+    directory. Archives are always memory-mapped. With `journal`, unexported
+    edits are autosaved under `path`/journal/, with `log` every save is
+    recorded in the append-only annotation log.
+    """
+    if ArchiveStorage.is_archive(path):
+        return ArchiveStorage(path, prefetch_workers=prefetch_workers, journal=journal, log=log)
+    return DirectoryStorage(path, cache_size=cache_size, prefetch_workers=prefetch_workers,
+                            mmap_mode=mmap_mode, journal=journal, log=log)
+
+
+def pack(src, dst):
+    """Convert a raw_data/annotations directory into an archive at `dst`."""
+    source = DirectoryStorage(src)
+    records = []
+    seen = set()
+    for rec in source.index.records():
+        if rec.canonical in seen:
+            print(f"Skipping {rec.filename}: {rec.canonical} is already packed")
+            continue
+        seen.add(rec.canonical)
+        records.append(rec)
+
+    # only the headers are read to size the output
+    shapes = [np.load(os.path.join(source.data_path, r.filename), mmap_mode="r") for r in records]
+    dtype = np.result_type(*[s.dtype for s in shapes]) if shapes else np.float64
+    lengths = [len(s) for s in shapes]
+    del shapes
+
+    os.makedirs(dst, exist_ok=True)
+    out = np.lib.format.open_memmap(os.path.join(dst, ArchiveStorage.SSINS), mode="w+",
+                                    dtype=dtype, shape=(sum(lengths),))
+    meta = sqlite3.connect(os.path.join(dst, ArchiveStorage.META))
+    with meta:
+        meta.execute("CREATE TABLE IF NOT EXISTS files ("
+                     "name TEXT PRIMARY KEY, offset INTEGER NOT NULL, "
+                     "length INTEGER NOT NULL, bad INTEGER NOT NULL DEFAULT 0)")
+        meta.execute("CREATE TABLE IF NOT EXISTS annotations (name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        meta.execute("DELETE FROM files")
+        meta.execute("DELETE FROM annotations")
+
+        offset = 0
+        for rec, length in zip(records, lengths):
+            out[offset:offset + length] = np.load(os.path.join(source.data_path, rec.filename))
+            meta.execute("INSERT INTO files VALUES (?, ?, ?, ?)",
+                         (rec.canonical, offset, length, int(rec.bad)))
+            annotations = source.load_annotations(rec.filename)
+            if annotations is not None:
+                blob = zstandard.compress(np.asarray(annotations).astype(np.uint8).tobytes())
+                meta.execute("INSERT INTO annotations VALUES (?, ?)", (rec.canonical, blob))
+            offset += length
+    out.flush()
+    meta.close()
+    print(f"Packed {len(records)} files ({offset} time steps) into {os.path.abspath(dst)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage annotator storage backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_pack = sub.add_parser("pack", help="pack a raw_data/annotations directory into an archive")
+    p_pack.add_argument("src")
+    p_pack.add_argument("dst")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack(args.src, args.dst)
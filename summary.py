@@ -0,0 +1,180 @@
+import json
+import numpy as np
+
+from hmm import N_STATES
+from rows import FileRows
+from storage import _canonical
+
+RAW_FIELDS = ("length", "min", "max", "median", "rms", "peaks")
+STATE_FIELDS = tuple(f"frac_{s}" for s in range(N_STATES + 1))
+FIELDS = RAW_FIELDS + STATE_FIELDS
+
+
+def raw_summary(ssins, nsigma=5):
+    """
+    Length, min, max, median and RMS of a series, and the number of peaks:
+    runs of points more than `nsigma` robust sigmas (1.4826 MAD) from the median.
+    """
+    x = np.asarray(ssins, dtype=np.float64)
+    finite = x[np.isfinite(x)]
+    if len(finite) == 0:
+        return [len(x), np.nan, np.nan, np.nan, np.nan, 0]
+
+    median = np.median(finite)
+    deviation = np.abs(x - median)
+    sigma = 1.4826 * np.median(np.abs(finite - median)) or finite.std()
+    above = deviation > nsigma * sigma if sigma > 0 else np.zeros(len(x), bool)
+    peaks = int(above[0]) + np.count_nonzero(above[1:] & ~above[:-1]) if len(x) else 0
+    return [len(x), finite.min(), finite.max(), median, np.sqrt(np.mean(finite ** 2)), peaks]
+
+
+def _bin_starts(n, width):
+    return (np.arange(width) * n) // width
+
+
+def thumbnail(ssins, width=256):
+    """Series reduced to `width` bins, each holding its maximum (NaN-aware) so peaks survive."""
+    x = np.asarray(ssins, dtype=np.float32)
+    if len(x) == 0:
+        return np.full(width, np.nan, np.float32)
+    return np.fmax.reduceat(x, _bin_starts(len(x), width))
+
+
+def state_thumbnail(labels, length, width=256):
+    """Most common state of each of `width` bins, 0 where there are no annotations."""
+    if labels is None or len(labels) == 0 or length == 0:
+        return np.zeros(width, np.uint8)
+    s = np.clip(np.asarray(labels).astype(np.intp), 0, N_STATES)
+    onehot = np.eye(N_STATES + 1, dtype=np.int32)[s]
+    return np.add.reduceat(onehot, _bin_starts(len(s), width), axis=0).argmax(axis=1).astype(np.uint8)
+
+
+def state_summary(labels, length):
+    """Fraction of points in each state, 0 (unlabelled) to N_STATES."""
+    if labels is None or len(labels) == 0:
+        fractions = np.zeros(N_STATES + 1)
+        fractions[0] = 1.0 if length else 0.0
+        return fractions.tolist()
+    s = np.clip(np.asarray(labels).astype(np.intp), 0, N_STATES)
+    return (np.bincount(s, minlength=N_STATES + 1) / len(s)).tolist()
+
+
+class SummaryIndex(FileRows):
+    """
+    Per-file summary statistics (RAW_FIELDS of the raw series, STATE_FIELDS of
+    its annotations), so files can be filtered and sorted without loading them.
+
+    A `width`-bin thumbnail of the series and of its states is kept with them
+    for the overview. Each part is stamped with the storage's raw/annotation
+    stamp and only recomputed when that changes. The table is cached in
+    `path`/summary.npz.
+    """
+
+    FILENAME = "summary.npz"
+
+    def __init__(self, storage, nsigma=5, width=256):
+        super().__init__(storage)
+        self.nsigma = nsigma
+        self.width = width
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with np.load(self._cache_file) as f:
+                names, stamps, values = f["names"], f["stamps"], f["values"]
+                thumbs, thumb_states = f["thumbs"], f["thumb_states"]
+                nsigma, fields = float(f["nsigma"]), tuple(f["fields"].tolist())
+        except (FileNotFoundError, KeyError, ValueError):
+            return
+        if nsigma != self.nsigma or fields != FIELDS or thumbs.shape[1:] != (self.width,):
+            return
+        for name, stamp, row, thumb, states in zip(names.tolist(), stamps.tolist(), values, thumbs, thumb_states):
+            raw_stamp, ann_stamp = json.loads(stamp)
+            self._rows[name] = (raw_stamp, ann_stamp, row.tolist(), thumb, states)
+
+    def _snapshot(self):
+        with self._lock:
+            names = list(self._rows)
+            rows = [self._rows[n] for n in names]
+        return {
+            "nsigma": self.nsigma,
+            "fields": np.array(FIELDS),
+            "names": np.array(names, dtype=str),
+            "stamps": np.array([json.dumps(r[:2]) for r in rows], dtype=str),
+            "values": np.array([r[2] for r in rows], dtype=np.float64).reshape(len(rows), len(FIELDS)),
+            "thumbs": np.array([r[3] for r in rows], dtype=np.float32).reshape(len(rows), self.width),
+            "thumb_states": np.array([r[4] for r in rows], dtype=np.uint8).reshape(len(rows), self.width),
+        }
+
+    def _update(self, rec):
+        """Recompute the stale parts of one file's row, True if anything changed."""
+        raw_stamp = self._storage.raw_stamp(rec.filename)
+        ann_stamp = self._storage.annotation_stamp(rec.filename)
+        old = self._rows.get(rec.canonical)
+        if old is not None and old[0] == raw_stamp and old[1] == ann_stamp:
+            return False
+
+        if old is not None and old[0] == raw_stamp:
+            raw, thumb = old[2][:len(RAW_FIELDS)], old[3]
+        else:
+            ssins = self._storage.load_ssins(rec.filename)
+            raw, thumb = raw_summary(ssins, self.nsigma), thumbnail(ssins, self.width)
+        if old is not None and old[1] == ann_stamp:
+            states, thumb_states = old[2][len(RAW_FIELDS):], old[4]
+        else:
+            labels = self._storage.load_annotations(rec.filename)
+            states = state_summary(labels, raw[0])
+            thumb_states = state_thumbnail(labels, raw[0], self.width)
+
+        with self._lock:
+            self._rows[rec.canonical] = (raw_stamp, ann_stamp, [float(v) for v in raw + states],
+                                         thumb, thumb_states)
+        return True
+
+    def get(self, filename):
+        """{field: value} for one file, or None if it has not been summarised yet."""
+        with self._lock:
+            row = self._rows.get(_canonical(filename))
+        return None if row is None else dict(zip(FIELDS, row[2]))
+
+    def thumbnails(self, filenames):
+        """(len(filenames), width) arrays of thumbnail values (NaN if missing) and states."""
+        values = np.full((len(filenames), self.width), np.nan, np.float32)
+        states = np.zeros((len(filenames), self.width), np.uint8)
+        with self._lock:
+            for i, f in enumerate(filenames):
+                row = self._rows.get(_canonical(f))
+                if row is not None:
+                    values[i], states[i] = row[3], row[4]
+        return values, states
+
+    def select(self, filenames, where=None, sort=None, descending=False):
+        """
+        The subset of `filenames` whose values lie within `where` ({field: [low, high]},
+        either bound may be None), ordered by `sort` if given. Files without a
+        summary are kept when nothing is filtered and left out otherwise.
+        """
+        where = {k: v for k, v in (where or {}).items() if v is not None and any(b is not None for b in v)}
+        if not where and sort is None:
+            return list(filenames)
+
+        out, missing = [], []
+        for f in filenames:
+            row = self.get(f)
+            if row is None:
+                if not where:
+                    missing.append(f)
+                continue
+            ok = True
+            for field, (low, high) in where.items():
+                v = row[field]
+                if (low is not None and not v >= low) or (high is not None and not v <= high):
+                    ok = False
+                    break
+            if ok:
+                key = row[sort] if sort is not None else 0.0
+                out.append((-np.inf if np.isnan(key) else key, f))
+
+        if sort is not None:
+            out.sort(key=lambda kv: kv[0], reverse=descending)
+        return [f for _, f in out] + missing
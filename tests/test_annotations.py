@@ -0,0 +1,103 @@
+import numpy as np
+
+from annotations import SUGGESTED, AnnotationRuns, EditHistory, reviewed
+
+
+def check(runs, dense):
+    np.testing.assert_array_equal(runs.dense(), dense)
+    assert len(runs) == len(dense)
+    if len(dense):
+        assert runs._starts[0] == 0
+        assert np.all(np.diff(runs._starts) > 0)
+        # neighbouring segments never share a state
+        assert np.all(runs._states[1:] != runs._states[:-1])
+
+
+def random_range(rng, n):
+    a, b = sorted(rng.integers(-3, n + 4, size=2))
+    return int(a), int(b)
+
+
+def test_edits_match_dense():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n = int(rng.integers(1, 60))
+        dense = rng.integers(0, 2 * SUGGESTED + 1, n).astype(np.uint8)
+        runs = AnnotationRuns.from_dense(dense)
+        check(runs, dense)
+        for _ in range(20):
+            a, b = random_range(rng, n)
+            lo, hi = max(a, 0), max(min(b, n), 0)
+            op = rng.integers(3)
+            if op == 0:
+                state = int(rng.integers(0, SUGGESTED + 1))
+                runs.set_range(a, b, state)
+                dense[lo:hi] = state
+            elif op == 1:
+                runs.accept([(a, b)])
+                dense[lo:hi] = reviewed(dense[lo:hi])
+            elif hi > lo:
+                # copy the runs of another labelling over [lo, hi)
+                other = rng.integers(0, SUGGESTED + 1, n).astype(np.uint8)
+                runs.set_runs(lo, hi, *AnnotationRuns.from_dense(other).runs(lo, hi))
+                dense[lo:hi] = other[lo:hi]
+            check(runs, dense)
+
+
+def test_runs_round_trip():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        dense = rng.integers(0, 3, int(rng.integers(1, 40))).astype(np.uint8)
+        runs = AnnotationRuns.from_dense(dense)
+        a, b = sorted(rng.integers(0, len(dense) + 1, size=2))
+        if b == a:
+            continue
+        starts, states = runs.runs(a, b)
+        np.testing.assert_array_equal(AnnotationRuns(starts, states, b - a).dense(), dense[a:b])
+
+
+def test_undo_redo():
+    rng = np.random.default_rng(2)
+    for _ in range(100):
+        n = int(rng.integers(1, 80))
+        runs = AnnotationRuns.from_dense(rng.integers(0, 2 * SUGGESTED + 1, n))
+        history = EditHistory(max_steps=1000, max_segments=10 ** 6)
+        states = [runs.dense().copy()]
+        for _ in range(int(rng.integers(1, 15))):
+            # disjoint ranges, as the browser sends them
+            a, b, c, d = sorted(rng.integers(-3, n + 4, size=4).tolist())
+            ranges = [(a, b), (c, d)]
+            if rng.random() < 0.3:
+                history.accept(runs, ranges)
+            else:
+                history.set_ranges(runs, ranges, int(rng.integers(0, SUGGESTED + 1)))
+            # edits of empty ranges record no step
+            if len(history.undo_steps) == len(states):
+                states.append(runs.dense().copy())
+        for s in reversed(states[:-1]):
+            assert history.undo(runs) is not None
+            check(runs, s)
+        assert history.undo(runs) is None
+        for s in states[1:]:
+            assert history.redo(runs) is not None
+            check(runs, s)
+
+
+def test_history_survives_the_session_store():
+    runs = AnnotationRuns.zeros(20)
+    history = EditHistory()
+    history.set_ranges(runs, [(2, 5), (10, 12)], 3)
+    restored = EditHistory(**history.state())
+    restored.undo(runs)
+    check(runs, np.zeros(20, np.uint8))
+
+
+def test_trim_keeps_latest_steps():
+    runs = AnnotationRuns.zeros(10)
+    history = EditHistory(max_steps=3)
+    for state in range(1, 6):
+        history.set_ranges(runs, [(0, 10)], state)
+    for expected in (4, 3, 2):
+        history.undo(runs)
+        check(runs, np.full(10, expected, np.uint8))
+    assert history.undo(runs) is None
@@ -0,0 +1,64 @@
+import numpy as np
+
+from changelog import AnnotationLog
+
+
+def random_save(rng, values):
+    values = values.copy()
+    for _ in range(int(rng.integers(1, 4))):
+        a, b = sorted(rng.integers(0, len(values) + 1, size=2))
+        values[a:b] = rng.integers(0, 4)
+    return values
+
+
+def test_replay_matches_saves(tmp_path):
+    rng = np.random.default_rng(0)
+    log = AnnotationLog(str(tmp_path), snapshot_every=3)
+    saved = {}
+    values = {"a": np.zeros(500, np.uint8), "b": np.zeros(80, np.uint8)}
+    for _ in range(60):
+        name = "a" if rng.random() < 0.7 else "b"
+        values[name] = random_save(rng, values[name])
+        version = log.append(name, values[name], user="u")
+        if version is not None:
+            saved[version] = (name, values[name])
+
+    for version, (name, expected) in saved.items():
+        np.testing.assert_array_equal(log.state(name, version).dense(), expected)
+    for name in values:
+        np.testing.assert_array_equal(log.state(name).dense(), values[name])
+
+
+def test_unchanged_save_adds_no_version(tmp_path):
+    log = AnnotationLog(str(tmp_path))
+    values = np.array([0, 1, 1, 2], np.uint8)
+    assert log.append("a", values) is not None
+    assert log.append("a", values) is None
+    assert len(log.history("a")) == 1
+
+
+def test_compact_keeps_states(tmp_path):
+    rng = np.random.default_rng(1)
+    log = AnnotationLog(str(tmp_path), snapshot_every=10 ** 6)
+    values, saved = np.zeros(300, np.uint8), {}
+    for _ in range(20):
+        values = random_save(rng, values)
+        version = log.append("a", values)
+        if version is not None:
+            saved[version] = values
+    assert log.compact() == 1
+    assert log.compact() == 0
+    for version, expected in saved.items():
+        np.testing.assert_array_equal(log.state("a", version).dense(), expected)
+
+
+def test_previous_labels_are_logged_first(tmp_path):
+    log = AnnotationLog(str(tmp_path))
+    base = np.array([1, 1, 2, 2, 0], np.uint8)
+    values = np.array([1, 1, 3, 2, 0], np.uint8)
+    version = log.append("a", values, user="u", previous=lambda: base)
+    first = log.history("a")[-1]["version"]
+    assert first < version
+    np.testing.assert_array_equal(log.state("a", first).dense(), base)
+    np.testing.assert_array_equal(log.state("a").dense(), values)
+    assert log.state("b") is None
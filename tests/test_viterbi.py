@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from hmm import viterbi_path
+
+
+def naive_viterbi(log_pi, log_A, log_B):
+    T, K = log_B.shape
+    d = log_pi + log_B[0]
+    psi = np.zeros((T, K), dtype=np.intp)
+    for t in range(1, T):
+        scores = d[:, None] + log_A
+        psi[t] = scores.argmax(axis=0)
+        d = scores.max(axis=0) + log_B[t]
+    path = [int(d.argmax())]
+    for t in range(T - 1, 0, -1):
+        path.append(int(psi[t, path[-1]]))
+    return np.array(path[::-1])
+
+
+def random_model(rng, T, K):
+    log_pi = np.log(rng.dirichlet(np.ones(K)))
+    log_A = np.log(rng.dirichlet(np.ones(K), size=K))
+    log_B = rng.normal(0, 3, (T, K))
+    return log_pi, log_A, log_B
+
+
+@pytest.mark.parametrize("T", [1, 2, 3, 7, 50, 257, 1000])
+def test_matches_naive(T):
+    rng = np.random.default_rng(T)
+    for K in (1, 2, 4):
+        model = random_model(rng, T, K)
+        np.testing.assert_array_equal(viterbi_path(*model), naive_viterbi(*model))
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 16, 99, 1000])
+def test_any_chunk_size(chunk):
+    rng = np.random.default_rng(chunk)
+    model = random_model(rng, 200, 4)
+    np.testing.assert_array_equal(viterbi_path(*model, chunk=chunk), naive_viterbi(*model))
+
+
+def test_forbidden_transitions():
+    # -inf entries must not leak into the padded last chunk or the back-pointers
+    rng = np.random.default_rng(0)
+    log_pi, log_A, log_B = random_model(rng, 101, 4)
+    log_A[0, 1] = log_A[2, 3] = -np.inf
+    path = viterbi_path(log_pi, log_A, log_B, chunk=7)
+    np.testing.assert_array_equal(path, naive_viterbi(log_pi, log_A, log_B))
+    assert not np.any((path[:-1] == 0) & (path[1:] == 1))
+
+
+def test_empty():
+    assert len(viterbi_path(np.zeros(2), np.zeros((2, 2)), np.zeros((0, 2)))) == 0
@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+import threading
+
+from storage import _parse_name
+
+logger = logging.getLogger(__name__)
+
+
+def problem(filename, ssins):
+    """Why a night cannot be annotated, None if it can."""
+    try:
+        _parse_name(filename)
+    except IndexError:
+        return "name does not end in _<night>_<pointing>.npy"
+    if ssins.ndim != 1:
+        return f"expected a 1-D series, got shape {ssins.shape}"
+    if not np.issubdtype(ssins.dtype, np.number):
+        return f"expected numbers, got {ssins.dtype}"
+    if len(ssins) == 0:
+        return "series is empty"
+    return None
+
+
+class Watcher:
+    """
+    Picks up nights written to storage while the app runs, every `interval`
+    seconds.
+
+    New files are held back from the file index until their raw series loads
+    and passes `problem`, then admitted, and the caches of new and replaced
+    files are warmed: the array cache, the `summary` and `similar` rows and
+    the uncertainty `ranking`. A file that fails is only checked again once
+    its raw stamp changes, so a night still being written shows up when it
+    is complete. Replaced files are noticed by inode, so upstream should
+    write nights under a temporary name and rename them into place.
+    """
+
+    def __init__(self, storage, interval=5.0, summary=None, similar=None, ranking=None):
+        self._storage = storage
+        self.interval = interval
+        self._indexes = [i for i in (summary, similar) if i is not None]
+        self._ranking = ranking
+        # held filename -> raw stamp it failed at
+        self._failed = {}
+        self._stop = threading.Event()
+        storage.index.hold_new = True
+
+    def _check(self, filename):
+        try:
+            ssins = np.asarray(self._storage.load_ssins(filename))
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            # truncated or not an .npy at all
+            return f"cannot be loaded ({e})"
+        return problem(filename, ssins)
+
+    def _warm(self, filenames):
+        if not filenames:
+            return
+        self._storage.prefetch(filenames)
+        for index in self._indexes:
+            index.update(filenames)
+        if self._ranking is not None:
+            for filename in filenames:
+                rec = self._storage.index.get(filename)
+                if rec is not None and not rec.annotated and not rec.bad:
+                    self._ranking.add(filename)
+
+    def poll(self):
+        """Admit the held files that pass and warm the caches, returns the files admitted."""
+        index = self._storage.index
+        index.refresh()
+        held = index.held()
+        self._failed = {f: stamp for f, stamp in self._failed.items() if f in held}
+
+        admitted = []
+        for filename in held:
+            try:
+                stamp = self._storage.raw_stamp(filename)
+                if self._failed.get(filename) == stamp:
+                    continue
+                reason = self._check(filename)
+            except FileNotFoundError:
+                continue
+            if reason is None:
+                self._failed.pop(filename, None)
+                admitted.append(filename)
+            else:
+                self._failed[filename] = stamp
+                logger.warning("Holding back %s: %s", filename, reason)
+
+        index.admit(admitted)
+        if admitted:
+            logger.info("Added %d new nights", len(admitted))
+        self._warm(admitted + index.take_replaced())
+        return admitted
+
+    def start(self):
+        """Poll in a background thread until `stop`."""
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.poll()
+                except Exception:
+                    logger.exception("Watching for new nights failed")
+        threading.Thread(target=run, name="watcher", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,202 @@
+import atexit
+import logging
+import numpy as np
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, write, mode="wb"):
+    """
+    Write a file so readers only ever see the old or the new contents:
+    write to a temporary file next to it, fsync, then rename over `path`.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    # make the rename itself durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_npy(path, values):
+    atomic_write(path, lambda f: np.save(f, values))
+
+
+def remove_file(path, _=None):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class WriteBehind:
+    """
+    Queue of pending writes flushed by a background thread.
+
+    Each write is a (function, value) pair under a key. Submitting a key that
+    is still queued replaces its value in place, so bursts of saves to the
+    same target are merged into one write, and writes run in the order their
+    keys were first queued. `pending` lets readers see queued values, and
+    `error` the exception of a key's last write if it failed.
+    """
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self._queue = OrderedDict()
+        self._inflight = {}
+        self._cond = threading.Condition()
+        self.written = 0
+        self.merged = 0
+        self.failed = 0
+        self._errors = {}
+        self._flushing = 0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, key, write, value=None):
+        with self._cond:
+            if key in self._queue:
+                self.merged += 1
+            self._queue[key] = (write, value)
+            self._cond.notify_all()
+
+    def pending(self, key):
+        """(found, value) for the newest queued or in-flight write to `key`."""
+        with self._cond:
+            item = self._queue.get(key) or self._inflight.get(key)
+        return (False, None) if item is None else (True, item[1])
+
+    def error(self, key):
+        """The exception raised by the last write to `key`, None if it succeeded."""
+        with self._cond:
+            return self._errors.get(key)
+
+    def flush(self, timeout=None, keys=None):
+        """
+        Block until every queued write, or only the writes to `keys`, has been
+        performed, False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if keys is None:
+            waiting = lambda: self._queue or self._inflight
+        else:
+            waiting = lambda: any(k in self._queue or k in self._inflight for k in keys)
+        with self._cond:
+            # the writer skips its delay while someone waits
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while waiting():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            # let a burst of edits collapse into one write
+            with self._cond:
+                self._cond.wait_for(lambda: self._flushing, self.delay)
+                batch, self._queue = self._queue, OrderedDict()
+                self._inflight = dict(batch)
+
+            for key, (write, value) in batch.items():
+                try:
+                    write(key, value)
+                    self.written += 1
+                    error = None
+                except Exception as e:
+                    self.failed += 1
+                    error = e
+                    logger.exception("Failed to write %s", key)
+                with self._cond:
+                    if error is None:
+                        self._errors.pop(key, None)
+                    else:
+                        self._errors[key] = error
+                    # waiters on this key need not wait for the rest of the batch
+                    del self._inflight[key]
+                    self._cond.notify_all()
+
+            with self._cond:
+                self._inflight = {}
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "written": self.written,
+                "merged": self.merged,
+                "failed": self.failed,
+            }
+
+
+class Journal:
+    """
+    Autosave of annotations that have not been exported yet, as compact
+    run-length .npz files keyed by canonical filename. Each entry records its
+    `owner` (the user or session that made it) and `base`, the stamp of the
+    saved annotations it was made over, so readers can skip entries that are
+    not theirs or that a later export superseded. Entries are written through
+    the write-behind queue, and removed by the storage once a night's exported
+    annotations are written.
+    """
+
+    def __init__(self, path, writer):
+        self.path = os.path.abspath(path)
+        self._writer = writer
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{os.path.splitext(name)[0]}.npz")
+
+    @staticmethod
+    def _write(path, entry):
+        starts, states, length, owner, base = entry
+        atomic_write(path, lambda f: np.savez(f, starts=starts, states=states, length=length,
+                                              owner=owner, base=base))
+
+    def record(self, name, annotations, owner="", base=""):
+        entry = (annotations._starts.copy(), annotations._states.copy(), annotations.length, owner, base)
+        self._writer.submit(self._file(name), self._write, entry)
+
+    def discard(self, name):
+        remove_file(self._file(name))
+
+    def load(self, name):
+        """(starts, states, length, owner, base) of the journalled annotations, or None."""
+        path = self._file(name)
+        found, value = self._writer.pending(path)
+        if found:
+            return value
+        try:
+            with np.load(path) as f:
+                # entries from before owners were recorded belong to nobody
+                owner, base = (str(f["owner"]), str(f["base"])) if "owner" in f else (None, None)
+                return f["starts"], f["states"], int(f["length"]), owner, base
+        except FileNotFoundError:
+            return None